@@ -3,14 +3,88 @@ ASGI config for ai project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Unlike the default Django 3.2 handler, ``StreamingASGIHandler`` is able to send
+``AsyncStreamingHttpResponse`` bodies from the event loop, so an open SSE stream
+does not pin a thread for the whole duration of the completion. It also listens for
+``http.disconnect`` and closes the stream as soon as the client is gone.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
+from contextvars import ContextVar
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai.settings')
 
-application = get_asgi_application()
+
+_receive: ContextVar = ContextVar("receive")
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """ASGI handler that also sends responses backed by async iterators."""
+
+    async def __call__(self, scope, receive, send):
+        # `send_response` has no access to `receive`, which is needed to notice disconnects
+        _receive.set(receive)
+        await super().__call__(scope, receive, send)
+
+    @staticmethod
+    async def _until_disconnect(stream, receive):
+        """Yields the parts of `stream` until the client disconnects."""
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            while True:
+                part = asyncio.ensure_future(stream.__anext__())
+                await asyncio.wait([part, disconnect], return_when=asyncio.FIRST_COMPLETED)
+                if not part.done():
+                    part.cancel()
+                    return
+                try:
+                    yield part.result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            disconnect.cancel()
+
+    async def send_response(self, response, send):
+        if not getattr(response, 'is_async', False):
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b'Set-Cookie', c.output(header='').encode('ascii').strip())
+            )
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+        stream = response.async_streaming_content
+        try:
+            async for part in self._until_disconnect(stream, _receive.get()):
+                await send({
+                    'type': 'http.response.body',
+                    'body': part,
+                    'more_body': True,
+                })
+            await send({'type': 'http.response.body'})
+        finally:
+            if hasattr(stream, 'aclose'):
+                await stream.aclose()
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
@@ -10,6 +10,186 @@ GPT_API_KEY = gpt_secrets.get('GPT_API_KEY')
 GPT_MODEL_ENGINE = gpt_secrets.get('GPT_MODEL_ENGINE')
 DALLE_MODEL_ENGINE = gpt_secrets.get('DALLE_MODEL_ENGINE')
 
+# LLM provider (see main.providers). Set "LLM_PROVIDER": "fake" in the GPT secrets to answer
+# in-process without calling OpenAI, e.g. for load tests. The fake provider answers after
+# first_token_latency seconds at tokens_per_second, fails error_rate of the calls and returns
+# image_url (a 1x1 PNG by default) as generated images.
+LLM_PROVIDER = {
+    "BACKEND": "main.providers.OpenAIProvider",
+    "OPTIONS": {},
+}
+if gpt_secrets.get('LLM_PROVIDER') == "fake":
+    LLM_PROVIDER = {
+        "BACKEND": "main.providers.FakeProvider",
+        "OPTIONS": {
+            "first_token_latency": 0.3,
+            "tokens_per_second": 50,
+            "tokens": 100,
+            "error_rate": 0.0,
+            "seed": 0,
+            "image_url": None,
+        },
+    }
+
+# HTTP transport of the OpenAI clients (see main.transport). HTTP2 requires the `h2` package.
+# Non-streamed calls wait for the whole answer before the first byte, hence the long READ_TIMEOUT;
+# STREAM_READ_TIMEOUT is the longest allowed gap between streamed chunks.
+OPENAI_HTTP = {
+    "MAX_CONNECTIONS": 100,
+    "MAX_KEEPALIVE_CONNECTIONS": 20,
+    "KEEPALIVE_EXPIRY": 30,
+    "HTTP2": False,
+    "CONNECT_TIMEOUT": 10,
+    "POOL_TIMEOUT": 10,
+    "READ_TIMEOUT": 600,
+    "STREAM_READ_TIMEOUT": 60,
+}
+
+# Limits for LLM calls (see main.limiter). Calls over the token bucket rates or in-flight maximums
+# wait in a round-robin per user queue of QUEUE_SIZE (USER_QUEUE_SIZE per user) for up to
+# QUEUE_TIMEOUT seconds. Streams get `queued` events meanwhile. A full queue answers 429.
+LLM_LIMITS = {
+    "GLOBAL_RATE": 20,
+    "GLOBAL_BURST": 40,
+    "GLOBAL_MAX_IN_FLIGHT": 64,
+    "USER_RATE": 0.5,
+    "USER_BURST": 5,
+    "USER_MAX_IN_FLIGHT": 2,
+    "QUEUE_SIZE": 32,
+    "USER_QUEUE_SIZE": 2,
+    "QUEUE_TIMEOUT": 15,
+}
+
+# Resilience of LLM calls per call site (see main.resilience). Sites missing here use "default".
+# BREAKER opens after MIN_CALLS within WINDOW_SECONDS when the ERROR_RATE or the LATENCY_PERCENTILE
+# of the latency (to the first token for streams) reaches LATENCY_THRESHOLD seconds. Calls then fail
+# fast for OPEN_SECONDS, after which one trial call decides whether it closes. With HEDGE_AFTER set,
+# a slow or failed request is hedged with a second one to FALLBACK_MODEL. Calls slower than
+# TARGET_LATENCY lower the adaptive load shedding limit (see LOAD_SHEDDING).
+GPT_FALLBACK_MODEL_ENGINE = gpt_secrets.get('GPT_FALLBACK_MODEL_ENGINE')
+LLM_CALL_SITES = {
+    "default": {
+        "BREAKER": {
+            "WINDOW_SECONDS": 60,
+            "MIN_CALLS": 10,
+            "ERROR_RATE": 0.5,
+            "LATENCY_PERCENTILE": 95,
+            "LATENCY_THRESHOLD": 60,
+            "OPEN_SECONDS": 30,
+        },
+        "HEDGE_AFTER": None,
+        "FALLBACK_MODEL": None,
+        "TARGET_LATENCY": None,
+    },
+    "chat": {
+        "BREAKER": {
+            "WINDOW_SECONDS": 60,
+            "MIN_CALLS": 10,
+            "ERROR_RATE": 0.5,
+            "LATENCY_PERCENTILE": 95,
+            "LATENCY_THRESHOLD": 15,
+            "OPEN_SECONDS": 30,
+        },
+        "HEDGE_AFTER": 5,
+        "FALLBACK_MODEL": GPT_FALLBACK_MODEL_ENGINE,
+        "TARGET_LATENCY": 3,
+    },
+    "interview": {
+        "HEDGE_AFTER": 5,
+        "FALLBACK_MODEL": GPT_FALLBACK_MODEL_ENGINE,
+        "TARGET_LATENCY": 3,
+    },
+}
+
+# Model routing (see main.routing). A call uses the MODEL of the first rule matching its call site
+# (CALL_SITES), agent type (AGENT_TYPES) and prompt size (MAX_PROMPT_TOKENS), keys missing from a rule
+# match anything. Rules without a MODEL are skipped, calls matching no rule use GPT_MODEL_ENGINE.
+# Text agents with a `model` set use it for their answers. LLM_MODEL_COSTS are the prices in USD per
+# 1M input and output tokens, used to estimate the cost saved by routing.
+GPT_SMALL_MODEL_ENGINE = gpt_secrets.get('GPT_SMALL_MODEL_ENGINE')
+LLM_ROUTES = [
+    {"CALL_SITES": ["title", "summary"], "MODEL": GPT_SMALL_MODEL_ENGINE},
+    # short chat turns, e.g. the first message of a chat or a follow-up in a short conversation
+    {"CALL_SITES": ["chat"], "AGENT_TYPES": ["text"], "MAX_PROMPT_TOKENS": 500, "MODEL": GPT_SMALL_MODEL_ENGINE},
+]
+LLM_MODEL_COSTS = {
+    "gpt-4o": (2.5, 10),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4-turbo": (10, 30),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+# Adaptive load shedding (see main.shedding). LLM calls in flight or queued are capped at a limit
+# between MIN_LIMIT and MAX_LIMIT. Calls within the TARGET_LATENCY of their call site raise it by
+# about INCREASE per round of calls, slower or failed calls multiply it by BACKOFF (at most every
+# COOLDOWN seconds). New streams over the limit get the "high demand" message, images and
+# evaluations 503 with Retry-After: RETRY_AFTER.
+LOAD_SHEDDING = {
+    "INITIAL_LIMIT": 96,
+    "MIN_LIMIT": 4,
+    "MAX_LIMIT": 96,
+    "INCREASE": 1,
+    "BACKOFF": 0.75,
+    "COOLDOWN": 5,
+    "RETRY_AFTER": 30,
+}
+
+# Offline batch jobs (see main.batch), submitted and collected by the `run_batch_jobs` command.
+# At most MAX_BATCH_SIZE pending jobs are submitted per run, `--wait` polls every POLL_INTERVAL seconds.
+# Jobs left "submitting" for SUBMIT_TIMEOUT seconds (by a run that died) are submitted again.
+BATCH_JOBS = {
+    "MAX_BATCH_SIZE": 1000,
+    "POLL_INTERVAL": 60,
+    "SUBMIT_TIMEOUT": 30 * 60,
+}
+
+# Server-sent events: tokens are coalesced into one frame per time or size window.
+# Set both to 0 to send every token in its own frame.
+SSE_COALESCE_MS = 30
+SSE_COALESCE_BYTES = 64
+
+# Chat history sent to the model is limited to this many tokens. Older turns are dropped until
+# the kept turns take CONTEXT_SUMMARY_TARGET of the budget, and folded into a rolling summary
+# in the background after the answer (used from the next request on).
+CONTEXT_TOKEN_BUDGET = 6000
+CONTEXT_SUMMARY_TARGET = 0.5
+
+# Cache for deterministic completions requested with `generate_chat_completion(..., cache=True)`.
+# Backends: main.completion_cache.LocMemCacheBackend / FileCacheBackend / DjangoCacheBackend
+COMPLETION_CACHE = {
+    "BACKEND": "main.completion_cache.LocMemCacheBackend",
+    "TTL": 60 * 60,
+    "OPTIONS": {
+        "max_entries": 1024,
+    },
+}
+
+# Threads for work that runs alongside the streams (e.g. chat titles)
+BACKGROUND_WORKERS = 8
+# How long a finished stream waits for its side events (e.g. the title) before sending Stop
+SSE_SIDE_EVENT_TIMEOUT = 10
+
+# Resumable streams: the partial answer is persisted every STREAM_CHECKPOINT_INTERVAL seconds,
+# finished generations stay available for reconnects (Last-Event-ID) for STREAM_RESUME_TTL seconds,
+# and a stream resumed under ASGI stops polling a checkpoint that did not change for STREAM_RESUME_STALE
+# seconds (under WSGI it sends what is persisted and has the client reconnect for the rest).
+# A running generation whose process did not report for STREAM_RESUME_STALE seconds is considered gone.
+STREAM_CHECKPOINT_INTERVAL = 2
+STREAM_RESUME_TTL = 60
+STREAM_RESUME_STALE = 30
+# Idle streams get a heartbeat comment every SSE_HEARTBEAT_INTERVAL seconds. Once all clients of a
+# generation are gone for STREAM_DISCONNECT_GRACE seconds, the upstream completion is closed.
+SSE_HEARTBEAT_INTERVAL = 15
+STREAM_DISCONNECT_GRACE = 5
+# Cache (an alias of CACHES) in which running generations are marked, see main.stream_registry. It must be
+# shared by the workers, e.g. Redis, for a reconnect served by another worker to know whether the answer is
+# still being generated; the default local-memory cache only covers the worker itself.
+STREAM_REGISTRY_CACHE = "default"
+
+# Bearer token of the metrics scraper: /metrics/ requires `Authorization: Bearer <METRICS_TOKEN>`,
+# and is not served at all (404) when no token is configured.
+METRICS_TOKEN = general_ai_tools.get("METRICS_TOKEN")
+
 # Gcloud project infos
 GCP_PROJECT_ID = gcp_infos.get("GCP_PROJECT_ID")
 GCP_LOCATION = gcp_infos.get("GCP_LOCATION")
@@ -32,6 +212,12 @@ PROD_QUEUE_GENERATE_VIDEO_TASK = prod_generate_tasks.get("PROD_QUEUE_GENERATE_VI
 PROD_QUEUE_GENERATE_DUMMY_IMAGE_TASK = prod_generate_tasks.get("PROD_QUEUE_GENERATE_DUMMY_IMAGE_TASK")
 PROD_QUEUE_GENERATE_DUMMY_VIDEO_TASK = prod_generate_tasks.get("PROD_QUEUE_GENERATE_DUMMY_IMAGE_TASK")
 
+# Deadlines (see main.deadline): API requests must be done within REQUEST_DEADLINE seconds, Cloud Tasks
+# (on the cloud_tasks/ handlers) within CLOUD_TASK_DEADLINE, which is also their dispatch deadline. Downstream calls only get the time
+# that is left (and at most REQUESTS_TIMEOUT for the services below and the users service).
+REQUEST_DEADLINE = 120
+CLOUD_TASK_DEADLINE = 30 * 60
+
 # Infos for image, video generating 
 REQUESTS_TIMEOUT = 10
 SYNCLAB_KEY = general_ai_tools.get("SYNCLAB_KEY")
@@ -9,6 +9,7 @@ from drf_spectacular import views as SchemaViews
 from main.views import (
     AiViewSet,
     AgentViewSet,
+    metrics_view,
 )
 from chat.views import (
     ChatViewSet,
@@ -51,6 +52,8 @@ urlpatterns = [
     path('schema/redoc/',
          SchemaViews.SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
 
+    path('metrics/', metrics_view, name='metrics'),
+
     path('cloud_tasks/generate-image/', generate_image_task_view, name='google_task_generate_image'),
     path('cloud_tasks/generate-video/', generate_video_task_view, name='google_task_generate_video'),
     path('cloud_tasks/dummy-generate-image/', dummy_generate_image_task_view, name='google_task_dummy_generate_image'),
@@ -36,4 +36,13 @@ class MessageObjectStatuses(models.TextChoices):
     AUDIO_READY = 'audio_ready', _('Audio Ready')
     VIDEO_READY = 'video_ready', _('Video Ready')
     IMAGE_READY = 'image_ready', _('Image Ready')
-    AWAITING = 'awaiting', _('Awaiting')
\ No newline at end of file
+    AWAITING = 'awaiting', _('Awaiting')
+    CANCELLED = 'cancelled', _('Cancelled')
+
+
+class EditorOperations(models.TextChoices):
+    INSERT = 'insert', _('Insert')
+    UPDATE = 'update', _('Update fields')
+    MOVE = 'move', _('Move')
+    DELETE = 'delete', _('Delete')
+    TOGGLE = 'toggle', _('Toggle checked')
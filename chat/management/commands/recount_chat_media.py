@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Chat
+
+
+class Command(BaseCommand):
+    help = "Recomputes the media counters of chats (videos, images, audios) from their editor objects."
+
+    def add_arguments(self, parser):
+        parser.add_argument("chat_ids", nargs="*", type=int, help="Chats to recount, all chats by default.")
+
+    def handle(self, *args, **options):
+        queryset = Chat.objects.filter(pk__in=options["chat_ids"]) if options["chat_ids"] else None
+        updated = Chat.recount_media(queryset)
+        self.stdout.write(f"Recounted the media of {updated} chats.")
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_chat_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='context_summary',
+            field=models.TextField(blank=True, default='', verbose_name='Context summary'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='context_summary_until',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Context summarized until message ID'),
+        ),
+    ]
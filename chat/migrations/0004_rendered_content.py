@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_context_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='rendered_content',
+            field=models.TextField(blank=True, editable=False, null=True, verbose_name='Rendered prompt content'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='rendered_template',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='Rendered with template'),
+        ),
+    ]
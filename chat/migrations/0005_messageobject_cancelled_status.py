@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_rendered_content'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messageobject',
+            name='status',
+            field=models.CharField(choices=[('initial', 'Initial'), ('accepted', 'Accepted'), ('error', 'Error'), ('retry', 'Retry'), ('audio_ready', 'Audio Ready'), ('video_ready', 'Video Ready'), ('image_ready', 'Image Ready'), ('awaiting', 'Awaiting'), ('cancelled', 'Cancelled')], default='initial', max_length=20, verbose_name='Status'),
+        ),
+    ]
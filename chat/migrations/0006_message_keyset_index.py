@@ -0,0 +1,17 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_messageobject_cancelled_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'date_created', 'id'], name='message--chat-created-index'),
+        ),
+    ]
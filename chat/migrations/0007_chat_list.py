@@ -0,0 +1,45 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:54
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def fill_message_stats(apps, schema_editor):
+    """Sets the message count and last text preview of the existing chats in a single UPDATE."""
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    MessageObject = apps.get_model('chat', 'MessageObject')
+    count = Message.objects.filter(chat=OuterRef('pk')).order_by().values('chat')\
+        .annotate(count=Count('pk')).values('count')
+    text = MessageObject.objects.filter(message__chat=OuterRef('pk'), content_type='text')\
+        .exclude(content="").order_by('-message__date_created', '-message_id', '-pk').values('content')[:1]
+    Chat.objects.update(
+        message_count=Coalesce(Subquery(count), 0),
+        last_message_preview=Coalesce(Substr(Subquery(text), 1, 150), Value("")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', editable=False, max_length=150, verbose_name='Last message preview'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Message count'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user_id', 'date_updated', 'id'], name='chat--user-updated-index'),
+        ),
+        migrations.RunPython(fill_message_stats, migrations.RunPython.noop),
+    ]
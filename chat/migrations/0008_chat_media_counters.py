@@ -0,0 +1,43 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:57
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_media_counters(apps, schema_editor):
+    """Counts the media objects of the existing chats in a single UPDATE."""
+    Chat = apps.get_model('chat', 'Chat')
+    EditorObject = apps.get_model('chat', 'EditorObject')
+    fields = {}
+    for content_type, field in (('video', 'videos'), ('image', 'images'), ('audio', 'audios')):
+        count = EditorObject.objects.filter(chat=OuterRef('pk'), content_type=content_type)\
+            .order_by().values('chat').annotate(count=Count('pk')).values('count')
+        fields[field] = Coalesce(Subquery(count), 0)
+    Chat.objects.update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chat_list'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='audios',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Audios'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='images',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Images'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='videos',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Videos'),
+        ),
+        migrations.RunPython(fill_media_counters, migrations.RunPython.noop),
+    ]
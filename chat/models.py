@@ -1,4 +1,8 @@
+from typing import Mapping, Optional
+
 from django.db import models
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from rest_framework.fields import MinValueValidator
 from main.models import Agent
@@ -10,12 +14,40 @@ from .choices import (
 )
 
 
+PREVIEW_LENGTH = 150
+
+
+# Editor object types counted on the chat, by counter field
+MEDIA_COUNTERS = {
+    EditorObjectTypes.VIDEO: "videos",
+    EditorObjectTypes.IMAGE: "images",
+    EditorObjectTypes.AUDIO: "audios",
+}
+
+
+def preview(text: str) -> str:
+    """Single-line start of `text` for the chat list."""
+    return " ".join(text.split())[:PREVIEW_LENGTH]
+
+
 class Chat(models.Model):
     user_id = models.CharField(max_length=255, verbose_name=_("User ID"), editable=False)
     user_email = models.CharField(max_length=255, verbose_name=_("User email"))
     title = models.CharField(_("Title"), max_length=100, default="", blank=True)
     date_updated = models.DateTimeField(_("Date updated"), auto_now_add=True)
     type = models.CharField(_("Type"), max_length=10, choices=ChatType.choices, default=ChatType.CHAT)
+    context_summary = models.TextField(_("Context summary"), blank=True, default="")
+    context_summary_until = models.BigIntegerField(_("Context summarized until message ID"), null=True, blank=True)
+    # Denormalized for the chat list, maintained when messages are written
+    last_message_preview = models.CharField(
+        _("Last message preview"), max_length=PREVIEW_LENGTH, blank=True, default="", editable=False)
+    message_count = models.PositiveIntegerField(_("Message count"), default=0, editable=False)
+    # Denormalized media counts of the editor objects, maintained when objects are written
+    videos = models.PositiveIntegerField(_("Videos"), default=0, editable=False)
+    images = models.PositiveIntegerField(_("Images"), default=0, editable=False)
+    audios = models.PositiveIntegerField(_("Audios"), default=0, editable=False)
+    # Version of the editor document (the objs), incremented by every change of the objects
+    version = models.PositiveIntegerField(_("Version"), default=0, editable=False)
     # objs
     # messages
 
@@ -24,6 +56,57 @@ class Chat(models.Model):
 
     class Meta:
         ordering = ['-date_updated']
+        indexes = [
+            # keyset pagination of the chat list (see `ChatViewSet.list`)
+            models.Index(fields=["user_id", "date_updated", "id"], name="chat--user-updated-index"),
+        ]
+
+    @classmethod
+    def message_added(cls, chat_id, text: Optional[str] = None) -> None:
+        """Counts a new message of the chat and moves the chat up. `text` becomes the preview."""
+        fields = {"message_count": models.F("message_count") + 1, "date_updated": timezone.now()}
+        if text:
+            fields["last_message_preview"] = preview(text)
+        cls.objects.filter(pk=chat_id).update(**fields)
+
+    @classmethod
+    def set_preview(cls, chat_id, text: str) -> None:
+        """Sets the preview to the text of the last message, e.g. once an answer is generated."""
+        cls.objects.filter(pk=chat_id).update(last_message_preview=preview(text))
+
+    @classmethod
+    def objs_changed(cls, chat_id, counts: Mapping[str, int], version: Optional[int] = None) -> bool:
+        """
+            Increments the document version, moves the chat up and adds the changes of the editor object counts per content
+            type (e.g. `{"video": -1}`) to the media counters, which never go below 0 (`recount_chat_media`
+            fixes counters that drifted). With `version`, only if it is still the current version:
+            returns False otherwise. Call it in the transaction of the changes, before them, the row stays
+            locked until the end of it.
+        """
+        fields = {MEDIA_COUNTERS[content_type]: Greatest(models.F(MEDIA_COUNTERS[content_type]) + n, 0)
+                  for content_type, n in counts.items() if n and content_type in MEDIA_COUNTERS}
+        queryset = cls.objects.filter(pk=chat_id)
+        if version is not None:
+            queryset = queryset.filter(version=version)
+        return bool(queryset.update(version=models.F("version") + 1, date_updated=timezone.now(), **fields))
+
+    @classmethod
+    def recount_media(cls, queryset: Optional[models.QuerySet] = None) -> int:
+        """Recomputes the media counters of the chats of `queryset` (all by default) in a single UPDATE."""
+        fields = {}
+        for content_type, field in MEDIA_COUNTERS.items():
+            count = EditorObject.objects.filter(chat=models.OuterRef('pk'), content_type=content_type)\
+                .order_by().values('chat').annotate(count=models.Count('pk')).values('count')
+            fields[field] = Coalesce(models.Subquery(count), 0)
+        return (cls.objects.all() if queryset is None else queryset).update(**fields)
+
+    def refresh_message_stats(self) -> None:
+        """Recounts the messages and takes the preview from the last text (e.g. after deleting messages). Does not save."""
+        self.message_count = self.messages.count()  # type: ignore
+        text = MessageObject.objects.filter(message__chat=self, content_type=MessageObjectTypes.TEXT)\
+            .exclude(content="").order_by('-message__date_created', '-message_id', '-pk')\
+            .values_list('content', flat=True).first()
+        self.last_message_preview = preview(text or "")
 
 
 class EditorObject(models.Model):
@@ -48,11 +131,17 @@ class Message(models.Model):
     date_created = models.DateTimeField(_("Date created"), auto_now_add=True)
     csat = models.BooleanField(_("CSAT Liked?"), null=True, blank=True, default=None)
     parameters = models.JSONField(_("Prompt parameters"), blank=True, null=True)
+    rendered_content = models.TextField(_("Rendered prompt content"), null=True, blank=True, editable=False)
+    rendered_template = models.CharField(_("Rendered with template"), max_length=50, blank=True, default="", editable=False)
     # parent = models.ForeignKey("self", models.SET_NULL, verbose_name=_("Parent message (for AI replies)"), null=True, blank=True)
     # objs
 
     class Meta:
         ordering = ['date_created']
+        indexes = [
+            # keyset pagination of the chat history (see `ChatViewSet.messages_list`)
+            models.Index(fields=["chat", "date_created", "id"], name="message--chat-created-index"),
+        ]
 
 
 class MessageObject(models.Model):
@@ -1,11 +1,20 @@
+from collections import Counter
+from typing import Iterable, Optional
+
 from django.db import transaction
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+
+from custom.custom_bulk import apply_bulk_changes
+from custom.custom_exceptions import Conflict
 from main.models import Agent
+from chat.choices import EditorOperations
 from chat.models import (
     EditorObject, 
     MessageObject, 
     Chat,
     Message,
+    MEDIA_COUNTERS,
 )
 
 class EditorObjectForChatSerializer(serializers.ModelSerializer):
@@ -22,26 +31,52 @@ class EditorObjectForChatSerializer(serializers.ModelSerializer):
 
 class ChatDetailSerializer(serializers.ModelSerializer):
     objs = EditorObjectForChatSerializer(many=True, read_only=True)
-    videos = serializers.IntegerField()
-    images = serializers.IntegerField()
 
     class Meta:
         model = Chat
-        fields = '__all__'
+        exclude = ['context_summary', 'context_summary_until']
+
+
+def count_changes(existing: Iterable[EditorObject], to_create: list[EditorObject], to_update: list[dict],
+                  to_delete: list[int]) -> Counter:
+    """Changes of the object counts per content type, from the `existing` objects of the chat that are changed."""
+    types = {obj.pk: obj.content_type for obj in existing}
+    counts: Counter = Counter(obj.content_type for obj in to_create)
+    for pk in set(to_delete) & types.keys():
+        counts[types.pop(pk)] -= 1
+    for obj_data in to_update:
+        content_type = types.get(obj_data["id"])
+        if content_type and obj_data.get("content_type", content_type) != content_type:
+            counts[content_type] -= 1
+            counts[obj_data["content_type"]] += 1
+    return counts
+
+
+def check_version(chat: Chat, counts: Counter, version: Optional[int]) -> None:
+    """Moves the document of `chat` to the next version, raises `Conflict` if it is not at `version` anymore."""
+    if not Chat.objs_changed(chat.pk, counts, version):
+        raise Conflict({
+            "detail": "The document was changed in the meantime, reload it.",
+            "version": Chat.objects.values_list('version', flat=True).get(pk=chat.pk),
+        })
+    chat.refresh_from_db(fields=['version', *MEDIA_COUNTERS.values()])
 
 
 class ChatUpdateSerializer(serializers.ModelSerializer):
     objs = EditorObjectForChatSerializer(many=True, required=False)
+    version = serializers.IntegerField(
+        min_value=0, required=False, help_text="Version of the edited document, 409 if it changed since.")
 
     class Meta:
         model = Chat
-        exclude = ['project']
+        exclude = ['context_summary', 'context_summary_until']
         extra_kwargs = {
             'id': {'read_only': True}
         }
 
     def update(self, instance, validated_data: dict):
         objs_data: list[dict] = validated_data.pop('objs', [])
+        version: Optional[int] = validated_data.pop('version', None)
         updated = False
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
@@ -60,23 +95,100 @@ class ChatUpdateSerializer(serializers.ModelSerializer):
             else:
                 obj.chat = instance
                 to_create.append(obj)
+        existing = list(instance.objs.all())  # prefetched
         with transaction.atomic():
+            if objs_data or version is not None:
+                check_version(instance, count_changes(existing, to_create, to_update, to_delete), version)
             if updated:
-                instance.save()
-            if to_create:
-                instance.objs.bulk_create(to_create)
-            if to_update:
-                # instance.objs.bulk_update(to_update, )
-                for obj_data in to_update:
-                    EditorObject.objects.filter(
-                        pk=obj_data.pop("id"),
-                        chat=instance
-                    ).update(**obj_data)
-            if to_delete:
-                EditorObject.objects.filter(
-                    pk__in=to_delete,
-                    chat=instance
-                ).delete()
+                # the message counters are maintained concurrently, only the given fields are written
+                instance.save(update_fields=list(validated_data))
+            # set-based: a constant number of statements however many objects the document has
+            self.objs_changes = apply_bulk_changes(instance.objs, existing, to_create, to_update, to_delete)
+        return instance
+
+
+class EditorObjectValuesSerializer(serializers.ModelSerializer):
+    """Fields of an editor object set by an operation, all optional."""
+    file = serializers.URLField(required=False)
+
+    class Meta:
+        model = EditorObject
+        exclude = ['id', 'chat']
+        extra_kwargs = {
+            'content_type': {'required': False},
+        }
+
+
+class EditorOperationSerializer(serializers.Serializer):
+    """
+        One operation on the objects of the document:
+        `insert` (`values`), `update` (`id`, `values`), `move` (`id`, `order`), `delete` (`id`), `toggle` (`id`).
+    """
+    op = serializers.ChoiceField(choices=EditorOperations.choices)
+    id = serializers.IntegerField(required=False)
+    values = EditorObjectValuesSerializer(required=False)
+    order = serializers.IntegerField(min_value=1, required=False)
+
+    REQUIRED = {
+        EditorOperations.INSERT: ['values'],
+        EditorOperations.UPDATE: ['id', 'values'],
+        EditorOperations.MOVE: ['id', 'order'],
+        EditorOperations.DELETE: ['id'],
+        EditorOperations.TOGGLE: ['id'],
+    }
+
+    def validate(self, attrs):
+        missing = [field for field in self.REQUIRED[attrs['op']] if field not in attrs]
+        if missing:
+            raise serializers.ValidationError({field: f"Required by `{attrs['op']}`." for field in missing})
+        if attrs['op'] == EditorOperations.INSERT and 'content_type' not in attrs['values']:
+            raise serializers.ValidationError({'values': "`content_type` is required by `insert`."})
+        return attrs
+
+
+class EditorOperationsSerializer(serializers.Serializer):
+    """
+        Delta sync of the editor document of a chat: the operations are applied in order, on top of
+        `version`, and cost a write of the objects they change (see `custom.custom_bulk`). Objects
+        inserted in a request can be referenced by their `id` from the next one.
+    """
+    version = serializers.IntegerField(min_value=0)
+    operations = EditorOperationSerializer(many=True, allow_empty=False, write_only=True)
+    objs = EditorObjectForChatSerializer(many=True, read_only=True, help_text="The inserted objects.")
+
+    def update(self, instance: Chat, validated_data: dict):
+        operations: list[dict] = validated_data['operations']
+        ids = {operation['id'] for operation in operations if 'id' in operation}
+        existing = {obj.pk: obj for obj in instance.objs.filter(pk__in=ids)}  # type: ignore
+        missing = ids - existing.keys()
+        if missing:
+            raise NotFound(f"Objects not found: {sorted(missing)}")
+        to_create: list[EditorObject] = []
+        values: dict[int, dict] = {}
+        deleted: set[int] = set()
+        for operation in operations:
+            op, pk = operation['op'], operation.get('id')
+            if pk in deleted:
+                raise serializers.ValidationError({'operations': f"Object {pk} is deleted by an earlier operation."})
+            if op == EditorOperations.INSERT:
+                to_create.append(EditorObject(chat=instance, **operation['values']))
+            elif op == EditorOperations.UPDATE:
+                values.setdefault(pk, {}).update(operation['values'])
+            elif op == EditorOperations.MOVE:
+                values.setdefault(pk, {})['order'] = operation['order']
+            elif op == EditorOperations.TOGGLE:
+                obj_values = values.setdefault(pk, {})
+                obj_values['is_checked'] = not obj_values.get('is_checked', existing[pk].is_checked)
+            elif op == EditorOperations.DELETE:
+                values.pop(pk, None)
+                deleted.add(pk)
+        to_update = [{"id": pk, **obj_values} for pk, obj_values in values.items()]
+        to_delete = list(deleted)
+        with transaction.atomic():
+            check_version(instance, count_changes(existing.values(), to_create, to_update, to_delete),
+                          validated_data['version'])
+            self.objs_changes = apply_bulk_changes(instance.objs, existing.values(), to_create, to_update, to_delete)
+        self.created = to_create
         return instance
 
 
@@ -98,21 +210,29 @@ class MessageListSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        exclude = ['task']
+        exclude = ['chat', 'rendered_content', 'rendered_template']
 
 
 class ChatMessagesSerializer(serializers.ModelSerializer):
     messages = MessageListSerializer(many=True, read_only=True)
+    previous = serializers.URLField(read_only=True, allow_null=True)
+    next = serializers.URLField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = Chat
+        fields = ['id', 'messages', 'previous', 'next']
+
 
+class ChatListSerializer(serializers.ModelSerializer):
     class Meta:
         model = Chat
-        fields = ['id', 'messages']
+        fields = ['id', 'title', 'type', 'date_updated', 'last_message_preview', 'message_count']
 
 
 class ChatShortSerializer(serializers.ModelSerializer):
     class Meta:
         model = Chat
-        fields = '__all__'
+        exclude = ['context_summary', 'context_summary_until']
 
 
 class ChatPreviewSerializer(serializers.ModelSerializer):
@@ -142,7 +262,7 @@ class MessageCreateSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        exclude = ['task']
+        exclude = ['chat', 'rendered_content', 'rendered_template']
         extra_kwargs = {
             'id': {'read_only': True},
             'is_answer': {'read_only': True}
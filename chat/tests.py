@@ -1,3 +1,243 @@
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 
-# Create your tests here.
+from custom.custom_exceptions import Conflict
+from custom.custom_paginators import KeysetPagination
+from main.api import StreamAgentAPI
+from main.models import Agent
+from chat.models import PREVIEW_LENGTH, Chat, EditorObject, EditorObjectTypes, Message, MessageObjectTypes
+from chat.serializers import ChatUpdateSerializer, EditorOperationsSerializer
+from chat.views import ChatListPagination
+
+
+class MessageKeysetPaginationTestCase(TestCase):
+    """The chat history is paged on (date_created, id), including messages created at the same time."""
+
+    def setUp(self):
+        agent = Agent.objects.create()
+        chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+        messages = [chat.messages.create(agent=agent) for _ in range(7)]
+        # messages 2-4 share their creation time, their order is decided by id
+        Message.objects.filter(pk__in=[m.pk for m in messages[2:5]]).update(date_created=messages[2].date_created)
+        self.ids = [m.pk for m in messages]
+        self.queryset = Message.objects.filter(chat=chat)
+
+    def paginate(self, url):
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(self.queryset, Request(APIRequestFactory().get(url)))
+        return [m.pk for m in page], paginator.get_previous_link(), paginator.get_next_link()
+
+    def test_walk_both_directions(self):
+        page, previous, next_ = self.paginate("/messages/?limit=3")
+        self.assertEqual(page, self.ids[4:])
+        self.assertIsNone(next_)
+        page, previous, next_ = self.paginate(previous)
+        self.assertEqual(page, self.ids[1:4])
+        page, previous, next_ = self.paginate(previous)
+        self.assertEqual(page, self.ids[:1])
+        self.assertIsNone(previous)
+        page, _, next_ = self.paginate(next_)
+        self.assertEqual(page, self.ids[1:4])
+        page, _, next_ = self.paginate(next_)
+        self.assertEqual(page, self.ids[4:])
+        self.assertIsNone(next_)
+
+
+class ChatListPaginationTestCase(TestCase):
+    """The chat list is paged newest first on (date_updated, id), including chats updated at the same time."""
+
+    def setUp(self):
+        chats = [Chat.objects.create(user_id="1", user_email="user@example.com") for _ in range(7)]
+        # chats 2-4 share their update time, their order is decided by id
+        Chat.objects.filter(pk__in=[c.pk for c in chats[2:5]]).update(date_updated=chats[2].date_updated)
+        Chat.objects.create(user_id="2", user_email="other@example.com")
+        self.ids = [c.pk for c in chats][::-1]
+        self.queryset = Chat.objects.filter(user_id="1")
+
+    def paginate(self, url):
+        paginator = ChatListPagination()
+        page = paginator.paginate_queryset(self.queryset, Request(APIRequestFactory().get(url)))
+        return [c.pk for c in page], paginator.get_previous_link(), paginator.get_next_link()
+
+    def test_walk_both_directions(self):
+        page, previous, next_ = self.paginate("/chats/?limit=3")
+        self.assertEqual(page, self.ids[:3])
+        self.assertIsNone(previous)
+        page, previous, next_ = self.paginate(next_)
+        self.assertEqual(page, self.ids[3:6])
+        page, previous, next_ = self.paginate(next_)
+        self.assertEqual(page, self.ids[6:])
+        self.assertIsNone(next_)
+        page, previous, _ = self.paginate(previous)
+        self.assertEqual(page, self.ids[3:6])
+        page, previous, _ = self.paginate(previous)
+        self.assertEqual(page, self.ids[:3])
+        self.assertIsNone(previous)
+
+    def test_updated_chat_moves_up(self):
+        Chat.message_added(self.ids[-1], "Hi")
+        page, _, _ = self.paginate("/chats/?limit=3")
+        self.assertEqual(page, [self.ids[-1]] + self.ids[:2])
+
+
+class ChatPreviewTestCase(TestCase):
+    """The preview and message count of the chat list are maintained when messages are written."""
+
+    def setUp(self):
+        self.agent = Agent.objects.create()
+        self.chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+
+    def add_message(self, text, is_answer=False):
+        message = self.chat.messages.create(agent=self.agent, is_answer=is_answer)
+        message.objs.create(content_type=MessageObjectTypes.TEXT, content=text)
+        Chat.message_added(self.chat.pk, None if is_answer else text)
+        return message
+
+    def test_message_added(self):
+        updated = self.chat.date_updated
+        self.add_message("  How do I\n  start? ")
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.last_message_preview, self.chat.message_count), ("How do I start?", 1))
+        self.assertGreater(self.chat.date_updated, updated)
+        # the answer is not generated yet, the preview stays
+        Chat.message_added(self.chat.pk)
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.last_message_preview, self.chat.message_count), ("How do I start?", 2))
+        Chat.message_added(self.chat.pk, "x" * (PREVIEW_LENGTH + 10))
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_preview, "x" * PREVIEW_LENGTH)
+
+    def test_answer_sets_preview(self):
+        self.add_message("How do I start?")
+        answer = self.chat.messages.create(agent=self.agent, is_answer=True)
+        Chat.message_added(self.chat.pk)
+        api = StreamAgentAPI(answer)
+        api.post_cancel("")
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_preview, "How do I start?")
+        api.post_cancel("Start with")
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_preview, "Start with")
+        api.post_generate("Start with a plan.")
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_preview, "Start with a plan.")
+
+    def test_refresh_after_delete(self):
+        self.add_message("first")
+        self.add_message("second")
+        last = self.add_message("third")
+        # messages created at the same time are ordered by id
+        Message.objects.filter(chat=self.chat).update(date_created=timezone.now())
+        last.delete()
+        self.chat.refresh_from_db()
+        self.chat.refresh_message_stats()
+        self.assertEqual((self.chat.last_message_preview, self.chat.message_count), ("second", 2))
+        self.chat.messages.all().delete()
+        self.chat.refresh_message_stats()
+        self.assertEqual((self.chat.last_message_preview, self.chat.message_count), ("", 0))
+
+
+class ChatUpdateBulkTestCase(TestCase):
+    """Saving the editor document costs a constant number of statements and skips unchanged objects."""
+
+    def setUp(self):
+        self.chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+        EditorObject.objects.bulk_create([
+            EditorObject(chat=self.chat, content_type=EditorObjectTypes.TEXT, content=str(i), order=i + 1)
+            for i in range(20)
+        ])
+        self.objs = list(self.chat.objs.all())
+
+    def update(self, objs):
+        chat = Chat.objects.prefetch_related('objs').get(pk=self.chat.pk)
+        serializer = ChatUpdateSerializer(chat, data={"objs": objs}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return serializer.objs_changes
+
+    def obj(self, obj, **values):
+        return {"id": obj.pk, "content_type": obj.content_type, "content": obj.content, "order": obj.order,
+                "file": "https://example.com/file.png", **values}
+
+    def test_update(self):
+        self.update([self.obj(obj) for obj in self.objs])
+        objs = [self.obj(obj, content=f"edited {i}") for i, obj in enumerate(self.objs[:10])]
+        objs += [self.obj(obj, is_checked=True) for obj in self.objs[10:15]]
+        objs += [self.obj(obj) for obj in self.objs[15:19]]
+        objs += [self.obj(self.objs[19], delete=True), {"content_type": EditorObjectTypes.TEXT, "file": "https://example.com/new.png"}]
+        chat = Chat.objects.prefetch_related('objs').get(pk=self.chat.pk)
+        serializer = ChatUpdateSerializer(chat, data={"objs": objs}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        # savepoint and release, version and refresh, one insert, one update per changed field set, one delete
+        with self.assertNumQueries(2 + 2 + 1 + 2 + 1):
+            serializer.save()
+        changes = serializer.objs_changes
+        self.assertEqual((changes.created, changes.deleted, changes.unchanged), (1, 1, 4))
+        self.assertEqual(changes.updated, {frozenset({"content"}): 10, frozenset({"is_checked"}): 5})
+        self.assertEqual(EditorObject.objects.get(pk=self.objs[3].pk).content, "edited 3")
+        self.assertTrue(EditorObject.objects.get(pk=self.objs[12].pk).is_checked)
+        self.assertFalse(EditorObject.objects.filter(pk=self.objs[19].pk).exists())
+
+    def test_media_counters(self):
+        self.update([
+            self.obj(self.objs[0], content_type=EditorObjectTypes.VIDEO),
+            self.obj(self.objs[1], delete=True),
+            {"content_type": EditorObjectTypes.IMAGE, "file": "https://example.com/1.png"},
+            {"content_type": EditorObjectTypes.IMAGE, "file": "https://example.com/2.png"},
+        ])
+        self.update([self.obj(self.chat.objs.filter(content_type=EditorObjectTypes.IMAGE).first(), delete=True)])
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.videos, self.chat.images, self.chat.audios), (1, 1, 0))
+        Chat.objects.filter(pk=self.chat.pk).update(videos=5, images=0)
+        Chat.recount_media()
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.videos, self.chat.images, self.chat.audios), (1, 1, 0))
+
+
+class EditorOperationsTestCase(TestCase):
+    """Operations on the editor document write only what they change, on top of the current version."""
+
+    def setUp(self):
+        self.chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+        EditorObject.objects.bulk_create([
+            EditorObject(chat=self.chat, content_type=EditorObjectTypes.CHECKBOX, content=str(i), order=i + 1)
+            for i in range(50)
+        ])
+        self.objs = list(self.chat.objs.all())
+
+    def apply(self, version, operations):
+        chat = Chat.objects.get(pk=self.chat.pk)
+        serializer = EditorOperationsSerializer(chat, data={"version": version, "operations": operations})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return chat.version
+
+    def test_operations(self):
+        first, second, third = self.objs[:3]
+        # chat, objects, savepoint and release, version and refresh, one update per changed field set, delete
+        with self.assertNumQueries(1 + 1 + 2 + 2 + 2 + 1):
+            version = self.apply(0, [
+                {"op": "update", "id": first.pk, "values": {"content": "edited"}},
+                {"op": "toggle", "id": first.pk},
+                {"op": "move", "id": second.pk, "order": 7},
+                {"op": "toggle", "id": second.pk},
+                {"op": "toggle", "id": second.pk},
+                {"op": "delete", "id": third.pk},
+            ])
+        self.assertEqual(version, 1)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.content, first.is_checked), ("edited", True))
+        self.assertEqual((second.order, second.is_checked), (7, False))
+        self.assertFalse(EditorObject.objects.filter(pk=third.pk).exists())
+        version = self.apply(version, [{"op": "insert", "values": {"content_type": EditorObjectTypes.VIDEO}}])
+        self.assertEqual(version, 2)
+        self.assertEqual(Chat.objects.get(pk=self.chat.pk).videos, 1)
+
+    def test_conflict(self):
+        self.apply(0, [{"op": "toggle", "id": self.objs[0].pk}])
+        with self.assertRaises(Conflict):
+            self.apply(0, [{"op": "toggle", "id": self.objs[1].pk}])
+        self.assertFalse(EditorObject.objects.get(pk=self.objs[1].pk).is_checked)
@@ -1,21 +1,19 @@
 from typing import Any
 
-from django.db.models import Count, Prefetch, Q
-from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.serializers import Serializer
-from main.models import AgentTypes
 from main.serializers import AgentTypeSerializer
+from custom.custom_paginators import KeysetPagination
 from custom.custom_permissions import HasUnexpiredSubscription
 from chat.models import (
     EditorObject,
-    EditorObjectTypes,
     MessageObject,
+    MessageObjectTypes,
     Chat,
     Message,
 )
@@ -25,36 +23,43 @@ from chat.serializers import (
     MessageCSATSerializer,
     ChatUpdateSerializer,
     ChatDetailSerializer,
+    EditorOperationsSerializer,
+    ChatListSerializer,
     ChatMessagesSerializer,
     EditorObjectForChatSerializer,
 )
 
 
+class ChatListPagination(KeysetPagination):
+    ordering = ("date_updated", "id")
+    newest_first = True
+    page_size = 30
+    max_page_size = 100
+
+
 class ChatViewSet(viewsets.GenericViewSet,
+                mixins.ListModelMixin,
                 mixins.CreateModelMixin,
                 mixins.UpdateModelMixin,
                 mixins.DestroyModelMixin,
                 mixins.RetrieveModelMixin):
     queryset = Chat.objects.all()
     permission_classes = [HasUnexpiredSubscription]
+    pagination_class = ChatListPagination
     request: Request
 
     def get_queryset(self):
-        queryset = super().get_queryset().filter(user_id=self.request.user['user_id'])
-        if self.action == 'retrieve':
-            return queryset.prefetch_related('objs')\
-                .annotate(videos=Count("objs", filter=Q(objs__content_type=EditorObjectTypes.VIDEO)))\
-                .annotate(images=Count("objs", filter=Q(objs__content_type=EditorObjectTypes.IMAGE)))
-        if self.action in ['update', 'partial_update']:
+        queryset = super().get_queryset().filter(user_id=self.request.user.id)
+        if self.action == 'list':
+            return queryset.only(*ChatListSerializer.Meta.fields)
+        if self.action in ['retrieve', 'update', 'partial_update']:
+            # the media counts are fields of the chat (see `Chat.objs_changed`)
             return queryset.prefetch_related('objs')
-        if self.action == 'messages_list':
-            agent_type = self.request.query_params.get("type", AgentTypes.TEXT)
-            prefetch = Prefetch("messages", Message.objects.filter(
-                agent__type=agent_type).prefetch_related("agent", "objs"))
-            return queryset.prefetch_related(prefetch)
         return queryset
 
     def get_serializer_class(self):
+        if self.action == 'list':
+            return ChatListSerializer
         if self.action in ['update', 'partial_update']:
             return ChatUpdateSerializer
         if self.action == 'retrieve':
@@ -67,8 +72,23 @@ class ChatViewSet(viewsets.GenericViewSet,
             return ChatMessagesSerializer
         if self.action == 'top_objects':
             return EditorObjectForChatSerializer
+        if self.action == 'operations':
+            return EditorOperationsSerializer
         return Serializer
 
+    @ extend_schema(parameters=[
+        OpenApiParameter("limit", int, description="Number of chats, 30 by default and at most 100."),
+        OpenApiParameter("before", str, description="Cursor of the `next` link: chats updated earlier."),
+        OpenApiParameter("after", str, description="Cursor of the `previous` link: chats updated later."),
+    ])
+    def list(self, request, *args, **kwargs):
+        """
+            Lists user's chats, most recently updated first, with the preview of their last message
+            and their message count. `next` and `previous` link to the chats updated earlier and later
+            (keyset pagination on `(date_updated, id)`).
+        """
+        return super().list(request, *args, **kwargs)
+
     def perform_update(self, serializer):
         """Update the chat and set the date_updated field before saving."""
         serializer.validated_data['date_updated'] = timezone.now()
@@ -82,8 +102,9 @@ class ChatViewSet(viewsets.GenericViewSet,
         ser.is_valid(raise_exception=True)
         # self.__update_project_last_modified(task.project_id)
         message = ser.save(chat=chat)
-        chat.date_updated = timezone.now()
-        chat.save()
+        text = next((obj.get('content') for obj in ser.validated_data.get('objs', [])
+                     if obj.get('content_type') == MessageObjectTypes.TEXT), None)
+        Chat.message_added(chat.pk, text)
         ser2 = self.get_serializer(message)
         return Response(ser2.data, status=status.HTTP_201_CREATED)
 
@@ -96,20 +117,54 @@ class ChatViewSet(viewsets.GenericViewSet,
         ser.is_valid(raise_exception=True)
         chat.messages.filter(agent__type=ser.data['type']).delete()
         chat.date_updated = timezone.now()
-        chat.save()
+        chat.context_summary = ""
+        chat.context_summary_until = None
+        chat.refresh_message_stats()
+        chat.save(update_fields=['date_updated', 'context_summary', 'context_summary_until',
+                                 'message_count', 'last_message_preview'])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-    @ extend_schema(parameters=[AgentTypeSerializer])
+    @ extend_schema(parameters=[
+        AgentTypeSerializer,
+        OpenApiParameter("limit", int, description="Number of messages, 50 by default and at most 200."),
+        OpenApiParameter("before", str, description="Cursor of the `previous` link: older messages."),
+        OpenApiParameter("after", str, description="Cursor of the `next` link: newer messages."),
+    ])
     @ messages.mapping.get
     def messages_list(self, request: Request, pk=None):
-        """List user's ProjectTask's TaskMessages with objects corresponding to it"""
+        """
+            List user's ProjectTask's TaskMessages with objects corresponding to it.
+            Returns the newest `limit` messages, oldest first. `previous` and `next` link to
+            the older and newer messages (keyset pagination on `(date_created, id)`).
+        """
         ser = AgentTypeSerializer(data=request.query_params)
         ser.is_valid(raise_exception=True)
-        qs = self.get_queryset()
-        chat = get_object_or_404(qs, pk=pk)
-        ser = self.get_serializer(chat)
+        chat = self.get_object()
+        messages = Message.objects.filter(chat=chat, agent__type=ser.data['type'])\
+            .select_related("agent").prefetch_related("objs")
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        ser = self.get_serializer({
+            "id": chat.pk,
+            "messages": page,
+            "previous": paginator.get_previous_link(),
+            "next": paginator.get_next_link(),
+        })
         return Response(ser.data)
 
+    @ action(['post'], True)
+    def operations(self, request: Request, pk=None):
+        """
+            Apply operations (insert, update, move, delete, toggle) to the EditorObjects of the chat,
+            on top of the document `version` the client has. Returns the new `version` and the inserted
+            objects, or 409 with the current `version` if the document changed in the meantime.
+        """
+        chat = self.get_object()
+        ser = self.get_serializer(chat, data=request.data)
+        ser.is_valid(raise_exception=True)
+        ser.save()
+        return Response(self.get_serializer({"version": chat.version, "objs": ser.created}).data)
+
     @ action(detail=True, pagination_class=None)
     def top_objects(self, request: Request, pk=None):
         """List user's ProjectTask's first 2 EditorObjects"""
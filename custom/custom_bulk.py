@@ -0,0 +1,68 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, FrozenSet, Iterable, List
+
+from django.db.models import Manager, Model, QuerySet
+
+
+@dataclass
+class BulkChanges:
+    """Rows touched by `apply_bulk_changes`, per operation."""
+    created: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    # rows updated per set of changed fields, each set is a single UPDATE statement
+    updated: Dict[FrozenSet[str], int] = field(default_factory=dict)
+
+    @property
+    def updated_total(self) -> int:
+        return sum(self.updated.values())
+
+
+def diff(obj: Model, values: Dict[str, Any]) -> Dict[str, Any]:
+    """The `values` that differ from the current values of `obj`."""
+    changed = {}
+    for name, value in values.items():
+        current = obj._meta.get_field(name).value_from_object(obj)
+        if current != value:
+            changed[name] = value
+    return changed
+
+
+def apply_bulk_changes(queryset: QuerySet | Manager, existing: Iterable[Model], to_create: List[Model],
+                       to_update: List[Dict[str, Any]], to_delete: List[Any]) -> BulkChanges:
+    """
+        Applies the changes of a set of rows with a constant number of statements.
+
+        `to_update` are the new values of rows by their `"id"`, diffed against the `existing` rows
+        (e.g. a prefetched relation, so no extra query): unchanged rows and ids not in `existing`
+        are skipped, the changed rows are grouped by the set of fields that changed and each
+        group is written with one `bulk_update`. `to_create` is one INSERT and `to_delete` one
+        DELETE, scoped to `queryset`. Run it inside a transaction.
+    """
+    changes = BulkChanges()
+    by_pk = {obj.pk: obj for obj in existing}
+    groups: Dict[FrozenSet[str], List[Model]] = defaultdict(list)
+    for values in to_update:
+        values = dict(values)
+        obj = by_pk.get(values.pop("id", None))
+        if obj is None:
+            continue
+        changed = diff(obj, values)
+        if not changed:
+            changes.unchanged += 1
+            continue
+        for name, value in changed.items():
+            setattr(obj, obj._meta.get_field(name).attname, value)
+        groups[frozenset(changed)].append(obj)
+    if to_create:
+        changes.created = len(queryset.bulk_create(to_create))
+    for fields, objs in groups.items():
+        queryset.bulk_update(objs, sorted(fields))
+        changes.updated[fields] = len(objs)
+    if to_delete:
+        _, deleted = queryset.filter(pk__in=to_delete).delete()
+        changes.deleted = deleted.get(queryset.model._meta.label, 0)
+    logging.debug("Bulk changes of %s: %s", queryset.model._meta.label, changes)
+    return changes
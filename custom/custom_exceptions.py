@@ -13,6 +13,35 @@ class BadRequest(APIException):
     default_code = 'bad_request'
 
 
+class Conflict(APIException):
+    status_code = 409
+    default_detail = 'Conflict with the current state of the resource'
+    default_code = 'conflict'
+
+
+class TooManyRequests(APIException):
+    status_code = 429
+    default_detail = 'Too many requests'
+    default_code = 'too_many_requests'
+
+
+class ServiceUnavailable(APIException):
+    """Sets `Retry-After` to `wait` seconds, if given."""
+    status_code = 503
+    default_detail = 'Service temporarily unavailable, try again later'
+    default_code = 'service_unavailable'
+
+    def __init__(self, detail=None, code=None, wait=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class DeadlineExceeded(APIException):
+    status_code = 504
+    default_detail = 'The request took too long'
+    default_code = 'deadline_exceeded'
+
+
 class Fraud3dsException(Exception):
     pass
 
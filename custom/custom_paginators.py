@@ -1,5 +1,15 @@
+import base64
+import json
+from typing import Any, List, Optional, Sequence
+
 from django.core import paginator
+from django.db.models import Q, QuerySet
 from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class NullPaginator(paginator.Paginator):
@@ -11,3 +21,104 @@ class NullPaginator(paginator.Paginator):
     @cached_property
     def count(self):
         return 0
+
+
+class KeysetPagination(BasePagination):
+    """
+        Keyset (seek) pagination on the unique `ordering`, e.g. `("date_created", "id")`.
+
+        Pages are selected with `WHERE (date_created, id) < cursor ORDER BY ... LIMIT n`, so with
+        an index on the ordering every page costs the same, however deep it is. Without a cursor
+        the newest `limit` rows are returned. `before` and `after` cursors walk to older and newer
+        rows. Pages are in ascending order, `previous` links to the older and `next` to the newer
+        rows (e.g. a chat history); with `newest_first` it is the other way round (e.g. a feed).
+    """
+    ordering: Sequence[str] = ("date_created", "id")
+    newest_first = False
+    page_size = 50
+    max_page_size = 200
+    limit_query_param = "limit"
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset: QuerySet, request: Request, view=None) -> List[Any]:
+        self.request = request
+        self.limit = self.get_limit(request)
+        before = self.decode_cursor(queryset, request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(queryset, request.query_params.get(self.after_query_param))
+        if after is not None:
+            rows = list(queryset.filter(self._seek(after, "gt")).order_by(*self.ordering)[:self.limit + 1])
+            self.has_newer, self.has_older = len(rows) > self.limit, True
+            page = rows[:self.limit]
+        else:
+            if before is not None:
+                queryset = queryset.filter(self._seek(before, "lt"))
+            descending = [f"-{field}" for field in self.ordering]
+            rows = list(queryset.order_by(*descending)[:self.limit + 1])
+            self.has_older, self.has_newer = len(rows) > self.limit, before is not None
+            page = rows[:self.limit][::-1]
+        self.page = page[::-1] if self.newest_first else page
+        return self.page
+
+    def get_limit(self, request: Request) -> int:
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(limit, 1), self.max_page_size)
+
+    def _seek(self, values: Sequence[Any], lookup: str) -> Q:
+        """
+            Rows after (`gt`) or before (`lt`) `values` in the ordering: (a, b) < (x, y) is a < x or (a = x and b < y).
+            The redundant a <= x bounds the index range, so the scan starts at the cursor.
+        """
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            equal = {name: value for name, value in zip(self.ordering[:i], values)}
+            condition |= Q(**equal, **{f"{field}__{lookup}": values[i]})
+        return Q(**{f"{self.ordering[0]}__{lookup}e": values[0]}) & condition
+
+    def encode_cursor(self, row: Any) -> str:
+        values = [str(getattr(row, field)) for field in self.ordering]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, queryset: QuerySet, cursor: Optional[str]) -> Optional[List[Any]]:
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            fields = [queryset.model._meta.get_field(field) for field in self.ordering]
+            if len(values) != len(fields):
+                raise ValueError(cursor)
+            return [field.to_python(value) for field, value in zip(fields, values)]
+        except Exception as e:
+            raise NotFound(self.invalid_cursor_message) from e
+
+    def _link(self, param: str, row: Any) -> str:
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, param, self.encode_cursor(row))
+
+    def _edge(self, newest: bool) -> Any:
+        return self.page[0] if newest == self.newest_first else self.page[-1]
+
+    def get_older_link(self) -> Optional[str]:
+        if not self.page or not self.has_older:
+            return None
+        return self._link(self.before_query_param, self._edge(newest=False))
+
+    def get_newer_link(self) -> Optional[str]:
+        if not self.page or not self.has_newer:
+            return None
+        return self._link(self.after_query_param, self._edge(newest=True))
+
+    def get_previous_link(self) -> Optional[str]:
+        return self.get_newer_link() if self.newest_first else self.get_older_link()
+
+    def get_next_link(self) -> Optional[str]:
+        return self.get_older_link() if self.newest_first else self.get_newer_link()
+
+    def get_paginated_response(self, data) -> Response:
+        return Response({"previous": self.get_previous_link(), "next": self.get_next_link(), "results": data})
@@ -0,0 +1,34 @@
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework.request import Request
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+        Streaming response over an async iterator.
+
+        Django 3.2 can only iterate streaming content synchronously, so the async content
+        is kept aside in `.async_streaming_content` and sent by `ai.asgi.StreamingASGIHandler`.
+    """
+    is_async = True
+
+    def __init__(self, streaming_content=(), *args, **kwargs):
+        super().__init__((), *args, **kwargs)
+        self.async_streaming_content = streaming_content
+
+    def __iter__(self):
+        raise TypeError("AsyncStreamingHttpResponse can only be served by ai.asgi.StreamingASGIHandler.")
+
+
+def is_asgi_request(request: Request) -> bool:
+    """Returns True if the request is served through ASGI, i.e. async streaming is available."""
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+def sse_response(stream) -> StreamingHttpResponse:
+    """Wraps a (sync or async) server-sent event stream into the appropriate streaming response."""
+    response_class = AsyncStreamingHttpResponse if hasattr(stream, '__aiter__') else StreamingHttpResponse
+    response = response_class(stream, content_type="text/event-stream")
+    response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
+    response['Cache-Control'] = 'no-cache'  # Ensure clients don't cache the data
+    return response
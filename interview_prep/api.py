@@ -1,9 +1,14 @@
 import json
+import logging
+from typing import List, Optional, Tuple
 
 from openai.types.chat import ChatCompletion
 
+from main import batch
+from main.models import BatchJob, BatchJobKinds
 from main.utils import generate_chat_completion
 from main.base_api import BaseGenerationAPI
+from main.context_window import Turn
 from interview_prep.models import UserInterviewMessage, UserInterviewPrep
 
 
@@ -12,9 +17,11 @@ class InterviewPrepAPI(BaseGenerationAPI):
         API for streaming text questions for an interview preparation.
         Also allows to generate AI evaluation of an interview based on the content.
     """
+    CALL_SITE = "interview"
 
-    def __init__(self, user_interview: UserInterviewPrep) -> None:
+    def __init__(self, user_interview: UserInterviewPrep, answer: Optional[UserInterviewMessage] = None) -> None:
         self.user_interview = user_interview
+        self.answer = answer
 
     # @override ( Requires Python version 3.12 )
     def get_user_prompt(self, *args, **kwargs) -> str:
@@ -27,31 +34,100 @@ class InterviewPrepAPI(BaseGenerationAPI):
         assert interview, "UserInterviewPrep is not bound to any InterviewPrep!"
         return interview.eval_sys_prompt if is_eval else interview.interview_sys_prompt
 
+    # @override ( Requires Python version 3.12 )
+    def checkpoint(self, partial_content: str) -> None:
+        """Persists the partial question as an incomplete message, so it survives a lost connection."""
+        if self.answer is None:
+            self.answer = UserInterviewMessage.objects.create(
+                user_interview=self.user_interview,
+                author_is_user=False,
+                text=partial_content,
+                is_complete=False
+            )
+        else:
+            UserInterviewMessage.objects.filter(pk=self.answer.pk).update(text=partial_content)
+
+    # @override ( Requires Python version 3.12 )
+    def load_checkpoint(self) -> Optional[Tuple[str, bool]]:
+        if self.answer is None:
+            return None
+        data = UserInterviewMessage.objects.filter(pk=self.answer.pk).values('text', 'is_complete').first()
+        if not data:
+            return None
+        return data['text'], not data['is_complete']
+
+    # @override ( Requires Python version 3.12 )
+    def post_cancel(self, partial_content: str) -> None:
+        """Keeps the partial question, as the user has seen it."""
+        self.post_generate(partial_content)
+
     # @override ( Requires Python version 3.12 )
     def post_generate(self, full_content: str) -> None:
-        UserInterviewMessage.objects.create(
-            user_interview=self.user_interview,
-            author_is_user=False,
-            text=full_content
-        )
+        if self.answer is None:
+            self.answer = UserInterviewMessage.objects.create(
+                user_interview=self.user_interview,
+                author_is_user=False,
+                text=full_content
+            )
+        else:
+            UserInterviewMessage.objects.filter(pk=self.answer.pk).update(text=full_content, is_complete=True)
 
     # @override ( Requires Python version 3.12 )
     def pre_generate(self, *args, **kwargs) -> None:
+        turns = []
         for interview_message in self.user_interview.messages.all():  # type: ignore
             content = interview_message.text
-            if content:
+            if content and interview_message.is_complete:
                 role = "user" if interview_message.author_is_user else "assistant"
-                self.append_message(content, role)
+                turns.append(Turn(interview_message.pk, role, content))
+        self.append_context(self.user_interview, turns)
 
-    def evaluate_interview(self):
+    def init_eval_messages(self) -> None:
+        """The interview to evaluate, without questions that are still generated or were cut off (see `.checkpoint`)."""
         self.init_messages(is_eval=True)
         for interview_message in self.user_interview.messages.all():  # type: ignore
             content = interview_message.text
-            if content:
+            if content and interview_message.is_complete:
                 role = "user" if interview_message.author_is_user else "assistant"
                 self.append_message(content, role)
 
-        response = generate_chat_completion(self.messages, reply_json=True)
+    def evaluate_interview(self):
+        self.init_eval_messages()
+        response = generate_chat_completion(self.messages, reply_json=True, cache=True, call_site="interview_evaluation")
         assert isinstance(response, ChatCompletion)
         data = json.loads(response.choices[0].message.content or "{}")
         return data
+
+    def enqueue_evaluation(self) -> BatchJob:
+        """Enqueues the evaluation as a batch job (see `main.batch`), it is saved by `write_evaluations`."""
+        self.init_eval_messages()
+        job = batch.make_job(BatchJobKinds.INTERVIEW_EVALUATION, self.user_interview.pk, self.messages,
+                             "interview_evaluation", reply_json=True)
+        return batch.enqueue([job])[0]
+
+
+def apply_evaluation(user_interview: UserInterviewPrep, data: dict) -> None:
+    try:
+        user_interview.ai_grade = int(data.get("ai_grade"))  # type: ignore
+    except (TypeError, ValueError):
+        # ai_grade is a number, "Error." can't be saved
+        user_interview.ai_grade = 0
+    for field in ("ai_feedback", "ai_strength", "ai_weakness"):
+        # the LLM's texts are not bounded, the columns are
+        max_length = UserInterviewPrep._meta.get_field(field).max_length
+        setattr(user_interview, field, str(data.get(field, "Error."))[:max_length])
+
+
+def write_evaluations(jobs: List[BatchJob]) -> None:
+    """Batch job writer: saves the evaluations of the interviews."""
+    evaluations = {}
+    for job in jobs:
+        try:
+            evaluations[job.target_id] = json.loads(job.result or "{}")
+        except ValueError:
+            logging.warning("Batch job %s: the evaluation is not valid JSON.", job.pk)
+    user_interviews = list(UserInterviewPrep.objects.filter(pk__in=evaluations.keys()))
+    for user_interview in user_interviews:
+        apply_evaluation(user_interview, evaluations[str(user_interview.pk)])
+    UserInterviewPrep.objects.bulk_update(
+        user_interviews, ['ai_grade', 'ai_feedback', 'ai_strength', 'ai_weakness'])
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interview_prep', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userinterviewprep',
+            name='context_summary',
+            field=models.TextField(blank=True, default='', verbose_name='Context summary'),
+        ),
+        migrations.AddField(
+            model_name='userinterviewprep',
+            name='context_summary_until',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Context summarized until message ID'),
+        ),
+    ]
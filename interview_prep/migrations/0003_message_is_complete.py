@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interview_prep', '0002_context_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userinterviewmessage',
+            name='is_complete',
+            field=models.BooleanField(blank=True, default=True, verbose_name='Is complete?'),
+        ),
+    ]
@@ -25,6 +25,8 @@ class UserInterviewPrep(models.Model):
     ai_weakness = models.CharField(_("AI weakness"), max_length=400, blank=True)
     user_grade = models.IntegerField(_("User grade"), validators=[MinValueValidator(0), MaxValueValidator(5)], default=0, blank=True)
     user_feedback = models.CharField(_("Description"), max_length=255, blank=True)
+    context_summary = models.TextField(_("Context summary"), blank=True, default="")
+    context_summary_until = models.BigIntegerField(_("Context summarized until message ID"), null=True, blank=True)
     # messages
 
 
@@ -32,6 +34,7 @@ class UserInterviewMessage(models.Model):
     user_interview = models.ForeignKey(UserInterviewPrep, verbose_name=_("User interview prep"), related_name="messages", on_delete=models.CASCADE)
     author_is_user = models.BooleanField(_("Author is user?"), default=False, blank=True)
     text = models.TextField(_("Text"), blank=True)
+    is_complete = models.BooleanField(_("Is complete?"), default=True, blank=True)
     date_created = models.DateTimeField(_("Date created"), auto_now=True)
 
     class Meta:
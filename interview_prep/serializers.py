@@ -15,6 +15,7 @@ class UserInterviewMessageSerializer(serializers.ModelSerializer):
         exclude = ['user_interview', 'date_created']
         extra_kwargs = {
             "author_is_user": {"read_only": True},
+            "is_complete": {"read_only": True},
         }
 
 
@@ -24,7 +25,7 @@ class UserInterviewPrepFullSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UserInterviewPrep
-        fields = '__all__'
+        exclude = ['context_summary', 'context_summary_until']
 
 
 class InterviewPrepCreateResponseSerializer(serializers.ModelSerializer):
@@ -52,3 +53,7 @@ class UserInterviewPrepEvalSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserInterviewPrep
         fields = ['ai_grade', 'ai_feedback', 'ai_strength', 'ai_weakness']
+
+
+class UserInterviewPrepEvalRequestSerializer(serializers.Serializer):
+    batch = serializers.BooleanField(default=False)
@@ -1,3 +1,65 @@
+import json
+
 from django.test import TestCase
 
-# Create your tests here.
+from interview_prep.api import InterviewPrepAPI, write_evaluations
+from interview_prep.models import InterviewPrep, UserInterviewPrep
+from main.models import BatchJob, BatchJobKinds
+
+
+class InterviewEvaluationTestCase(TestCase):
+    """Only complete messages are evaluated, a question that is still generated is not part of the interview yet."""
+
+    def setUp(self):
+        interview = InterviewPrep.objects.create(
+            interview_sys_prompt="Interview me.", eval_sys_prompt="Evaluate me.", initial_message="Hi")
+        self.user_interview = UserInterviewPrep.objects.create(
+            interview=interview, user_id="1", user_email="user@example.com")
+        self.user_interview.messages.create(text="first question")
+        self.user_interview.messages.create(author_is_user=True, text="first answer")
+        # checkpoint of the next question (see `InterviewPrepAPI.checkpoint`)
+        self.user_interview.messages.create(text="second que", is_complete=False)
+
+    def test_partial_question_not_evaluated(self):
+        api = InterviewPrepAPI(self.user_interview)
+        api.init_eval_messages()
+        self.assertEqual(
+            [(message["role"], message["content"]) for message in api.messages],
+            [("system", "Evaluate me."), ("assistant", "first question"), ("user", "first answer")]
+        )
+
+    def test_partial_question_not_enqueued(self):
+        job = InterviewPrepAPI(self.user_interview).enqueue_evaluation()
+        self.assertNotIn("second que", [message["content"] for message in job.request["messages"]])
+
+
+class WriteEvaluationsTestCase(TestCase):
+    def setUp(self):
+        interview = InterviewPrep.objects.create(
+            interview_sys_prompt="Interview me.", eval_sys_prompt="Evaluate me.", initial_message="Hi")
+        self.user_interviews = [
+            UserInterviewPrep.objects.create(interview=interview, user_id="1", user_email="user@example.com")
+            for _ in range(3)
+        ]
+
+    def job(self, user_interview: UserInterviewPrep, result: str) -> BatchJob:
+        return BatchJob(kind=BatchJobKinds.INTERVIEW_EVALUATION, target_id=str(user_interview.pk), result=result)
+
+    def test_write_evaluations(self):
+        evaluated, not_a_number, invalid = self.user_interviews
+        with self.assertLogs(level="WARNING"):
+            write_evaluations([
+                self.job(evaluated, json.dumps(
+                    {"ai_grade": 4, "ai_feedback": "Good", "ai_strength": "Clear", "ai_weakness": "Short"})),
+                self.job(not_a_number, json.dumps({"ai_grade": "seven", "ai_feedback": "Good"})),
+                self.job(invalid, "{not json"),
+            ])
+        evaluated.refresh_from_db()
+        self.assertEqual(
+            (evaluated.ai_grade, evaluated.ai_feedback, evaluated.ai_strength, evaluated.ai_weakness),
+            (4, "Good", "Clear", "Short"))
+        not_a_number.refresh_from_db()
+        self.assertEqual((not_a_number.ai_grade, not_a_number.ai_strength), (0, "Error."))
+        # not evaluated
+        invalid.refresh_from_db()
+        self.assertEqual((invalid.ai_grade, invalid.ai_feedback), (0, ""))
@@ -1,24 +1,30 @@
 import openai
+from django.conf import settings
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.http import StreamingHttpResponse
 from drf_spectacular.utils import extend_schema
 from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser
 from rest_framework.request import Request
 from rest_framework.response import Response
-from custom.custom_exceptions import BadRequest
+from custom.custom_exceptions import BadRequest, TooManyRequests
 from custom.custom_renderers import ServerSentEventRenderer
-from interview_prep.api import InterviewPrepAPI
+from custom.custom_responses import is_asgi_request, sse_response
+from interview_prep.api import InterviewPrepAPI, apply_evaluation
 from interview_prep.models import InterviewPrep, UserInterviewPrep
 from interview_prep.serializers import (InterviewPrepSerializer,
                                         UserInterviewMessageSerializer,
                                         UserInterviewPrepCreateSerializer,
+                                        UserInterviewPrepEvalRequestSerializer,
                                         UserInterviewPrepEvalSerializer,
                                         UserInterviewPrepFullSerializer,
                                         UserInterviewPrepPatchSerializer)
 from interview_prep.speech_to_text import generate_transcription
 from main.google_tasks import create_update_user_onboarding_task
+from main.limiter import aqueued_stream, limiter, queued_stream, user_scope
+from main.shedding import aoverloaded_stream, check_capacity, is_overloaded, overloaded_stream
+from main.sse import format_retry, parse_last_event_id
+from main.stream_registry import generations
 
 
 class UserInterviewPrepViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin, mixins.CreateModelMixin, mixins.UpdateModelMixin):
@@ -50,18 +56,27 @@ class UserInterviewPrepViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixi
     def perform_create(self, serializer):
         serializer.save(user_id=self.request.user.id, user_email=self.request.user.email)
 
-    @extend_schema(request=None)
+    @extend_schema(request=None, parameters=[UserInterviewPrepEvalRequestSerializer])
     @action(['post'], True)
     def evaluate(self, request: Request, pk=None):
-        """The view evaluates a UserInterviewPrep using InterviewPrepAPI and returns evaluation data."""
+        """
+            The view evaluates a UserInterviewPrep using InterviewPrepAPI and returns evaluation data.
+            With `batch=true` the evaluation is enqueued as a batch job (see `main.batch`) and saved
+            later, the view answers 202 with the current evaluation data.
+        """
         user_interview: UserInterviewPrep = self.get_object()
         if not user_interview.interview:
             raise BadRequest("UserInterviewPrep is not bound to any InterviewPrep!")
-        data = InterviewPrepAPI(user_interview).evaluate_interview()
-        user_interview.ai_grade = data.get("ai_grade", "Error.")
-        user_interview.ai_feedback = data.get("ai_feedback", "Error.")
-        user_interview.ai_strength = data.get("ai_strength", "Error.")
-        user_interview.ai_weakness = data.get("ai_weakness", "Error.")
+        query = UserInterviewPrepEvalRequestSerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        if query.validated_data['batch']:
+            InterviewPrepAPI(user_interview).enqueue_evaluation()
+            create_update_user_onboarding_task({"first_video": True}, str(request.auth))
+            return Response(self.get_serializer(user_interview).data, status.HTTP_202_ACCEPTED)
+        check_capacity(f"{self.basename}-{self.action}")
+        with user_scope(request.user.id):
+            data = InterviewPrepAPI(user_interview).evaluate_interview()
+        apply_evaluation(user_interview, data)
         user_interview.save()
         ser = self.get_serializer(user_interview)
         create_update_user_onboarding_task({"first_video": True}, str(request.auth))
@@ -129,15 +144,53 @@ class UserInterviewPrepViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixi
             Returns a Streaming HTTP Response rendered as Server-sent Event with text tokens.
             The view uses InterviewPrepAPI to generate text response.
             Raises Bad Request if requested UserInterviewPrep does not belong to any InterviewPrep.
+            A client reconnecting with `Last-Event-ID` gets the rest of the same question.
+            Over the LLM limits the request is queued (`queued` events) or answered with 429.
+            Over the adaptive limit (see `main.shedding`) the "high demand" message is sent right away.
         """
         user_interview: UserInterviewPrep = self.get_object()
         if not user_interview.interview:
             raise BadRequest("UserInterviewPrep is not bound to any InterviewPrep!")
-        stream = InterviewPrepAPI(user_interview).get_text_stream()
-        response = StreamingHttpResponse(stream, content_type="text/event-stream")
-        response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
-        response['Cache-Control'] = 'no-cache'  # Ensure clients don't cache the data
-        return response
+        last_event_id = parse_last_event_id(request.headers.get("Last-Event-ID"))
+        key = ("interview", user_interview.pk)
+        if last_event_id is not None and generations.get(key) is None:
+            # The generation is not running in this process: resume from the persisted question
+            if response := self.replay_stream(request, user_interview, key, last_event_id):
+                return response
+        # Retries of a request that is still in flight attach to its generation
+        generation, created = generations.get_or_create(key, resume=last_event_id is not None)
+        if generation is None:
+            # It is in flight in another process: follow its question, or reconnect once it is started
+            return (self.replay_stream(request, user_interview, key, last_event_id or 0)
+                    or sse_response([format_retry(settings.STREAM_CHECKPOINT_INTERVAL)]))
+        if created and is_overloaded(f"{self.basename}-{self.action}"):
+            generation.attach(aoverloaded_stream() if is_asgi_request(request) else overloaded_stream())
+        elif created:
+            try:
+                ticket = limiter.enqueue(str(request.user.id))
+            except TooManyRequests:
+                generation.fail()
+                raise
+            api = InterviewPrepAPI(user_interview)
+            api.view = f"{self.basename}-{self.action}"
+            if is_asgi_request(request):
+                generation.attach(aqueued_stream(ticket, api.aget_text_stream))
+            else:
+                generation.attach(queued_stream(ticket, api.get_text_stream))
+        if is_asgi_request(request):
+            return sse_response(generation.asubscribe(last_event_id))
+        return sse_response(generation.subscribe(last_event_id))
+
+    def replay_stream(self, request: Request, user_interview: UserInterviewPrep, key, last_event_id: int):
+        """Resumes the persisted last question after `last_event_id`, returns None if there is none."""
+        messages = list(user_interview.messages.all())  # type: ignore
+        if not messages or messages[-1].author_is_user:
+            return None
+        api = InterviewPrepAPI(user_interview, answer=messages[-1])
+        running = generations.running(key)
+        if is_asgi_request(request):
+            return sse_response(api.areplay_stream(last_event_id, running))
+        return sse_response(api.replay_stream(last_event_id, running))
 
 
 class InterviewPrepViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
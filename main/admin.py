@@ -3,6 +3,7 @@ from django.contrib import admin
 from main.models import (
     Agent,
     AgentImageExample,
+    BatchJob,
     VideoAvatar,
     VideoAvatarTemplate,
 )
@@ -25,4 +26,18 @@ class AgentImageExampleInline(admin.TabularInline):
 @admin.register(Agent)
 class AgentAdmin(admin.ModelAdmin):
     list_display = ('id', 'type', 'name')
+    readonly_fields = ('template_version',)
     inlines = [AgentImageExampleInline]
+
+    def save_model(self, request, obj, form, change):
+        # Invalidates prompt text materialized on the messages with the old template
+        if change and 'user_template' in form.changed_data:
+            obj.template_version += 1
+        super().save_model(request, obj, form, change)
+
+
+@admin.register(BatchJob)
+class BatchJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'target_id', 'model', 'status', 'date_created', 'date_completed')
+    list_filter = ('kind', 'status')
+    search_fields = ('target_id', 'batch_id')
@@ -4,16 +4,28 @@ from typing import (
     Any,
     Iterable,
     List,
+    Optional,
+    Tuple,
 )
-from openai.types.chat import ChatCompletion
+from django.conf import settings
+from django.db.models import QuerySet, prefetch_related_objects
+from django.utils import timezone
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+from main import batch
 from main.utils import generate_chat_completion
 from main.base_api import BaseGenerationAPI
+from main.context_window import Turn
+from main.routing import Route, route
 from main.models import (
     Agent,
-    AgentTypes
+    AgentTypes,
+    BatchJob,
+    BatchJobKinds,
 )
 from chat.models import (
+    Chat,
     MessageObject,
+    MessageObjectStatuses,
     MessageObjectTypes,
     Message,
 )
@@ -30,12 +42,24 @@ class StreamAgentAPI(BaseGenerationAPI):
         as the appropriate response. In addition to this, API is written to automatically create
         new TaskMessage with a MessageObject, corresponding to the answer of the Agent.
     """
+    CALL_SITE = "chat"
     agent: Agent
     agent_message: Message
 
     def __init__(self, message: Message) -> None:
         self.agent = message.agent  # type: ignore
         self.agent_message = message
+        self._rendered: List[Message] = []
+        self._answer_obj: Optional[MessageObject] = None
+
+    @property
+    def metric_labels(self) -> dict:
+        return {**super().metric_labels, "agent_type": self.agent.type}
+
+    # @override ( Requires Python version 3.12 )
+    def get_route(self) -> Route:
+        """The model of the Agent, if it has one, or the routing rules for its type."""
+        return route(self.CALL_SITE, self.messages, agent_type=self.agent.type, model=self.agent.model)
 
     # @override ( Requires Python version 3.12 )
     def get_system_prompt(self, *args, **kwargs):
@@ -45,15 +69,63 @@ class StreamAgentAPI(BaseGenerationAPI):
     def get_user_prompt(self, *args, **kwargs):
         return self.agent.user_template
 
+    def get_message_chat(self, task_message: Message) -> Chat:
+        """Returns the Chat of the message, reusing the one already loaded with `.agent_message`."""
+        if task_message.chat_id == self.agent_message.chat_id:  # type: ignore
+            return self.agent_message.chat
+        return task_message.chat
+
+    def get_message_objs(self, task_message: Message) -> List[MessageObject]:
+        """
+            Returns message's objects ordered by pk.
+
+            Always goes through `.objs.all()`, so a `prefetch_related('objs')` on the
+            message queryset is reused instead of querying the objects per message.
+        """
+        return sorted(task_message.objs.all(), key=lambda obj: obj.pk)  # type: ignore
+
+    def get_rendered_content(self, task_message: Message) -> Optional[str]:
+        """
+            Returns the materialized prompt text of the message if it is still valid.
+
+            User messages are valid for the template they were rendered with (`Agent.template_key`),
+            answers do not depend on any template.
+        """
+        if task_message.rendered_content is None:
+            return None
+        if task_message.is_answer or task_message.rendered_template == self.agent.template_key:
+            return task_message.rendered_content
+        return None
+
+    def set_rendered_content(self, task_message: Message, text: str) -> None:
+        """Materializes the prompt text on the message. Saved in bulk by `.save_rendered_content`."""
+        template = "" if task_message.is_answer else self.agent.template_key
+        if task_message.rendered_content == text and task_message.rendered_template == template:
+            return
+        task_message.rendered_content = text
+        task_message.rendered_template = template
+        self._rendered.append(task_message)
+
+    def save_rendered_content(self) -> None:
+        if self._rendered:
+            Message.objects.bulk_update(self._rendered, ['rendered_content', 'rendered_template'])
+            self._rendered = []
+
     def get_message_text_content(self, task_message: Message) -> str:
+        rendered = self.get_rendered_content(task_message)
+        if rendered is not None:
+            return rendered
+        objs = self.get_message_objs(task_message)
         if task_message.is_answer:
-            if obj := task_message.objs.first():  # type: ignore
-                return obj.content
-            return ""
+            text = objs[0].content if objs else ""
+            # a partial answer that is still being generated is not materialized
+            if objs and objs[0].status != MessageObjectStatuses.AWAITING:
+                self.set_rendered_content(task_message, text)
+            return text
 
         params = defaultdict(lambda: self.NOT_DEFINED)
         # project = task_message.task.project
-        chat = task_message.chat
+        chat = self.get_message_chat(task_message)
 
         if isinstance(task_message.parameters, dict):
             params.update(task_message.parameters)
@@ -61,8 +133,7 @@ class StreamAgentAPI(BaseGenerationAPI):
             logging.warning(
                 "StreamAgentAPI: task_message.parameters is not a dictionary. Ignoring parameters. task_message.pk=%d", task_message.pk)
 
-        # type: ignore
-        for obj in task_message.objs.filter(content_type__in=[MessageObjectTypes.QUOTE, MessageObjectTypes.TEXT]):
+        for obj in objs:
             if obj.content_type == MessageObjectTypes.QUOTE:
                 params.update(quote=obj.content)
             elif obj.content_type == MessageObjectTypes.TEXT:
@@ -73,12 +144,14 @@ class StreamAgentAPI(BaseGenerationAPI):
                 email=chat.user_email
             )
 
-        return self.get_user_prompt().format_map(params)
+        text = self.get_user_prompt().format_map(params)
+        self.set_rendered_content(task_message, text)
+        return text
 
     def get_message_full_content(self, task_message: Message) -> List[Any]:
         content = []
         params = defaultdict(lambda: self.NOT_DEFINED)
-        chat = task_message.chat
+        chat = self.get_message_chat(task_message)
 
         if isinstance(task_message.parameters, dict):
             params.update(task_message.parameters)
@@ -86,7 +159,7 @@ class StreamAgentAPI(BaseGenerationAPI):
             logging.warning(
                 "StreamAgentAPI: task_message.parameters is not a dictionary. Ignoring parameters. task_message.pk=%d", task_message.pk)
 
-        for obj in task_message.objs.all():  # type: ignore
+        for obj in self.get_message_objs(task_message):
             if obj.content_type == MessageObjectTypes.QUOTE:
                 params.update(quote=obj.content)
             elif obj.content_type == MessageObjectTypes.TEXT:
@@ -104,24 +177,94 @@ class StreamAgentAPI(BaseGenerationAPI):
             )
 
         text = self.get_user_prompt().format_map(params)
+        self.set_rendered_content(task_message, text)
         content.append({
             "type": "text",
             "text": text
         })
         return content
 
+    # @override ( Requires Python version 3.12 )
+    def checkpoint(self, partial_content: str) -> None:
+        """Persists the partial answer as an AWAITING MessageObject, so it survives a lost connection."""
+        if self._answer_obj is None:
+            self._answer_obj = MessageObject.objects.create(
+                message=self.agent_message,
+                content_type=MessageObjectTypes.TEXT,
+                content=partial_content,
+                status=MessageObjectStatuses.AWAITING,
+            )
+        else:
+            MessageObject.objects.filter(pk=self._answer_obj.pk).update(content=partial_content)
+
+    # @override ( Requires Python version 3.12 )
+    def load_checkpoint(self) -> Optional[Tuple[str, bool]]:
+        data = MessageObject.objects.filter(
+            message=self.agent_message, content_type=MessageObjectTypes.TEXT
+        ).order_by('pk').values('content', 'status').first()
+        if not data:
+            # the first checkpoint is not written yet, or never will be (the stream failed before it)
+            age = (timezone.now() - self.agent_message.date_created).total_seconds()
+            return "", age < settings.STREAM_CHECKPOINT_INTERVAL
+        return data['content'], data['status'] == MessageObjectStatuses.AWAITING
+
+    # @override ( Requires Python version 3.12 )
+    def post_cancel(self, partial_content: str) -> None:
+        """Keeps the partial answer, marked as CANCELLED."""
+        if self._answer_obj is None:
+            MessageObject.objects.create(
+                message=self.agent_message,
+                content_type=MessageObjectTypes.TEXT,
+                content=partial_content,
+                status=MessageObjectStatuses.CANCELLED,
+            )
+        else:
+            MessageObject.objects.filter(pk=self._answer_obj.pk).update(
+                content=partial_content, status=MessageObjectStatuses.CANCELLED)
+        if partial_content:
+            Chat.set_preview(self.agent_message.chat_id, partial_content)
+
     # @override ( Requires Python version 3.12 )
     def post_generate(self, full_content: str) -> None:
-        MessageObject.objects.create(
-            message=self.agent_message,
-            content_type=MessageObjectTypes.TEXT,
-            content=full_content,
-        )
+        if self._answer_obj is None:
+            MessageObject.objects.create(
+                message=self.agent_message,
+                content_type=MessageObjectTypes.TEXT,
+                content=full_content,
+            )
+        else:
+            MessageObject.objects.filter(pk=self._answer_obj.pk).update(
+                content=full_content, status=MessageObjectStatuses.INITIAL)
+        Message.objects.filter(pk=self.agent_message.pk).update(
+            rendered_content=full_content, rendered_template="")
+        Chat.set_preview(self.agent_message.chat_id, full_content)
+
+    def prefetch_context(self, task_messages: Iterable[Message], last_msg_id: Any) -> List[Message]:
+        """
+            Loads the chat history with at most two bulk queries, so building the context does not
+            depend on the history length.
+
+            Messages with a valid materialized prompt text are a single column read, so objects
+            are only prefetched for the ones that have to be rendered (and for the last message,
+            which may contain images).
+        """
+        if isinstance(task_messages, QuerySet):
+            task_messages = task_messages.select_related('agent')
+        task_messages = list(task_messages)
+        to_render = [
+            task_message for task_message in task_messages
+            if task_message != self.agent_message and (
+                task_message.pk == last_msg_id or self.get_rendered_content(task_message) is None
+            )
+        ]
+        prefetch_related_objects(to_render, 'objs')
+        return task_messages
 
     # @override ( Requires Python version 3.12 )
     def pre_generate(self, *args, **kwargs) -> None:
-        task_messages = kwargs["task_messages"]
         last_msg_id = kwargs["last_msg_id"]
+        task_messages = self.prefetch_context(kwargs["task_messages"], last_msg_id)
+        turns = []
         for task_message in task_messages:
             if task_message == self.agent_message:
                 continue
@@ -131,35 +274,84 @@ class StreamAgentAPI(BaseGenerationAPI):
                 content = self.get_message_full_content(task_message)
             if content:
                 role = "assistant" if task_message.is_answer else "user"
-                self.append_message(content, role)
+                turns.append(Turn(task_message.pk, role, content))
+        self.save_rendered_content()
+        self.append_context(self.agent_message.chat, turns)
 
     # @override ( Requires Python version 3.12 )
     def get_text_stream(self, task_messages: Iterable[Message], last_msg_id: Any):  # pylint: disable=W0221
-        try:
-            return self._get_text_stream(task_messages=task_messages, last_msg_id=last_msg_id)
-        except Exception as e:
-            logging.exception(e)
-            return self.fake_stream("Currently, the AI service is experiencing high demand, please try a few minutes later.")
+        return super().get_text_stream(task_messages=task_messages, last_msg_id=last_msg_id)
 
-    def get_title(self, user_msg_id: Any):
+    # @override ( Requires Python version 3.12 )
+    def aget_text_stream(self, task_messages: Iterable[Message], last_msg_id: Any):  # pylint: disable=W0221
+        return super().aget_text_stream(task_messages=task_messages, last_msg_id=last_msg_id)
+
+    def generate_title(self, user_msg_id: Any) -> Optional[str]:
+        """
+            Generates and saves the title of the Chat. Meant to be run alongside the answer stream.
+            Returns None and keeps the title if it could not be generated.
+        """
+        title = self.get_title(user_msg_id)
+        if not title:
+            return None
+        title = title[:Chat._meta.get_field('title').max_length]
+        Chat.objects.filter(pk=self.agent_message.chat_id).update(title=title)
+        return title
+
+    def get_title(self, user_msg_id: Any) -> Optional[str]:
         data = MessageObject.objects.filter(
             message_id=user_msg_id, content_type=MessageObjectTypes.TEXT).values("content").first()
         if not data:
-            return "None"
-        messages = [
-            {
-                "role": "system",
-                "content": "Write a short title for a conversation with ChatGPT based on the following user request.",
-            },
-            {
-                "role": "user",
-                "content": data["content"],
-            }
-        ]
+            return None
         try:
-            response = generate_chat_completion(messages)
+            response = generate_chat_completion(get_title_messages(data["content"]), cache=True, call_site="title")
         except Exception as e:
             logging.exception(e)
-            return "None"
+            return None
         assert isinstance(response, ChatCompletion)
-        return response.choices[0].message.content or "None"
+        return response.choices[0].message.content
+
+
+def get_title_messages(content: str) -> List[ChatCompletionMessageParam]:
+    return [
+        {
+            "role": "system",
+            "content": "Write a short title for a conversation with ChatGPT based on the following user request.",
+        },
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
+
+
+def enqueue_chat_titles(limit: int) -> int:
+    """Enqueues batch jobs (see `main.batch`) titling up to `limit` "Untitled" chats from their first text message."""
+    queued = batch.open_targets(BatchJobKinds.CHAT_TITLE)
+    first_texts = (
+        MessageObject.objects
+        .filter(message__chat__title="Untitled", message__is_answer=False, content_type=MessageObjectTypes.TEXT)
+        .exclude(content="")
+        .order_by('message__chat_id', 'message__date_created', 'pk')
+        .values_list('message__chat_id', 'content')
+    )
+    jobs: List[BatchJob] = []
+    for chat_id, content in first_texts.iterator():
+        if len(jobs) >= limit:
+            break
+        if str(chat_id) in queued:
+            continue
+        queued.add(str(chat_id))
+        jobs.append(batch.make_job(BatchJobKinds.CHAT_TITLE, chat_id, get_title_messages(content), "title"))
+    batch.enqueue(jobs)
+    return len(jobs)
+
+
+def write_chat_titles(jobs: List[BatchJob]) -> None:
+    """Batch job writer: saves the titles of the chats that are still "Untitled"."""
+    max_length = Chat._meta.get_field('title').max_length
+    titles = {job.target_id: job.result[:max_length] for job in jobs if job.result}
+    chats = list(Chat.objects.filter(pk__in=titles.keys(), title="Untitled").only('pk', 'title'))
+    for chat in chats:
+        chat.title = titles[str(chat.pk)]
+    Chat.objects.bulk_update(chats, ['title'])
@@ -1,12 +1,67 @@
+import asyncio
 import logging
+import time
 from abc import ABC, abstractmethod
+from concurrent import futures
+from concurrent.futures import Future
 from typing import (
     Any,
+    AsyncIterator,
+    Awaitable,
     Iterable,
     List,
+    Optional,
+    Tuple,
 )
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from openai.types.chat import ChatCompletionMessageParam
-from main.utils import generate_chat_completion
+from main import metrics
+from main.context_window import ContextWindow, Turn, count_text_tokens
+from main.limiter import Ticket, current_stream_ticket, stream_scope
+from main.routing import Route, route
+from main.sse import (
+    STOP_FRAME,
+    TICK,
+    SSECoalescer,
+    awith_ticks,
+    format_event,
+    format_frame,
+    format_retry,
+    with_ticks,
+)
+from main.utils import agenerate_chat_completion, generate_chat_completion, run_in_background
+
+
+class StreamStats:
+    """
+        Timings of a single stream. They are kept locally and recorded into the stream metrics
+        once the stream ends, so tokens only cost a clock read and a list append.
+    """
+
+    def __init__(self, started: Optional[float] = None) -> None:
+        self.started = started or time.monotonic()
+        self.first_sent: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.gaps: List[float] = []
+
+    def token(self) -> None:
+        now = time.monotonic()
+        if self.last_token is not None:
+            self.gaps.append(now - self.last_token)
+        self.last_token = now
+
+    def sent(self) -> None:
+        if self.first_sent is None:
+            self.first_sent = time.monotonic()
+
+    def record(self, reason: str, tokens: int, **labels) -> None:
+        if self.first_sent is not None:
+            metrics.stream_ttft_seconds.observe(self.first_sent - self.started, **labels)
+        metrics.stream_inter_token_seconds.observe_many(self.gaps, **labels)
+        metrics.stream_output_tokens.observe(tokens, **labels)
+        metrics.stream_duration_seconds.observe(time.monotonic() - self.started, **labels)
+        metrics.streams_ended.inc(reason=reason, **labels)
 
 
 class BaseGenerationAPI(ABC):
@@ -14,27 +69,184 @@ class BaseGenerationAPI(ABC):
         Base API for working with AI generatio
     """
     NOT_DEFINED = "Not defined."
+    HIGH_DEMAND = "Currently, the AI service is experiencing high demand, please try a few minutes later."
+    # settings.LLM_CALL_SITES entry of the streamed completions
+    CALL_SITE = "default"
+    # name of the view serving the stream, a label of the stream metrics
+    view = "other"
+    _started: Optional[float] = None
+    _route: Optional[Route] = None
+    _context: Optional[ContextWindow] = None
+    _ticket: Optional[Ticket] = None
     _messages: List[ChatCompletionMessageParam] = []
+    _side_events: List[Tuple[str, Future]] = []
 
     def _text_stream(self, generator: Iterable):
         """A generator that returns GPT's streaming response in Server-side event data format.
 
+        Tokens are coalesced into frames according to `SSE_COALESCE_MS`/`SSE_COALESCE_BYTES`.
+        The partial content is passed to `.checkpoint` every `STREAM_CHECKPOINT_INTERVAL` seconds.
+        When the generator is closed before the end (the client is gone), the upstream completion
+        is closed and the partial content is passed to `.post_cancel`.
+        Time to first token, gaps between tokens, tokens, duration and how the stream ended are
+        recorded in `main.metrics`, labeled with `.metric_labels`.
+
         :param generator: OpenAi chat completion generator
         :type generator: Iterable
         :yield: text stream formatted for a server-side event.
         :rtype: Generator [bytes, Any, None]
         """
-        full_content = ""
-        for _, chunk in enumerate(generator):
-            answer = chunk.choices[0]  # type: ignore
-            if answer.finish_reason:
-                break
-            chunk_text: str = answer.delta.content or ""
-            full_content += chunk_text
-            chunk_text = chunk_text.replace("\n", "<br/>")
-            yield (f'data: {chunk_text}\n\n').encode()
-        self.post_generate(full_content)
-        yield ('data: Stop\0\n\n').encode()
+        buffer = SSECoalescer()
+        stats = StreamStats(self._started)
+        reason = "completed"
+        last_checkpoint = time.monotonic()
+        # without new tokens the pending text is still sent once it is due
+        chunks = with_ticks(generator, buffer.timeout) if buffer.max_delay else generator
+        try:
+            for chunk in chunks:
+                if chunk is TICK:
+                    if frame := buffer.flush_due():
+                        stats.sent()
+                        yield frame
+                    continue
+                answer = chunk.choices[0]  # type: ignore
+                if answer.finish_reason:
+                    reason = self._end_reason(answer.finish_reason)
+                    break
+                if answer.delta.content:
+                    stats.token()
+                if frame := buffer.push(answer.delta.content or ""):
+                    stats.sent()
+                    yield frame
+                if self._side_events:
+                    yield from self._side_event_frames()
+                if time.monotonic() - last_checkpoint >= settings.STREAM_CHECKPOINT_INTERVAL:
+                    self.checkpoint(buffer.content)
+                    last_checkpoint = time.monotonic()
+            if frame := buffer.flush():
+                stats.sent()
+                yield frame
+        except GeneratorExit:
+            self._record_cancel(buffer.content, stats)
+            self.post_cancel(buffer.content)
+            self.summarize_context()
+            raise
+        except Exception:
+            self._record_error(buffer.content, stats)
+            raise
+        finally:
+            # closes the upstream HTTP response, so no more tokens are generated
+            if hasattr(generator, "close"):
+                generator.close()  # type: ignore
+        self._record_complete(buffer.content, stats, reason)
+        self.post_generate(buffer.content)
+        self.summarize_context()
+        if self._side_events:
+            futures.wait([future for _, future in self._side_events], timeout=settings.SSE_SIDE_EVENT_TIMEOUT)
+            yield from self._side_event_frames()
+        yield STOP_FRAME
+
+    async def _atext_stream(self, completion: Awaitable) -> AsyncIterator[bytes]:
+        """Async variant of `._text_stream` used when the app is served through `ai.asgi`.
+
+        The chat completion is awaited inside the generator, so upstream errors are
+        reported to the client as a fake stream instead of failing the response.
+        Closing the generator closes the upstream completion, as in `._text_stream`.
+
+        :param completion: awaitable returning an OpenAi async chat completion generator
+        :type completion: Awaitable
+        :yield: text stream formatted for a server-side event.
+        :rtype: AsyncGenerator [bytes, None]
+        """
+        try:
+            generator = await completion
+        except Exception as e:
+            logging.exception(e)
+            metrics.streams_ended.inc(reason="unavailable", **self.metric_labels)
+            for frame in self.fake_stream(self.HIGH_DEMAND):
+                yield frame
+            return
+        buffer = SSECoalescer()
+        stats = StreamStats(self._started)
+        reason = "completed"
+        last_checkpoint = time.monotonic()
+        chunks = awith_ticks(generator, buffer.timeout) if buffer.max_delay else generator
+        try:
+            async for chunk in chunks:
+                if chunk is TICK:
+                    if frame := buffer.flush_due():
+                        stats.sent()
+                        yield frame
+                    continue
+                answer = chunk.choices[0]  # type: ignore
+                if answer.finish_reason:
+                    reason = self._end_reason(answer.finish_reason)
+                    break
+                if answer.delta.content:
+                    stats.token()
+                if frame := buffer.push(answer.delta.content or ""):
+                    stats.sent()
+                    yield frame
+                if self._side_events:
+                    for frame in self._side_event_frames():
+                        yield frame
+                if time.monotonic() - last_checkpoint >= settings.STREAM_CHECKPOINT_INTERVAL:
+                    await sync_to_async(self.checkpoint)(buffer.content)
+                    last_checkpoint = time.monotonic()
+            if frame := buffer.flush():
+                stats.sent()
+                yield frame
+        except GeneratorExit:
+            self._record_cancel(buffer.content, stats)
+            await sync_to_async(self.post_cancel)(buffer.content)
+            self.summarize_context()
+            raise
+        except Exception:
+            self._record_error(buffer.content, stats)
+            raise
+        finally:
+            if chunks is not generator:
+                # cancels the read of the next chunk
+                await chunks.aclose()  # type: ignore
+            if hasattr(generator, "aclose"):
+                await generator.aclose()  # type: ignore
+            elif hasattr(generator, "close"):
+                await generator.close()  # type: ignore
+        self._record_complete(buffer.content, stats, reason)
+        await sync_to_async(self.post_generate)(buffer.content)
+        self.summarize_context()
+        if self._side_events:
+            await asyncio.wait(
+                [asyncio.wrap_future(future) for _, future in self._side_events],
+                timeout=settings.SSE_SIDE_EVENT_TIMEOUT
+            )
+            for frame in self._side_event_frames():
+                yield frame
+        yield STOP_FRAME
+
+    def add_side_event(self, event: str, future: Future):
+        """
+            Sends the result of `future` to the client as a separate SSE event named `event`
+            as soon as it is ready, without delaying the answer tokens.
+            Pending events are awaited for up to `SSE_SIDE_EVENT_TIMEOUT` before the Stop frame.
+        """
+        self._side_events = self._side_events + [(event, future)]
+
+    def _side_event_frames(self) -> List[bytes]:
+        """Returns frames for the side events that are ready and forgets about them."""
+        frames = []
+        pending = []
+        for event, future in self._side_events:
+            if not future.done():
+                pending.append((event, future))
+                continue
+            try:
+                if (result := future.result()) is not None:
+                    frames.append(format_event(event, str(result)))
+            except Exception as e:
+                logging.exception(e)
+        self._side_events = pending
+        return frames
 
     @abstractmethod
     def get_system_prompt(self, *args, **kwargs) -> str:
@@ -71,6 +283,106 @@ class BaseGenerationAPI(ABC):
             }  # type: ignore
         )
 
+    def append_context(self, owner: Any, turns: List[Turn]):
+        """
+            Appends chat history fitted into `CONTEXT_TOKEN_BUDGET` by `ContextWindow`.
+            Older turns are replaced with the rolling summary persisted on `owner`.
+        """
+        assert self._messages, "self.__messages is not defined. Run .init_messages() first!"
+        self._context = ContextWindow(owner)
+        self._messages.extend(self._context.fit(turns))
+
+    def summarize_context(self) -> None:
+        """
+            Folds the turns `.append_context` dropped from the prompt into the summary, in the background,
+            so the LLM call does not delay the answer. Called once the stream ended.
+        """
+        if self._context and self._context.dropped:
+            # the stream may still hold its slot, the summary is made under it (see `main.limiter`)
+            with stream_scope(self._ticket):
+                run_in_background(self._context.extend_summary, self._context.dropped)
+            self._context = None
+
+    def checkpoint(self, partial_content: str) -> None:
+        """A helper function that is called in `._text_stream` every `STREAM_CHECKPOINT_INTERVAL` seconds with the content generated so far."""
+        return
+
+    def load_checkpoint(self) -> Optional[Tuple[str, bool]]:
+        """Returns the persisted answer content and whether it is still being generated, or None if there is no answer."""
+        return None
+
+    def replay_stream(self, last_event_id: int, running: bool = False):
+        """
+            Resumes a stream whose generation is not running in this process from the persisted checkpoint.
+
+            Sends the content after `last_event_id` persisted so far, without polling for more: a WSGI worker
+            is not held while the answer is generated elsewhere. If it is still `running` (in another process,
+            see `main.stream_registry`), the response ends without the Stop frame and the client reconnects
+            with its new `Last-Event-ID` after `STREAM_CHECKPOINT_INTERVAL` to get the rest.
+        """
+        checkpoint = self.load_checkpoint()
+        if checkpoint is not None and len(checkpoint[0]) > last_event_id:
+            content = checkpoint[0]
+            yield format_frame(content[last_event_id:], len(content))
+        if running and checkpoint is not None and checkpoint[1]:
+            yield format_retry(settings.STREAM_CHECKPOINT_INTERVAL)
+            return
+        yield STOP_FRAME
+
+    async def areplay_stream(self, last_event_id: int, running: bool = False):
+        """
+            Async counterpart of `.replay_stream`. Keeps polling the checkpoint while the answer is in progress,
+            which only costs a task here. Gives up once it did not change for `STREAM_RESUME_STALE` seconds.
+        """
+        offset = last_event_id
+        unchanged = 0.0
+        while (checkpoint := await sync_to_async(self.load_checkpoint)()) is not None:
+            content, in_progress = checkpoint
+            if len(content) > offset:
+                yield format_frame(content[offset:], len(content))
+                offset = len(content)
+                unchanged = 0.0
+            if not running or not in_progress or unchanged >= settings.STREAM_RESUME_STALE:
+                break
+            await asyncio.sleep(settings.STREAM_CHECKPOINT_INTERVAL)
+            unchanged += settings.STREAM_CHECKPOINT_INTERVAL
+        yield STOP_FRAME
+
+    @property
+    def metric_labels(self) -> dict:
+        """Labels of the stream metrics."""
+        return {"agent_type": self.CALL_SITE, "view": self.view}
+
+    @staticmethod
+    def _end_reason(finish_reason: str) -> str:
+        return "completed" if finish_reason == "stop" else finish_reason
+
+    def _record_complete(self, full_content: str, stats: StreamStats, reason: str = "completed") -> None:
+        tokens = count_text_tokens(full_content)
+        metrics.completion_tokens.observe(tokens, api=type(self).__name__)
+        stats.record(reason, tokens, **self.metric_labels)
+        if self._route:
+            self._route.record_tokens(tokens)
+
+    def _record_cancel(self, partial_content: str, stats: StreamStats) -> None:
+        """Counts the cancellation and the tokens it saved, estimated from the mean length of finished answers."""
+        api = type(self).__name__
+        tokens = count_text_tokens(partial_content)
+        saved = metrics.completion_tokens.mean(api=api) - tokens
+        metrics.stream_cancellations.inc(api=api)
+        metrics.stream_tokens_saved.inc(max(saved, 0), api=api)
+        stats.record("client_disconnect", tokens, **self.metric_labels)
+        if self._route:
+            self._route.record_tokens(tokens)
+        logging.info("%s: stream cancelled after %d characters.", api, len(partial_content))
+
+    def _record_error(self, partial_content: str, stats: StreamStats) -> None:
+        stats.record("upstream_error", count_text_tokens(partial_content), **self.metric_labels)
+
+    def post_cancel(self, partial_content: str) -> None:
+        """A helper function that is called in `._text_stream` instead of `.post_generate` when the stream is closed before the end."""
+        return
+
     def post_generate(self, full_content: str) -> None:
         """A helper function that is called in `.__text_stream` after the full completion and before the last message packet were sent."""
         return
@@ -79,22 +391,60 @@ class BaseGenerationAPI(ABC):
         """A helper function that is called in `.__get_text_stream` before generating a chat completion from `self.messages`."""
         return
 
+    def get_route(self) -> Route:
+        """Model of the streamed completion of `self.messages` (see `main.routing`)."""
+        return route(self.CALL_SITE, self.messages)
+
     def _get_text_stream(self, *args, **kwargs):
         """Args and kwargs are passed down to `.pre_generate` and `.init_messages` -> `.get_system_prompt`."""
+        self._started = time.monotonic()
+        self._ticket = current_stream_ticket()
         self.init_messages(*args, **kwargs)
         self.pre_generate(*args, **kwargs)
-        generator = generate_chat_completion(self.messages, stream=True)
+        self._route = self.get_route()
+        generator = generate_chat_completion(
+            self.messages, stream=True, call_site=self.CALL_SITE, route_to=self._route)
         return self._text_stream(generator)
 
+    def _aget_text_stream(self, *args, **kwargs):
+        """
+            Same as `._get_text_stream`, but returns an async generator.
+
+            `.pre_generate` still runs synchronously (in the view's thread), only the
+            completion itself is awaited on the event loop.
+        """
+        self._started = time.monotonic()
+        self._ticket = current_stream_ticket()
+        self.init_messages(*args, **kwargs)
+        self.pre_generate(*args, **kwargs)
+        self._route = self.get_route()
+        return self._atext_stream(agenerate_chat_completion(
+            self.messages, stream=True, call_site=self.CALL_SITE, route_to=self._route))
+
     def get_text_stream(self, *args, **kwargs) -> Any:
         """A simple wrapper with a possibility to add types when overriding."""
         try:
             return self._get_text_stream(*args, **kwargs)
         except Exception as e:
             logging.exception(e)
-            return self.fake_stream("Currently, the AI service is experiencing high demand, please try a few minutes later.")
+            metrics.streams_ended.inc(reason="unavailable", **self.metric_labels)
+            return self.fake_stream(self.HIGH_DEMAND)
+
+    def aget_text_stream(self, *args, **kwargs) -> Any:
+        """Async counterpart of `.get_text_stream`. Should only be used with `AsyncStreamingHttpResponse`."""
+        try:
+            return self._aget_text_stream(*args, **kwargs)
+        except Exception as e:
+            logging.exception(e)
+            metrics.streams_ended.inc(reason="unavailable", **self.metric_labels)
+            return self.afake_stream(self.HIGH_DEMAND)
 
     def fake_stream(self, text):
         """Fake stream for streaming errors."""
-        yield (f'data: {text}\n\n').encode()
-        yield ('data: Stop\0\n\n').encode()
+        yield format_frame(text)
+        yield STOP_FRAME
+
+    async def afake_stream(self, text):
+        """Async fake stream for streaming errors."""
+        for frame in self.fake_stream(text):
+            yield frame
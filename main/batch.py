@@ -0,0 +1,144 @@
+"""
+Offline batch generation.
+
+Work nobody waits on (titles of old "Untitled" chats, deferred interview evaluations, ...) is not
+sent through `main.utils.generate_chat_completion`. It is stored as `BatchJob` rows instead, and
+`run_batch_jobs` (a management command meant to be run periodically):
+    - submits the pending jobs in bulk, one batch per model, with `BaseProvider.submit_batch`.
+      With `OpenAIProvider` they go through the OpenAI Batch API, which has its own rate limits,
+      so they neither take slots of `main.limiter` nor compete with live streams upstream.
+      The jobs are claimed first (marked "submitting" in a short transaction), so no row locks are
+      held during the upload, and marked submitted once the batch ID is known;
+    - collects finished batches and writes their results back in bulk, with the writer of the job
+      kind (`WRITERS`), which gets all completed jobs of a kind from a batch at once.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, Iterable, List, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+
+from main import metrics
+from main.models import BatchJob, BatchJobKinds, BatchJobStatuses
+from main.providers import get_provider
+from main.routing import route
+
+# Writers of the results per job kind: functions taking the completed jobs of a kind
+WRITERS = {
+    BatchJobKinds.CHAT_TITLE: "main.api.write_chat_titles",
+    BatchJobKinds.INTERVIEW_EVALUATION: "interview_prep.api.write_evaluations",
+}
+OPEN_STATUSES = (BatchJobStatuses.PENDING, BatchJobStatuses.SUBMITTING, BatchJobStatuses.SUBMITTED)
+
+
+def make_job(kind: str, target_id, messages: List[ChatCompletionMessageParam], call_site: str,
+             reply_json=False, temperature=0) -> BatchJob:
+    """An unsaved job, the model is routed for `call_site` (see `main.routing`)."""
+    return BatchJob(
+        kind=kind,
+        target_id=str(target_id),
+        call_site=call_site,
+        model=route(call_site, messages).model,
+        request={
+            "messages": messages,
+            "temperature": temperature,
+            "response_format": {"type": "json_object" if reply_json else "text"},
+        },
+    )
+
+
+def enqueue(jobs: Iterable[BatchJob]) -> List[BatchJob]:
+    return BatchJob.objects.bulk_create(jobs)
+
+
+def open_targets(kind: str) -> Set[str]:
+    """Target IDs that already have a pending or submitted job of `kind`."""
+    return set(BatchJob.objects.filter(kind=kind, status__in=OPEN_STATUSES).values_list('target_id', flat=True))
+
+
+def _claim(limit: int) -> List[BatchJob]:
+    """
+        Marks up to `limit` pending jobs as submitting, along with the ones a run that died left submitting
+        for `BATCH_JOBS["SUBMIT_TIMEOUT"]` seconds. Concurrent runs claim different jobs.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.BATCH_JOBS["SUBMIT_TIMEOUT"])
+    with transaction.atomic():
+        jobs = list(BatchJob.objects.select_for_update(skip_locked=True)
+                    .filter(Q(status=BatchJobStatuses.PENDING)
+                            | Q(status=BatchJobStatuses.SUBMITTING, date_submitted__lt=stale))
+                    .order_by('date_created')[:limit])
+        for job in jobs:
+            job.status = BatchJobStatuses.SUBMITTING
+            job.date_submitted = now
+        BatchJob.objects.bulk_update(jobs, ['status', 'date_submitted'])
+    return jobs
+
+
+def submit_pending(limit: int = 0) -> int:
+    """Submits up to `limit` (`BATCH_JOBS["MAX_BATCH_SIZE"]` by default) pending jobs, returns how many were submitted."""
+    limit = limit or settings.BATCH_JOBS["MAX_BATCH_SIZE"]
+    provider = get_provider()
+    by_model: Dict[str, List[BatchJob]] = defaultdict(list)
+    for job in _claim(limit):
+        by_model[job.model].append(job)
+    submitted = 0
+    for model, model_jobs in by_model.items():
+        pks = [job.pk for job in model_jobs]
+        try:
+            batch_id = provider.submit_batch([
+                {"custom_id": str(job.pk), "model": model, **job.request} for job in model_jobs
+            ])
+        except Exception as e:
+            # the jobs are pending again and submitted with the next run
+            logging.exception(e)
+            BatchJob.objects.filter(pk__in=pks).update(status=BatchJobStatuses.PENDING, date_submitted=None)
+            continue
+        BatchJob.objects.filter(pk__in=pks).update(status=BatchJobStatuses.SUBMITTED, batch_id=batch_id)
+        submitted += len(model_jobs)
+    return submitted
+
+
+def _resolve(job: BatchJob, result) -> None:
+    job.date_completed = timezone.now()
+    if isinstance(result, ChatCompletion):
+        job.status = BatchJobStatuses.COMPLETED
+        job.result = result.choices[0].message.content or ""
+    else:
+        job.status = BatchJobStatuses.FAILED
+        job.error = result or "No result in the batch."
+    metrics.batch_jobs.inc(kind=job.kind, status=job.status)
+
+
+def collect_submitted() -> Tuple[int, int]:
+    """Writes back the results of the finished batches, returns how many jobs completed and failed."""
+    provider = get_provider()
+    completed = failed = 0
+    batch_ids = (BatchJob.objects.filter(status=BatchJobStatuses.SUBMITTED)
+                 .values_list('batch_id', flat=True).distinct())
+    for batch_id in list(batch_ids):
+        results = provider.get_batch(batch_id)
+        if results is None:
+            continue
+        jobs = list(BatchJob.objects.filter(status=BatchJobStatuses.SUBMITTED, batch_id=batch_id))
+        by_kind: Dict[str, List[BatchJob]] = defaultdict(list)
+        for job in jobs:
+            _resolve(job, results.get(str(job.pk)))
+            if job.status == BatchJobStatuses.COMPLETED:
+                by_kind[job.kind].append(job)
+        with transaction.atomic():
+            for kind, kind_jobs in by_kind.items():
+                import_string(WRITERS[kind])(kind_jobs)
+            BatchJob.objects.bulk_update(jobs, ['status', 'result', 'error', 'date_completed'])
+        # only once written back: after a rollback the results are collected again with the next run
+        provider.delete_batch(batch_id)
+        batch_completed = sum(len(kind_jobs) for kind_jobs in by_kind.values())
+        completed += batch_completed
+        failed += len(jobs) - batch_completed
+    return completed, failed
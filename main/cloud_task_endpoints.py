@@ -14,6 +14,7 @@ from chat.models import (
     MessageObjectTypes,
     Message,
 )
+from main import deadline
 from main.utils import generate_image
 from main.api import StreamAgentAPI
 from rest_framework.response import Response
@@ -52,7 +53,7 @@ def dummy_generate_video_task_view(request):
             return Response({"error": "MessageObject does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
         with TemporaryFile("w+b") as tmp_file:
-            with urlopen(DUMMY_VIDEO_URL) as response:
+            with urlopen(DUMMY_VIDEO_URL, timeout=deadline.timeout(settings.REQUESTS_TIMEOUT)) as response:
                 tmp_file.write(response.read())
             filename = f"stage_video_{ai_msg_obj.pk}.mp4" if settings.DEBUG else f"video_{ai_msg_obj.pk}.mp4"
             ai_msg_obj.file.save(filename, File(tmp_file), save=False)
@@ -90,7 +91,7 @@ def dummy_generate_image_task_view(request):
             return Response({"error": "MessageObject does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
         with TemporaryFile("w+b") as tmp_file:
-            with urlopen(DUMMY_IMAGE_URL) as response:
+            with urlopen(DUMMY_IMAGE_URL, timeout=deadline.timeout(settings.REQUESTS_TIMEOUT)) as response:
                 tmp_file.write(response.read())
             filename = f"stage_image_{ai_msg_obj.pk}.webp" if settings.DEBUG else f"image_{ai_msg_obj.pk}.webp"
             ai_msg_obj.file.save(filename, File(tmp_file), save=False)
@@ -172,7 +173,8 @@ def generate_video_task_view(request):
                 },
             }
             headers = {"Content-Type": "application/json", "xi-api-key": settings.ELEVENLABS_KEY}
-            response = requests.post(audio_url, json=payload, headers=headers, timeout=settings.REQUESTS_TIMEOUT, stream=True)
+            response = requests.post(audio_url, json=payload, headers=headers,
+                                     timeout=deadline.timeout(settings.REQUESTS_TIMEOUT), stream=True)
 
             if response.status_code != 200:
                 logging.warning(f"{exc_msg} ElevenLabs returned status_code={response.status_code}")
@@ -182,6 +184,7 @@ def generate_video_task_view(request):
             filename = f"stage_audio_{msg_obj_id}.mp3" if settings.DEBUG else f"audio_{msg_obj_id}.mp3"
             with TemporaryFile("w+b") as tmp_file:
                 for chunk in response.iter_content(1024):
+                    deadline.check()
                     tmp_file.write(chunk)
                 ai_msg_obj.file.save(filename, File(tmp_file), save=False)
                 ai_msg_obj.status = MessageObjectStatuses.AUDIO_READY
@@ -197,7 +200,8 @@ def generate_video_task_view(request):
             "webhookUrl": WEBHOOK_URL
         }
         headers = {"x-api-key": settings.SYNCLAB_KEY, "Content-Type": "application/json"}
-        response = requests.post(video_url, json=payload, headers=headers, timeout=settings.REQUESTS_TIMEOUT)
+        response = requests.post(video_url, json=payload, headers=headers,
+                                 timeout=deadline.timeout(settings.REQUESTS_TIMEOUT))
 
         if response.status_code != 201:
             logging.warning(f"{exc_msg} SyncLab returned status_code={response.status_code}")
@@ -274,7 +278,7 @@ def generate_image_task_view(request):
             return Response({"error": "Failed to generate image"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         with TemporaryFile("w+b") as tmp_file:
-            with urlopen(images[0].url) as response:
+            with urlopen(images[0].url, timeout=deadline.timeout(settings.REQUESTS_TIMEOUT)) as response:
                 tmp_file.write(response.read())
             filename = f"stage_image_{ai_msg_obj.pk}.jpeg" if settings.DEBUG else f"image_{ai_msg_obj.pk}.jpeg"
             ai_msg_obj.file.save(filename, File(tmp_file), save=False)
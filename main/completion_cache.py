@@ -0,0 +1,214 @@
+"""
+Opt-in cache for deterministic (`temperature=0`, non-streamed) chat completions.
+
+Entries are keyed by a hash of the model, messages and response format. The storage is
+pluggable through `settings.COMPLETION_CACHE["BACKEND"]`:
+    - `LocMemCacheBackend`: per-process LRU dictionary;
+    - `FileCacheBackend`: one file per entry in `OPTIONS["location"]`, shared by the workers of a host;
+    - `DjangoCacheBackend`: any Django cache from `settings.CACHES` (`OPTIONS["alias"]`).
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from openai.types.chat import ChatCompletion
+
+from main import metrics
+
+
+class BaseCacheBackend(ABC):
+    """Stores serialized completions for `ttl` seconds, evicting the least recently used ones."""
+
+    def __init__(self, max_entries: int = 1024, **kwargs) -> None:
+        self.max_entries = max_entries
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Returns the stored value or None if it is missing or expired."""
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: int) -> None:
+        """Stores the value for `ttl` seconds."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Removes the value, if any."""
+
+
+class LocMemCacheBackend(BaseCacheBackend):
+    def __init__(self, max_entries: int = 1024, **kwargs) -> None:
+        super().__init__(max_entries, **kwargs)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class FileCacheBackend(BaseCacheBackend):
+    """Files are touched on read, so the modification time orders them for LRU eviction."""
+
+    def __init__(self, max_entries: int = 1024, location: str = "/tmp/ai_completion_cache", **kwargs) -> None:
+        super().__init__(max_entries, **kwargs)
+        self.location = location
+        os.makedirs(location, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.location, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires"] < time.time():
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def set(self, key, value, ttl):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"expires": time.time() + ttl, "value": value}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def _evict(self):
+        with os.scandir(self.location) as it:
+            entries = [entry for entry in it if entry.name.endswith(".json")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class DjangoCacheBackend(BaseCacheBackend):
+    """Eviction is left to the Django cache itself (`MAX_ENTRIES`, Redis/Memcached policies)."""
+
+    def __init__(self, max_entries: int = 1024, alias: str = "default", **kwargs) -> None:
+        super().__init__(max_entries, **kwargs)
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(f"completion:{key}")
+
+    def set(self, key, value, ttl):
+        self.cache.set(f"completion:{key}", value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(f"completion:{key}")
+
+
+class CompletionCache:
+    """
+        Completion cache with hit/miss counters, also exported as `metrics.completion_cache_lookups`.
+        Backend errors are logged and treated as misses, as are entries that are not a valid completion
+        (corrupt, or from an older schema), which are removed.
+    """
+
+    def __init__(self, backend: BaseCacheBackend, ttl: int) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, messages: Any, response_format: Any) -> str:
+        payload = json.dumps([model, messages, response_format], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logging.exception(e)
+            value = None
+        completion = None
+        result = "miss"
+        if value is not None:
+            try:
+                completion = ChatCompletion.model_validate_json(value)
+                result = "hit"
+            except (ValueError, TypeError) as e:  # pydantic's ValidationError is a ValueError
+                logging.warning("Completion cache: dropping the invalid entry %s. %s", key, e)
+                self.delete(key)
+                result = "invalid"
+        with self._lock:
+            if completion is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.completion_cache_lookups.inc(result=result)
+        return completion
+
+    def delete(self, key: str) -> None:
+        try:
+            self.backend.delete(key)
+        except Exception as e:
+            logging.exception(e)
+
+    def set(self, key: str, completion: ChatCompletion) -> None:
+        try:
+            self.backend.set(key, completion.model_dump_json(), self.ttl)
+        except Exception as e:
+            logging.exception(e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+@lru_cache(maxsize=1)
+def get_completion_cache() -> CompletionCache:
+    config = settings.COMPLETION_CACHE
+    backend_class = import_string(config["BACKEND"])
+    return CompletionCache(backend_class(**config.get("OPTIONS", {})), config.get("TTL", 3600))
@@ -0,0 +1,155 @@
+"""
+Token-budgeted chat context.
+
+The newest turns are sent to the model as they are. Once they no longer fit into
+`settings.CONTEXT_TOKEN_BUDGET`, the oldest ones are dropped from the prompt and folded into a
+rolling summary that is persisted on the owner (`Chat` or `UserInterviewPrep`) and only extended
+with turns that were not summarized yet. Folding takes an LLM call, so it is done in the
+background once the answer is generated (see `BaseAPI.summarize_context`): the prompt is built
+from the summary there is and the newest turns that fit, the next request uses the new summary.
+"""
+import logging
+from functools import lru_cache
+from typing import Any, List, NamedTuple
+
+from django.conf import settings
+from django.db import models
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+
+from main.utils import generate_chat_completion
+
+# Rough price of an image in a prompt (1024x1024, high detail).
+IMAGE_TOKENS = 765
+# Every message is wrapped with a few service tokens.
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Extend the current summary with the new messages. Keep every fact, name, number and decision "
+    "that may matter later, drop small talk. Reply with the updated summary only."
+)
+
+
+class Turn(NamedTuple):
+    """A single history message. `pk` is used to remember which turns are already summarized."""
+    pk: int
+    role: str
+    content: Any
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken  # pylint: disable=import-outside-toplevel
+        try:
+            return tiktoken.encoding_for_model(settings.GPT_MODEL_ENGINE or "")
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # tiktoken missing or its BPE files can't be downloaded
+        logging.warning("context_window: tokenizer is not available, estimating tokens. %s", e)
+        return None
+
+
+def count_text_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(content: Any) -> int:
+    """Counts tokens of a message content, which is either a string or a list of content parts."""
+    if isinstance(content, str):
+        return count_text_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content or []:
+        if part.get("type") == "text":
+            tokens += count_text_tokens(part.get("text", ""))
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def content_to_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content or [] if part.get("type") == "text")
+
+
+class ContextWindow:
+    """
+        Fits chat history into a token budget.
+
+        `owner` must have `context_summary` and `context_summary_until` fields.
+        Turns with `pk <= owner.context_summary_until` are represented by the summary only.
+        When the rest exceeds the budget, the oldest of them are dropped until the remaining turns
+        take at most `CONTEXT_SUMMARY_TARGET` of the budget, so the summary is extended once per
+        several turns instead of on every request. The dropped turns are kept in `.dropped`, to be
+        folded into the summary with `.extend_summary` off the request path.
+        The newest turn is always kept as is.
+    """
+    dropped: List[Turn]
+
+    def __init__(self, owner: models.Model, budget: int = None, target: float = None) -> None:
+        self.owner = owner
+        self.budget = settings.CONTEXT_TOKEN_BUDGET if budget is None else budget
+        self.target = settings.CONTEXT_SUMMARY_TARGET if target is None else target
+        self.dropped = []
+
+    def fit(self, turns: List[Turn]) -> List[ChatCompletionMessageParam]:
+        until = self.owner.context_summary_until  # type: ignore
+        if until is not None:
+            turns = [turn for turn in turns if turn.pk > until]
+        costs = [count_tokens(turn.content) for turn in turns]
+        if turns and sum(costs) > self.budget:
+            start = len(turns) - 1
+            used = costs[start]
+            while start > 0 and used + costs[start - 1] <= self.budget * self.target:
+                start -= 1
+                used += costs[start]
+            self.dropped = turns[:start]
+            turns = turns[start:]
+
+        messages: List[ChatCompletionMessageParam] = []
+        if summary := self.owner.context_summary:  # type: ignore
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary}",
+            })
+        messages.extend({"role": turn.role, "content": turn.content} for turn in turns)  # type: ignore
+        return messages
+
+    def extend_summary(self, turns: List[Turn]) -> None:
+        """
+            Folds `turns` into the owner's summary and persists it. On errors the turns are just dropped.
+            The summary is only saved if no other request extended it in the meantime.
+        """
+        if not turns:
+            return
+        until = self.owner.context_summary_until  # type: ignore
+        lines = [
+            f"{'User' if turn.role == 'user' else 'Assistant'}: {content_to_text(turn.content)}"
+            for turn in turns
+        ]
+        messages: List[ChatCompletionMessageParam] = [
+            {
+                "role": "system",
+                "content": SUMMARY_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": f"Current summary:\n{self.owner.context_summary or '-'}\n\nNew messages:\n" + "\n".join(lines),  # type: ignore
+            }
+        ]
+        try:
+            response = generate_chat_completion(messages, call_site="summary")
+            assert isinstance(response, ChatCompletion)
+            summary = response.choices[0].message.content or ""
+        except Exception as e:
+            logging.exception(e)
+            return
+        self.owner.context_summary = summary  # type: ignore
+        self.owner.context_summary_until = turns[-1].pk  # type: ignore
+        type(self.owner).objects.filter(pk=self.owner.pk, context_summary_until=until).update(
+            context_summary=summary,
+            context_summary_until=turns[-1].pk,
+        )
@@ -0,0 +1,76 @@
+"""
+Request-scoped deadlines.
+
+`deadline_middleware` gives every request a deadline: `REQUEST_DEADLINE`
+seconds for API requests, `CLOUD_TASK_DEADLINE` (their dispatch deadline) for Cloud Tasks. Code
+running inside the request, including threads started with a copy of its context (e.g. hedged
+LLM calls), sees the same deadline:
+    - downstream calls get only the remaining time, e.g. `requests.get(..., timeout=timeout(10))`;
+    - `check()` raises `DeadlineExceeded` (504) once the deadline passed, so no more work is
+      started for a caller that has given up.
+Streams outlive their request and are not bounded, they end when their clients leave.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+
+from custom.custom_exceptions import DeadlineExceeded
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """Work inside the block must finish within `seconds`, or by the enclosing deadline if that is earlier."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left until the deadline, None without a deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check() -> None:
+    """Raises `DeadlineExceeded` if the deadline passed."""
+    if expired():
+        raise DeadlineExceeded()
+
+
+def timeout(default: float) -> float:
+    """Timeout for a downstream call: `default` capped by the remaining time. Raises `DeadlineExceeded` if none is left."""
+    check()
+    left = remaining()
+    return default if left is None else min(default, left)
+
+
+CLOUD_TASKS_PATH = "/cloud_tasks/"
+
+
+def deadline_middleware(get_response):
+    """
+        Sets the deadline of the request. Cloud Tasks get their dispatch deadline, only on their handlers:
+        any client can send the `X-CloudTasks-TaskName` header.
+    """
+    def middleware(request):
+        if request.path_info.startswith(CLOUD_TASKS_PATH) and "X-CloudTasks-TaskName" in request.headers:
+            seconds = settings.CLOUD_TASK_DEADLINE
+        else:
+            seconds = settings.REQUEST_DEADLINE
+        with deadline_scope(seconds):
+            return get_response(request)
+    return middleware
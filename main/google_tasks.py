@@ -60,7 +60,7 @@ def create_generate_image_task(user_msg_id: int, msg_obj_id: int):
             },
             "body": json.dumps(payload).encode(),
         },
-        "dispatch_deadline": {"seconds": 30 * 60}
+        "dispatch_deadline": {"seconds": settings.CLOUD_TASK_DEADLINE}
     }
 
     response = client.create_task(request={"parent": parent, "task": task})
@@ -101,7 +101,7 @@ def create_generate_video_task(user_msg_id: int, msg_obj_id: int, avatar_id: int
             },
             "body": json.dumps(payload).encode(),
         },
-        "dispatch_deadline": {"seconds": 30 * 60}
+        "dispatch_deadline": {"seconds": settings.CLOUD_TASK_DEADLINE}
     }
 
     response = client.create_task(request={"parent": parent, "task": task})
@@ -139,7 +139,7 @@ def create_dummy_image_task(msg_obj_id: int):
             },
             "body": json.dumps(payload).encode(),
         },
-        "dispatch_deadline": {"seconds": 30 * 60}
+        "dispatch_deadline": {"seconds": settings.CLOUD_TASK_DEADLINE}
     }
 
     response = client.create_task(request={"parent": parent, "task": task})
@@ -177,7 +177,7 @@ def create_dummy_video_task(msg_obj_id: int):
             },
             "body": json.dumps(payload).encode(),
         },
-        "dispatch_deadline": {"seconds": 30 * 60}
+        "dispatch_deadline": {"seconds": settings.CLOUD_TASK_DEADLINE}
     }
 
     response = client.create_task(request={"parent": parent, "task": task})
@@ -0,0 +1,326 @@
+"""
+Global and per-user limits for LLM calls.
+
+A call is admitted when both the global and the user's token bucket have a token and
+neither the global nor the user's number of calls in flight is at its maximum
+(`settings.LLM_LIMITS`). Other calls wait in a short queue that is served round-robin per
+user, so one user with many requests does not delay everybody else. A call that finds the
+queue full, or waits longer than `QUEUE_TIMEOUT`, is rejected with `TooManyRequests` (429).
+
+Streams are admitted in the views through `queued_stream`/`aqueued_stream`, which send
+`queued` events with the position while waiting. Non-streamed calls are admitted in
+`main.utils` for the user set with `user_scope`, or against the global limits only.
+The auxiliary calls of a stream (its title, its context summary) are made under the stream's
+own ticket while it is held (`stream_scope`): waiting for a second slot while holding one
+would deadlock once all slots are taken by streams.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from custom.custom_exceptions import TooManyRequests
+from main import deadline
+from main.sse import STOP_FRAME, format_event, format_frame
+
+RATE_LIMITED = "Too many requests at the moment, please try again in a minute."
+
+_user: ContextVar[Optional[str]] = ContextVar("llm_user", default=None)
+_stream_ticket: ContextVar[Optional["Ticket"]] = ContextVar("llm_stream_ticket", default=None)
+
+
+@contextmanager
+def user_scope(user_id: Any):
+    """Counts the LLM calls made inside the block against the quota of `user_id`."""
+    token = _user.set(str(user_id))
+    try:
+        yield
+    finally:
+        _user.reset(token)
+
+
+def current_user() -> Optional[str]:
+    return _user.get()
+
+
+@contextmanager
+def stream_scope(ticket: Optional["Ticket"]):
+    """Runs the LLM calls made inside the block under the slot of the stream's `ticket`, as long as it is held."""
+    token = _stream_ticket.set(ticket)
+    try:
+        yield
+    finally:
+        _stream_ticket.reset(token)
+
+
+def current_stream_ticket() -> Optional["Ticket"]:
+    return _stream_ticket.get()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class Ticket:
+    """A call waiting for or holding a slot. Releasing it frees the slot or leaves the queue."""
+
+    def __init__(self, limiter: "Limiter", user: Optional[str]) -> None:
+        self.limiter = limiter
+        self.user = user
+        self.admitted = False
+        self.released = False
+        self.created = time.monotonic()
+
+    @property
+    def position(self) -> int:
+        """1-based position in the queue, 0 once admitted."""
+        return self.limiter.position(self)
+
+    def release(self) -> None:
+        self.limiter.release(self)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class Limiter:
+    POLL_INTERVAL = 0.05
+    # idle users' buckets are pruned once there are this many
+    MAX_BUCKETS = 1024
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._user_in_flight: Dict[Optional[str], int] = defaultdict(int)
+        self._bucket = TokenBucket(config["GLOBAL_RATE"], config["GLOBAL_BURST"])
+        self._user_buckets: Dict[str, TokenBucket] = {}
+        self._queues: "OrderedDict[Optional[str], Deque[Ticket]]" = OrderedDict()
+
+    def _user_bucket(self, user: str) -> TokenBucket:
+        if user not in self._user_buckets:
+            if len(self._user_buckets) >= self.MAX_BUCKETS:
+                self._prune()
+            self._user_buckets[user] = TokenBucket(self.config["USER_RATE"], self.config["USER_BURST"])
+        return self._user_buckets[user]
+
+    def _prune(self) -> None:
+        """Drops the buckets of idle users that are full again, they are the same as new ones."""
+        for user, bucket in list(self._user_buckets.items()):
+            if user in self._user_in_flight or user in self._queues:
+                continue
+            bucket.available()
+            if bucket.tokens >= bucket.capacity:
+                del self._user_buckets[user]
+
+    def _user_allows(self, user: Optional[str]) -> bool:
+        if user is None:
+            return True
+        return (
+            self._user_in_flight.get(user, 0) < self.config["USER_MAX_IN_FLIGHT"]
+            and self._user_bucket(user).available()
+        )
+
+    def _global_allows(self) -> bool:
+        return self._in_flight < self.config["GLOBAL_MAX_IN_FLIGHT"] and self._bucket.available()
+
+    def _users(self) -> List[Optional[str]]:
+        """Users with queued calls, those with fewer calls in flight first, round-robin otherwise."""
+        return sorted(self._queues, key=lambda user: self._user_in_flight.get(user, 0))
+
+    def _order(self) -> List[Ticket]:
+        """Queued tickets in the order they are served."""
+        order = []
+        queues = [list(self._queues[user]) for user in self._users()]
+        for i in range(max(map(len, queues), default=0)):
+            order.extend(queue[i] for queue in queues if i < len(queue))
+        return order
+
+    def _admit(self) -> None:
+        """Admits queued tickets in order. Must be called with the lock held."""
+        for user in self._users():
+            if not self._global_allows():
+                return
+            if not self._user_allows(user):
+                continue
+            queue = self._queues.pop(user)
+            ticket = queue.popleft()
+            ticket.admitted = True
+            self._in_flight += 1
+            self._user_in_flight[user] += 1
+            self._bucket.take()
+            if user is not None:
+                self._user_bucket(user).take()
+            # the user goes to the end of the round
+            if queue:
+                self._queues[user] = queue
+
+    def _remove(self, ticket: Ticket) -> None:
+        queue = self._queues.get(ticket.user)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user]
+
+    def enqueue(self, user: Optional[str] = None) -> Ticket:
+        """Queues a call and admits it right away if the limits allow. Raises `TooManyRequests` if the queue is full."""
+        with self._condition:
+            queued = sum(map(len, self._queues.values()))
+            user_queued = len(self._queues.get(user, ()))
+            if queued >= self.config["QUEUE_SIZE"] or (user is not None and user_queued >= self.config["USER_QUEUE_SIZE"]):
+                raise TooManyRequests()
+            ticket = Ticket(self, user)
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._admit()
+            return ticket
+
+    def load(self) -> int:
+        """Calls in flight and queued."""
+        with self._condition:
+            return self._in_flight + sum(map(len, self._queues.values()))
+
+    def position(self, ticket: Ticket) -> int:
+        with self._condition:
+            if ticket.admitted:
+                return 0
+            order = self._order()
+            return order.index(ticket) + 1 if ticket in order else 0
+
+    def poll(self, ticket: Ticket) -> bool:
+        """Tries to admit queued calls. Returns True once `ticket` is admitted."""
+        with self._condition:
+            if not ticket.admitted:
+                self._admit()
+            return ticket.admitted
+
+    def expired(self, ticket: Ticket) -> bool:
+        return time.monotonic() - ticket.created >= self.config["QUEUE_TIMEOUT"]
+
+    def release(self, ticket: Ticket) -> None:
+        with self._condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._in_flight -= 1
+                self._user_in_flight[ticket.user] -= 1
+                if not self._user_in_flight[ticket.user]:
+                    del self._user_in_flight[ticket.user]
+            else:
+                self._remove(ticket)
+            self._admit()
+            self._condition.notify_all()
+
+    def admit(self, user: Optional[str] = None) -> AbstractContextManager:
+        """
+            `.acquire`, unless the call is made for a stream whose ticket is still held (see `stream_scope`):
+            then it runs under that ticket.
+        """
+        ticket = _stream_ticket.get()
+        if ticket is not None and ticket.admitted and not ticket.released:
+            return nullcontext()
+        return self.acquire(user)
+
+    def acquire(self, user: Optional[str] = None) -> Ticket:
+        """
+            Blocks until the call is admitted. Raises `TooManyRequests` if the queue is full or the wait
+            is too long, `DeadlineExceeded` if the deadline of the request passes meanwhile.
+        """
+        ticket = self.enqueue(user)
+        with self._condition:
+            while not ticket.admitted:
+                if self.expired(ticket) or deadline.expired():
+                    self._remove(ticket)
+                    deadline.check()
+                    raise TooManyRequests()
+                self._condition.wait(self.POLL_INTERVAL)
+                self._admit()
+        return ticket
+
+    def check_rate(self, user: Optional[str] = None) -> None:
+        """Takes a token for a call that is not tracked in flight (e.g. a queued Cloud Task). Raises `TooManyRequests`."""
+        with self._condition:
+            if not self._bucket.available() or (user is not None and not self._user_bucket(user).available()):
+                raise TooManyRequests()
+            self._bucket.take()
+            if user is not None:
+                self._user_bucket(user).take()
+
+
+limiter = Limiter(settings.LLM_LIMITS)
+
+
+def queued_stream(ticket: Ticket, start: Callable[[], Iterator[bytes]]) -> Iterator[bytes]:
+    """
+        Sends `queued` events with the position of `ticket` until it is admitted, then the frames
+        of `start()`. The slot is released when the stream ends or is closed.
+    """
+    try:
+        position = None
+        while not limiter.poll(ticket):
+            if limiter.expired(ticket):
+                yield format_frame(RATE_LIMITED)
+                yield STOP_FRAME
+                return
+            if (current := ticket.position) != position:
+                position = current
+                yield format_event("queued", str(position))
+            time.sleep(Limiter.POLL_INTERVAL)
+        with stream_scope(ticket):
+            stream = start()
+        yield from stream
+    finally:
+        ticket.release()
+
+
+async def aqueued_stream(ticket: Ticket, start: Callable[[], Any]) -> AsyncIterator[bytes]:
+    """
+        Async counterpart of `queued_stream`. `start` is synchronous and returns an async generator,
+        which is closed (closing the upstream completion) before the slot is released.
+    """
+    try:
+        position = None
+        while not limiter.poll(ticket):
+            if limiter.expired(ticket):
+                yield format_frame(RATE_LIMITED)
+                yield STOP_FRAME
+                return
+            if (current := ticket.position) != position:
+                position = current
+                yield format_event("queued", str(position))
+            await asyncio.sleep(Limiter.POLL_INTERVAL)
+        with stream_scope(ticket):
+            stream = await sync_to_async(start)()
+        try:
+            async for frame in stream:
+                yield frame
+        finally:
+            # unlike `yield from`, `async for` does not close the stream when this one is closed
+            await stream.aclose()
+    finally:
+        ticket.release()
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from main.base_api import BaseGenerationAPI
+from main.providers import FakeProvider
+
+MESSAGES = [{"role": "user", "content": "bench"}]
+
+
+def fake_provider(tokens: int, token_delay: float) -> FakeProvider:
+    """Fake provider with a fixed delay per token."""
+    return FakeProvider(first_token_latency=token_delay, tokens_per_second=1 / token_delay, tokens=tokens)
+
+
+class BenchGenerationAPI(BaseGenerationAPI):
+    """Generation API that does not touch the database."""
+
+    def get_system_prompt(self, *args, **kwargs):
+        return ""
+
+    def get_user_prompt(self, *args, **kwargs):
+        return ""
+
+
+class Gauge:
+    """Tracks the number of simultaneously open streams and what they sent."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def inc(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def dec(self, frames, size):
+        with self.lock:
+            self.current -= 1
+            self.frames += frames
+            self.bytes += size
+
+
+class Command(BaseCommand):
+    help = "Compares how many SSE streams a single worker holds open in sync (WSGI) and async (ASGI) modes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--streams", type=int, default=200, help="Number of concurrent clients.")
+        parser.add_argument("--tokens", type=int, default=50, help="Tokens per completion.")
+        parser.add_argument("--token-delay", type=float, default=0.02, help="Seconds between upstream tokens.")
+        parser.add_argument("--threads", type=int, default=4,
+                            help="Threads per sync worker (gunicorn --threads).")
+
+    def handle(self, *args, **options):
+        streams, tokens, delay = options["streams"], options["tokens"], options["token_delay"]
+        threads = options["threads"]
+        sync = self.bench_sync(streams, tokens, delay, threads)
+        async_ = asyncio.run(self.bench_async(streams, tokens, delay))
+        self.stdout.write(
+            f"{'mode':<6} {'streams':>8} {'peak open':>10} {'wall, s':>9} {'streams/s':>10}"
+            f" {'frames/stream':>14} {'bytes/stream':>13}")
+        for mode, (gauge, wall) in (("sync", sync), ("async", async_)):
+            self.stdout.write(
+                f"{mode:<6} {streams:>8} {gauge.peak:>10} {wall:>9.2f} {streams / wall:>10.1f}"
+                f" {gauge.frames / streams:>14.1f} {gauge.bytes / streams:>13.1f}")
+
+    def bench_sync(self, streams, tokens, delay, threads):
+        gauge = Gauge()
+        provider = fake_provider(tokens, delay)
+
+        def consume(_):
+            gauge.inc()
+            frames = size = 0
+            try:
+                for frame in BenchGenerationAPI()._text_stream(
+                        provider.chat_completion("fake", MESSAGES, 0, True, {"type": "text"}, None)):
+                    frames += 1
+                    size += len(frame)
+            finally:
+                gauge.dec(frames, size)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(consume, range(streams)))
+        return gauge, time.perf_counter() - start
+
+    async def bench_async(self, streams, tokens, delay):
+        gauge = Gauge()
+        provider = fake_provider(tokens, delay)
+
+        async def consume():
+            gauge.inc()
+            frames = size = 0
+            try:
+                async for frame in BenchGenerationAPI()._atext_stream(
+                        provider.achat_completion("fake", MESSAGES, 0, True, {"type": "text"}, None)):
+                    frames += 1
+                    size += len(frame)
+            finally:
+                gauge.dec(frames, size)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(consume() for _ in range(streams)))
+        return gauge, time.perf_counter() - start
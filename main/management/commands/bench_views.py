@@ -0,0 +1,393 @@
+import asyncio
+import json
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.models import Chat, MessageObjectTypes
+from interview_prep.models import InterviewPrep, UserInterviewPrep
+from main.context_window import count_text_tokens
+from main.models import Agent, AgentTypes
+from main.providers import get_provider
+from main.sse import HEARTBEAT_FRAME, STOP_FRAME
+
+STREAM_ENDPOINTS = ("stream", "question")
+ENDPOINTS = STREAM_ENDPOINTS + ("messages_list",)
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "mean": statistics.mean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values) if values else None,
+    }
+
+
+def split_frames(parts) -> Iterator[bytes]:
+    """Splits response body parts into SSE frames."""
+    buffer = b""
+    for part in parts:
+        buffer += part
+        while b"\n\n" in buffer:
+            frame, buffer = buffer.split(b"\n\n", 1)
+            yield frame + b"\n\n"
+
+
+def is_content_frame(frame: bytes) -> bool:
+    """Data frames with answer text, i.e. not events (`queued`, `title`), heartbeats or the stop frame."""
+    return frame not in (HEARTBEAT_FRAME, STOP_FRAME) and not frame.startswith(b"event:")
+
+
+def frame_text(frame: bytes) -> str:
+    return "".join(
+        line[len("data: "):] for line in frame.decode().split("\n") if line.startswith("data: "))
+
+
+class StreamTiming:
+    """Timings of a single request, measured from sending it."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.status: Optional[int] = None
+        self.ttft: Optional[float] = None
+        self.gaps: List[float] = []
+        self.total: Optional[float] = None
+        self.tokens = 0
+        self.frames = 0
+        self._last: Optional[float] = None
+
+    def frame(self, frame: bytes) -> None:
+        now = time.perf_counter()
+        self.frames += 1
+        if not is_content_frame(frame):
+            return
+        if self.ttft is None:
+            self.ttft = now - self.started
+        else:
+            self.gaps.append(now - self._last)
+        self._last = now
+        self.tokens += count_text_tokens(frame_text(frame))
+
+    def finish(self, status: int) -> None:
+        self.status = status
+        self.total = time.perf_counter() - self.started
+
+    @property
+    def ok(self) -> bool:
+        # streams must send some answer, other responses have no frames
+        return self.status == 200 and (self.ttft is not None or not self.frames)
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.ttft is None or self.total is None or self.total <= self.ttft:
+            return None
+        return self.tokens / (self.total - self.ttft)
+
+
+class Gauge:
+    """Tracks the number of simultaneously open requests."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self) -> "Gauge":
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        with self.lock:
+            self.current -= 1
+
+
+class BenchUser:
+    """A simulated client with its own chat and interview."""
+
+    def __init__(self, index: int, agent: Agent, interview: InterviewPrep, history: int) -> None:
+        self.id = f"bench-{index}"
+        self.email = f"{self.id}@example.com"
+        self.chat = Chat.objects.create(user_id=self.id, user_email=self.email)
+        for i in range(history):
+            self._add_message(agent, f"question {i}")
+            answer = self.chat.messages.create(agent=agent, is_answer=True)
+            answer.objs.create(content_type=MessageObjectTypes.TEXT, content=f"answer {i}")
+        self.agent = agent
+        self.message = self._add_message(agent, "How do I prepare for an interview?")
+        self.user_interview = UserInterviewPrep.objects.create(
+            interview=interview, user_id=self.id, user_email=self.email)
+        token = AccessToken()
+        token["user_id"] = self.id
+        token["email"] = self.email
+        token["subscriptions"] = [{
+            "expires": (timezone.now() + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"),
+        }]
+        self.authorization = f"Bearer {token}"
+
+    def _add_message(self, agent: Agent, text: str):
+        message = self.chat.messages.create(agent=agent, parameters={})
+        message.objs.create(content_type=MessageObjectTypes.TEXT, content=text)
+        return message
+
+    def path(self, endpoint: str) -> str:
+        if endpoint == "stream":
+            query = urlencode({"agent_id": self.agent.pk, "message_id": self.message.pk})
+            return f"/ai/{self.chat.pk}/stream/?{query}"
+        if endpoint == "question":
+            return f"/user_interview_prep/{self.user_interview.pk}/question/"
+        return f"/chats/{self.chat.pk}/messages/?{urlencode({'type': AgentTypes.TEXT})}"
+
+
+async def asgi_get(application, path: str, headers: List[Tuple[bytes, bytes]]) -> AsyncIterator[Any]:
+    """
+        Sends a GET request to an ASGI application, as an ASGI server would.
+        Yields the response status, then the body parts as they are sent.
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), *headers],
+        "client": ("127.0.0.1", 0),
+        "server": ("testserver", 80),
+    }
+    messages: asyncio.Queue = asyncio.Queue()
+    disconnected = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    app = asyncio.ensure_future(application(scope, receive, messages.put))
+    try:
+        while True:
+            getter = asyncio.ensure_future(messages.get())
+            await asyncio.wait([getter, app], return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                app.result()  # raises the application error, if any
+                return
+            message = getter.result()
+            if message["type"] == "http.response.start":
+                yield message["status"]
+            elif message["type"] == "http.response.body":
+                if message.get("body"):
+                    yield message["body"]
+                if not message.get("more_body"):
+                    return
+    finally:
+        disconnected.set()
+        await app
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the chat stream, interview question and messages list views end to end "
+        "against the in-process fake LLM provider, in a test database. Reports time to first "
+        "token, inter-token latency, total time, tokens per second and the peak number of "
+        "concurrent streams per worker as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=["sync", "asgi", "both"], default="both",
+                            help="Serve the views through the test client (WSGI) or the ASGI application.")
+        parser.add_argument("--clients", type=int, default=20, help="Concurrent clients, each with its own user.")
+        parser.add_argument("--requests", type=int, default=1, help="Sequential requests per client and view.")
+        parser.add_argument("--threads", type=int, default=8,
+                            help="Threads of the sync worker (gunicorn --threads).")
+        parser.add_argument("--history", type=int, default=10, help="Question/answer pairs in each chat.")
+        parser.add_argument("--first-token-latency", type=float, default=0.3,
+                            help="Seconds of the fake provider before the first token.")
+        parser.add_argument("--tokens-per-second", type=float, default=50,
+                            help="Token rate of the fake provider.")
+        parser.add_argument("--tokens", type=int, default=100, help="Tokens per fake answer.")
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+        parser.add_argument("--baseline",
+                            help="JSON results of an earlier run. Changes of the p50/p95 values are printed to stderr.")
+
+    def handle(self, *args, **options):
+        provider = {
+            "BACKEND": "main.providers.FakeProvider",
+            "OPTIONS": {
+                "first_token_latency": options["first_token_latency"],
+                "tokens_per_second": options["tokens_per_second"],
+                "tokens": options["tokens"],
+            },
+        }
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        # Cloud Tasks are outside of what is measured here
+        onboarding = mock.patch("main.views.create_update_user_onboarding_task")
+        try:
+            with override_settings(LLM_PROVIDER=provider), onboarding:
+                get_provider.cache_clear()
+                results = self.bench(options)
+        finally:
+            get_provider.cache_clear()
+            teardown_databases(old_config, verbosity=0)
+        report = {
+            "commit": self.get_commit(),
+            "options": {key: options[key] for key in (
+                "mode", "clients", "requests", "threads", "history",
+                "first_token_latency", "tokens_per_second", "tokens")},
+            "results": results,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                self.compare(json.load(file)["results"], results)
+
+    @staticmethod
+    def get_commit() -> Optional[str]:
+        try:
+            return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def bench(self, options) -> dict:
+        agent = Agent.objects.create(
+            type=AgentTypes.TEXT,
+            sys_template="You are a helpful career assistant.",
+            user_template="{main_field}",
+        )
+        interview = InterviewPrep.objects.create(
+            title="Bench", interview_sys_prompt="You are an interviewer.",
+            eval_sys_prompt="Evaluate the interview.", initial_message="Tell me about yourself.")
+        users = [BenchUser(i, agent, interview, options["history"]) for i in range(options["clients"])]
+        modes = ["sync", "asgi"] if options["mode"] == "both" else [options["mode"]]
+        results = {}
+        for mode in modes:
+            results[mode] = {}
+            for endpoint in ENDPOINTS:
+                if mode == "sync":
+                    timings, peak, wall = self.bench_sync(users, endpoint, options)
+                else:
+                    timings, peak, wall = asyncio.run(self.bench_asgi(users, endpoint, options))
+                results[mode][endpoint] = self.report(endpoint, timings, peak, wall)
+        return results
+
+    def bench_sync(self, users: List[BenchUser], endpoint: str, options) -> Tuple[List[StreamTiming], int, float]:
+        gauge = Gauge()
+        timings: List[StreamTiming] = []
+
+        def run(user: BenchUser):
+            client = Client(HTTP_AUTHORIZATION=user.authorization)
+            for _ in range(options["requests"]):
+                timing = StreamTiming()
+                with gauge:
+                    response = client.get(user.path(endpoint))
+                    if response.streaming:
+                        for frame in split_frames(response.streaming_content):
+                            timing.frame(frame)
+                        response.close()
+                timing.finish(response.status_code)
+                timings.append(timing)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+            list(executor.map(run, users))
+        return timings, gauge.peak, time.perf_counter() - start
+
+    async def bench_asgi(self, users: List[BenchUser], endpoint: str, options) -> Tuple[List[StreamTiming], int, float]:
+        from ai.asgi import application
+
+        gauge = Gauge()
+        timings: List[StreamTiming] = []
+
+        async def run(user: BenchUser):
+            headers = [(b"authorization", user.authorization.encode())]
+            for _ in range(options["requests"]):
+                timing = StreamTiming()
+                status = 0
+                buffer = b""
+                with gauge:
+                    async for part in asgi_get(application, user.path(endpoint), headers):
+                        if isinstance(part, int):
+                            status = part
+                            continue
+                        buffer += part
+                        while b"\n\n" in buffer:
+                            frame, buffer = buffer.split(b"\n\n", 1)
+                            timing.frame(frame + b"\n\n")
+                timing.finish(status)
+                timings.append(timing)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run(user) for user in users))
+        return timings, gauge.peak, time.perf_counter() - start
+
+    @staticmethod
+    def report(endpoint: str, timings: List[StreamTiming], peak: int, wall: float) -> dict:
+        ok = [timing for timing in timings if timing.ok]
+        report = {
+            "requests": len(timings),
+            "errors": len(timings) - len(ok),
+            "wall_seconds": wall,
+            "requests_per_second": len(timings) / wall if wall else None,
+            "peak_concurrent": peak,
+            "total_seconds": summarize([timing.total for timing in ok]),
+        }
+        if endpoint in STREAM_ENDPOINTS:
+            report.update({
+                "ttft_seconds": summarize([timing.ttft for timing in ok if timing.ttft is not None]),
+                "inter_token_seconds": summarize([gap for timing in ok for gap in timing.gaps]),
+                "tokens_per_second": summarize(
+                    [timing.tokens_per_second for timing in ok if timing.tokens_per_second is not None]),
+            })
+        return report
+
+    def compare(self, baseline: dict, results: dict) -> None:
+        for mode, endpoints in results.items():
+            for endpoint, report in endpoints.items():
+                before = baseline.get(mode, {}).get(endpoint)
+                if not before:
+                    continue
+                for metric, values in report.items():
+                    if not isinstance(values, dict) or not isinstance(before.get(metric), dict):
+                        continue
+                    for stat in ("p50", "p95"):
+                        old, new = before[metric].get(stat), values.get(stat)
+                        if old and new is not None:
+                            self.stderr.write(
+                                f"{mode:<5} {endpoint:<14} {metric:<20} {stat}: "
+                                f"{old:.4f} -> {new:.4f} ({(new - old) / old:+.1%})")
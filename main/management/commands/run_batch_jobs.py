@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main import batch
+from main.api import enqueue_chat_titles
+from main.models import BatchJob, BatchJobStatuses
+
+
+class Command(BaseCommand):
+    help = "Submits pending batch jobs and writes back the results of finished batches (see main.batch)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--untitled-chats", type=int, default=0,
+                            help="Enqueue title jobs for up to this many \"Untitled\" chats first.")
+        parser.add_argument("--wait", action="store_true",
+                            help="Poll until all submitted jobs are done (every BATCH_JOBS[\"POLL_INTERVAL\"] seconds).")
+
+    def handle(self, *args, **options):
+        if options["untitled_chats"]:
+            queued = enqueue_chat_titles(options["untitled_chats"])
+            self.stdout.write(f"Enqueued {queued} chat title jobs.")
+        submitted = batch.submit_pending()
+        self.stdout.write(f"Submitted {submitted} jobs.")
+        while True:
+            completed, failed = batch.collect_submitted()
+            self.stdout.write(f"Completed {completed} jobs, {failed} failed.")
+            running = BatchJob.objects.filter(status=BatchJobStatuses.SUBMITTED).count()
+            if not options["wait"] or not running:
+                break
+            self.stdout.write(f"Waiting for {running} jobs.")
+            time.sleep(settings.BATCH_JOBS["POLL_INTERVAL"])
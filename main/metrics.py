@@ -0,0 +1,258 @@
+"""
+In-process metrics of the generation APIs.
+
+Metrics are kept per process as plain counters, summaries and histograms labeled by keyword
+arguments, e.g. `stream_cancellations.inc(api="StreamAgentAPI")`. `exposition()` renders all of
+them in the Prometheus text format, served at `/metrics`. Every worker process has its own
+metrics, so each one has to be scraped (or the scrape aggregated per pod).
+"""
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+REGISTRY: List["Metric"] = []
+
+
+def _labels(labels: dict) -> LabelValues:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: LabelValues) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def expose(self) -> List[str]:
+        """Lines of the metric in the Prometheus text format."""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+
+
+class Counter(Metric):
+    """A monotonically increasing value."""
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def samples(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for labels, value in self.samples().items():
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Summary(Metric):
+    """Count and sum of observed values."""
+    TYPE = "summary"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: Dict[LabelValues, Tuple[int, float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0.0))
+            self._values[key] = (count + 1, total + value)
+
+    def mean(self, **labels) -> float:
+        with self._lock:
+            count, total = self._values.get(_labels(labels), (0, 0.0))
+        return total / count if count else 0.0
+
+    def samples(self) -> Dict[LabelValues, Tuple[int, float]]:
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for labels, (count, total) in self.samples().items():
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+        return lines
+
+
+class Gauge(Metric):
+    """A value that is set to the current state."""
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def samples(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for labels, value in self.samples().items():
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    """
+        Counts of observed values per bucket (upper bounds), with their count and sum.
+
+        `observe_many` adds the values collected by a caller at once, e.g. the gaps between the
+        tokens of a stream, so the lock is taken once per stream instead of once per token.
+    """
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        self.observe_many((value,), **labels)
+
+    def observe_many(self, values: Iterable[float], **labels) -> None:
+        key = _labels(labels)
+        counts = [0] * len(self.buckets)
+        total = 0.0
+        for value in values:
+            counts[bisect_left(self.buckets, value)] += 1
+            total += value
+        with self._lock:
+            bucket_counts, bucket_total = self._values.setdefault(key, ([0] * len(self.buckets), 0.0))
+            for i, count in enumerate(counts):
+                bucket_counts[i] += count
+            self._values[key] = (bucket_counts, bucket_total + total)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _ = self._values.get(_labels(labels), ([], 0.0))
+            return sum(counts)
+
+    def samples(self) -> Dict[LabelValues, Tuple[List[int], float]]:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        for labels, (counts, total) in self.samples().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels(labels + (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+        return lines
+
+
+def exposition() -> str:
+    """All metrics in the Prometheus text format."""
+    return "\n".join(line for metric in REGISTRY for line in metric.expose()) + "\n"
+
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60)
+GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+completion_tokens = Summary(
+    "ai_completion_tokens", "Tokens of the answers that were streamed to the end.")
+stream_cancellations = Counter(
+    "ai_stream_cancellations_total", "Streams whose upstream completion was closed after the client disconnected.")
+stream_tokens_saved = Counter(
+    "ai_stream_tokens_saved_total",
+    "Estimated completion tokens not generated thanks to cancellations "
+    "(mean length of finished answers minus the partial answer).")
+upstream_pool_wait_seconds = Summary(
+    "ai_upstream_pool_wait_seconds", "Time OpenAI requests waited for a pooled connection.")
+upstream_connect_seconds = Summary(
+    "ai_upstream_connect_seconds", "TCP connect and TLS handshake time of new OpenAI connections.")
+upstream_ttfb_seconds = Summary(
+    "ai_upstream_ttfb_seconds", "Time from sending an OpenAI request until its response headers arrived.")
+circuit_opened = Counter(
+    "ai_circuit_opened_total", "Times the circuit breaker of an LLM call site opened.")
+circuit_rejections = Counter(
+    "ai_circuit_rejections_total", "LLM calls rejected because the circuit of their call site was open.")
+hedged_requests = Counter(
+    "ai_hedged_requests_total", "Second requests sent to the fallback model because the first one was slow or failed.")
+hedge_wins = Counter(
+    "ai_hedge_wins_total", "Hedged requests that answered before the first one.")
+llm_concurrency_limit = Gauge(
+    "ai_llm_concurrency_limit", "Adaptive limit of LLM calls in flight or queued, over which new work is shed.")
+shed_requests = Counter(
+    "ai_shed_requests_total", "Requests whose LLM work was shed because the adaptive limit was reached.")
+stream_ttft_seconds = Histogram(
+    "ai_stream_ttft_seconds",
+    "Time from starting a generation (building the context included) until its first token was sent.",
+    LATENCY_BUCKETS)
+stream_inter_token_seconds = Histogram(
+    "ai_stream_inter_token_seconds", "Gaps between the completion chunks of a stream.", GAP_BUCKETS)
+stream_output_tokens = Histogram(
+    "ai_stream_output_tokens", "Completion tokens sent per stream.", TOKEN_BUCKETS)
+stream_duration_seconds = Histogram(
+    "ai_stream_duration_seconds", "Time from starting a generation until its stream ended.", LATENCY_BUCKETS)
+streams_ended = Counter(
+    "ai_streams_total",
+    "Ended streams by reason: completed, length, content_filter, client_disconnect, upstream_error "
+    "or unavailable (the completion could not be started).")
+llm_calls = Counter(
+    "ai_llm_calls_total", "LLM calls by call site and the model they were routed to (see main.routing).")
+llm_latency_seconds = Summary(
+    "ai_llm_latency_seconds", "Latency of LLM calls (to the first token for streams) by call site and model.")
+llm_cost_usd = Counter(
+    "ai_llm_cost_usd_total", "Estimated cost of LLM calls by call site and model.")
+llm_cost_saved_usd = Counter(
+    "ai_llm_cost_saved_usd_total",
+    "Estimated cost saved by routing calls away from the default model (its price minus the routed model's).")
+llm_latency_saved_seconds = Counter(
+    "ai_llm_latency_saved_seconds_total",
+    "Estimated latency saved by routing calls away from the default model "
+    "(its mean latency at the call site minus the routed call's).")
+batch_jobs = Counter(
+    "ai_batch_jobs_total", "Batch jobs (see main.batch) by kind and status: completed or failed.")
+completion_cache_lookups = Counter(
+    "ai_completion_cache_lookups_total",
+    "Lookups of the completion cache (see main.completion_cache) by result: hit, miss or invalid "
+    "(an entry that is not a valid completion, removed and answered as a miss).")
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='template_version',
+            field=models.PositiveIntegerField(default=1, verbose_name='User prompt template version'),
+        ),
+    ]
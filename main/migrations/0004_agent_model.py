@@ -0,0 +1,18 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_agent_template_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='model',
+            field=models.CharField(blank=True, help_text="LLM of the agent's answers. Leave empty to route by settings.LLM_ROUTES.", max_length=100, verbose_name='Model'),
+        ),
+    ]
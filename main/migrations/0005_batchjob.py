@@ -0,0 +1,38 @@
+# Generated by Django 3.2.6 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_agent_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('chat_title', 'Chat title'), ('interview_evaluation', 'Interview evaluation')], max_length=25, verbose_name='Kind')),
+                ('target_id', models.CharField(max_length=255, verbose_name='Target ID')),
+                ('call_site', models.CharField(max_length=50, verbose_name='Call site')),
+                ('model', models.CharField(max_length=100, verbose_name='Model')),
+                ('request', models.JSONField(verbose_name='Request')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('submitted', 'Submitted'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20, verbose_name='Status')),
+                ('batch_id', models.CharField(blank=True, default='', max_length=255, verbose_name='Batch ID')),
+                ('result', models.TextField(blank=True, default='', verbose_name='Result')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Error')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date created')),
+                ('date_completed', models.DateTimeField(blank=True, null=True, verbose_name='Date completed')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='batchjob',
+            index=models.Index(fields=['status', 'date_created'], name='batch-job--status-index'),
+        ),
+        migrations.AddIndex(
+            model_name='batchjob',
+            index=models.Index(fields=['kind', 'target_id'], name='batch-job--target-index'),
+        ),
+    ]
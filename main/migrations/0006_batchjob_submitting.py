@@ -0,0 +1,23 @@
+# Generated by Django 3.2.6 on 2026-10-18 21:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_batchjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchjob',
+            name='date_submitted',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Date submitted'),
+        ),
+        migrations.AlterField(
+            model_name='batchjob',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('submitting', 'Submitting'), ('submitted', 'Submitted'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20, verbose_name='Status'),
+        ),
+    ]
@@ -52,13 +52,58 @@ class Agent(models.Model):
         "Video avatar"), on_delete=models.SET_NULL, null=True, blank=True)
     order = models.PositiveIntegerField(
         _("Order"), default=1, validators=[MinValueValidator(1)])
+    template_version = models.PositiveIntegerField(_("User prompt template version"), default=1)
+    model = models.CharField(
+        _("Model"), max_length=100, blank=True,
+        help_text=_("LLM of the agent's answers. Leave empty to route by settings.LLM_ROUTES."))
 
     class Meta:
         ordering = ['order']
 
+    @property
+    def template_key(self) -> str:
+        """Identifies the user prompt template that materialized `Message.rendered_content` was built with."""
+        return f"{self.pk}:{self.template_version}"
+
 
 class AgentImageExample(models.Model):
     agent = models.ForeignKey(Agent, verbose_name=_(
         "Agent"), on_delete=models.CASCADE, related_name="examples")
     file = models.FileField(
         _("Image"), upload_to='jlab/agents/images', max_length=255)
+
+
+class BatchJobKinds(models.TextChoices):
+    CHAT_TITLE = 'chat_title', _('Chat title')
+    INTERVIEW_EVALUATION = 'interview_evaluation', _('Interview evaluation')
+
+
+class BatchJobStatuses(models.TextChoices):
+    PENDING = 'pending', _('Pending')
+    SUBMITTING = 'submitting', _('Submitting')
+    SUBMITTED = 'submitted', _('Submitted')
+    COMPLETED = 'completed', _('Completed')
+    FAILED = 'failed', _('Failed')
+
+
+class BatchJob(models.Model):
+    """A non-interactive completion, submitted with others in a batch and written back to its target (see `main.batch`)."""
+    kind = models.CharField(_("Kind"), choices=BatchJobKinds.choices, max_length=25)
+    target_id = models.CharField(_("Target ID"), max_length=255)
+    call_site = models.CharField(_("Call site"), max_length=50)
+    model = models.CharField(_("Model"), max_length=100)
+    request = models.JSONField(_("Request"))
+    status = models.CharField(
+        _("Status"), choices=BatchJobStatuses.choices, default=BatchJobStatuses.PENDING, max_length=20)
+    batch_id = models.CharField(_("Batch ID"), max_length=255, blank=True, default="")
+    result = models.TextField(_("Result"), blank=True, default="")
+    error = models.TextField(_("Error"), blank=True, default="")
+    date_created = models.DateTimeField(_("Date created"), auto_now_add=True)
+    date_submitted = models.DateTimeField(_("Date submitted"), null=True, blank=True)
+    date_completed = models.DateTimeField(_("Date completed"), null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "date_created"], name="batch-job--status-index"),
+            models.Index(fields=["kind", "target_id"], name="batch-job--target-index"),
+        ]
@@ -0,0 +1,361 @@
+"""
+LLM providers behind `main.utils`.
+
+The provider is selected with `settings.LLM_PROVIDER["BACKEND"]`:
+    - `OpenAIProvider`: the OpenAI SDK with the pooled transport of `main.transport`;
+    - `FakeProvider`: answers in-process without network access, for load tests and benchmarks.
+      Answers are deterministic for the same messages; latency, token rate, length, error rate
+      and image payload are set with `OPTIONS`.
+
+Providers return OpenAI SDK types, so the rest of the code does not depend on the provider.
+Batches of non-interactive completions (see `main.batch`) go through the OpenAI Batch API with
+`OpenAIProvider`. Other providers run them in-process, one by one, when they are submitted.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Union
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from openai import AsyncOpenAI, OpenAI
+from openai.types import Image
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from main import deadline
+from main.transport import build_async_http_client, build_http_client, get_client_timeout, get_timeout
+
+
+# Result of a batched request: the completion, or the error message of a failed request
+BatchResult = Union[ChatCompletion, str]
+
+
+class BaseProvider(ABC):
+    def __init__(self, **options) -> None:
+        self.options = options
+        self._batches: Dict[str, Dict[str, BatchResult]] = {}
+        self._batches_lock = threading.Lock()
+
+    @abstractmethod
+    def chat_completion(self, model: str, messages: Any, temperature: float, stream: bool,
+                        response_format: dict, timeout: Any) -> Any:
+        """Returns a `ChatCompletion`, or an iterable of `ChatCompletionChunk` with `.close()` if `stream`."""
+
+    @abstractmethod
+    async def achat_completion(self, model: str, messages: Any, temperature: float, stream: bool,
+                               response_format: dict, timeout: Any) -> Any:
+        """Async counterpart of `.chat_completion`. Streams are async iterables with an async `.close()`."""
+
+    @abstractmethod
+    def generate_image(self, model: str, prompt: str, quality: str, n: int, timeout: Any) -> List[Image]:
+        """Returns `n` generated images."""
+
+    def submit_batch(self, requests: List[dict]) -> str:
+        """
+            Submits non-streamed completions, returns the batch ID.
+            Requests have a `custom_id` and the `model`, `messages`, `temperature` and `response_format`
+            of `.chat_completion`. This local stand-in runs them right away.
+        """
+        results: Dict[str, BatchResult] = {}
+        for request in requests:
+            try:
+                results[request["custom_id"]] = self.chat_completion(
+                    model=request["model"],
+                    messages=request["messages"],
+                    temperature=request["temperature"],
+                    stream=False,
+                    response_format=request["response_format"],
+                    timeout=get_timeout()
+                )
+            except Exception as e:
+                results[request["custom_id"]] = str(e) or type(e).__name__
+        batch_id = f"local-{uuid.uuid4().hex}"
+        with self._batches_lock:
+            self._batches[batch_id] = results
+        return batch_id
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, BatchResult]]:
+        """
+            Results of a submitted batch by `custom_id`, None while it is running (for the local stand-in:
+            submitted by another process). Requests missing from the results failed without an answer
+            (e.g. the batch expired). The results stay available until `.delete_batch`.
+        """
+        with self._batches_lock:
+            return self._batches.get(batch_id)
+
+    def delete_batch(self, batch_id: str) -> None:
+        """Forgets the results of a batch, once they are written back."""
+        with self._batches_lock:
+            self._batches.pop(batch_id, None)
+
+
+class OpenAIProvider(BaseProvider):
+    def __init__(self, **options) -> None:
+        super().__init__(**options)
+        self.client = OpenAI(api_key=settings.GPT_API_KEY,
+                             http_client=build_http_client(),
+                             timeout=get_client_timeout())
+        self.async_client = AsyncOpenAI(api_key=settings.GPT_API_KEY,
+                                        http_client=build_async_http_client(),
+                                        timeout=get_client_timeout())
+
+    @staticmethod
+    def _with_deadline(client):
+        """Retries would each get the whole timeout, so there are none when the request has a deadline."""
+        return client if deadline.remaining() is None else client.with_options(max_retries=0)
+
+    def chat_completion(self, model, messages, temperature, stream, response_format, timeout):
+        return self._with_deadline(self.client).chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=stream,
+            response_format=response_format,  # type: ignore
+            timeout=timeout
+        )
+
+    async def achat_completion(self, model, messages, temperature, stream, response_format, timeout):
+        return await self._with_deadline(self.async_client).chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=stream,
+            response_format=response_format,  # type: ignore
+            timeout=timeout
+        )
+
+    def generate_image(self, model, prompt, quality, n, timeout):
+        return self._with_deadline(self.client).images.generate(
+            model=model,
+            prompt=prompt,
+            quality=quality,  # type: ignore
+            n=n,
+            timeout=timeout
+        ).data
+
+    BATCH_ENDPOINT = "/v1/chat/completions"
+    BATCH_RUNNING = ("validating", "in_progress", "finalizing", "cancelling")
+
+    def submit_batch(self, requests):
+        lines = (json.dumps({
+            "custom_id": request["custom_id"],
+            "method": "POST",
+            "url": self.BATCH_ENDPOINT,
+            "body": {key: request[key] for key in ("model", "messages", "temperature", "response_format")},
+        }) for request in requests)
+        input_file = self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch", timeout=get_timeout())
+        batch = self.client.batches.create(
+            input_file_id=input_file.id, endpoint=self.BATCH_ENDPOINT, completion_window="24h", timeout=get_timeout())
+        return batch.id
+
+    def get_batch(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id, timeout=get_timeout())
+        if batch.status in self.BATCH_RUNNING:
+            return None
+        results: Dict[str, BatchResult] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id, timeout=get_timeout()).text.splitlines():
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[item["custom_id"]] = ChatCompletion.model_validate(response["body"])
+                else:
+                    results[item["custom_id"]] = json.dumps(item.get("error") or response.get("body"))
+        return results
+
+
+class FakeProviderError(Exception):
+    """Error injected by `FakeProvider`."""
+
+
+# 1x1 white PNG
+FAKE_IMAGE_URL = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/58BAAT/Av9VbYGVAAAAAElFTkSuQmCC"
+)
+FAKE_WORDS = (
+    "the", "answer", "depends", "on", "your", "goals", "and", "experience", "so", "start",
+    "with", "a", "clear", "plan", "then", "practice", "every", "day", "to", "improve",
+)
+
+
+class FakeStream:
+    """
+        Streamed fake completion. Sleeps between chunks to simulate the token rate.
+        Like the SDK streams, it can be iterated only once.
+    """
+
+    def __init__(self, chunks: List[ChatCompletionChunk], first_delay: float, delay: float) -> None:
+        self.chunks = chunks
+        self.first_delay = first_delay
+        self.delay = delay
+        self.closed = False
+        # when the next chunk arrives
+        self._due = time.monotonic()
+        self._iterator = self._iterate()
+
+    def _delay(self, index: int) -> float:
+        # the first chunk only carries the role
+        return self.first_delay if index == 1 else self.delay if index > 1 else 0
+
+    def _iterate(self) -> Iterator[ChatCompletionChunk]:
+        for i, chunk in enumerate(self.chunks):
+            time.sleep(max(self._due - time.monotonic(), 0))
+            if self.closed:
+                return
+            self._due = time.monotonic() + self._delay(i + 1)
+            yield chunk
+
+    def wait(self, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for the next chunk, like `main.transport.wait_readable` for SDK streams."""
+        delay = self._due - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(delay, 0))
+        return True
+
+    def __iter__(self) -> Iterator[ChatCompletionChunk]:
+        return self._iterator
+
+    def __next__(self) -> ChatCompletionChunk:
+        return next(self._iterator)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class AsyncFakeStream(FakeStream):
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self._aiterator = self._aiterate()
+
+    async def _aiterate(self) -> AsyncIterator[ChatCompletionChunk]:
+        for i, chunk in enumerate(self.chunks):
+            await asyncio.sleep(self._delay(i))
+            if self.closed:
+                return
+            yield chunk
+
+    def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        return self._aiterator
+
+    async def __anext__(self) -> ChatCompletionChunk:
+        return await self._aiterator.__anext__()
+
+    async def close(self) -> None:  # type: ignore
+        self.closed = True
+
+
+class FakeProvider(BaseProvider):
+    """
+        In-process provider for load tests.
+
+        :param first_token_latency: seconds before the first token
+        :param tokens_per_second: token rate after the first token
+        :param tokens: number of tokens in an answer
+        :param error_rate: share of calls that raise `FakeProviderError`, drawn from a generator seeded with `seed`
+        :param image_url: URL of the generated images, a 1x1 PNG data URL by default
+    """
+
+    def __init__(self, first_token_latency: float = 0.3, tokens_per_second: float = 50, tokens: int = 100,
+                 error_rate: float = 0.0, seed: int = 0, image_url: Optional[str] = None, **options) -> None:
+        super().__init__(**options)
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.image_url = image_url or FAKE_IMAGE_URL
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _maybe_fail(self) -> None:
+        with self._lock:
+            failed = self.error_rate and self._random.random() < self.error_rate
+        if failed:
+            raise FakeProviderError("Injected error.")
+
+    def _answer(self, messages: Any) -> List[str]:
+        """Tokens of the answer, derived from the messages."""
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True, default=str).encode()).digest()
+        return [
+            FAKE_WORDS[(digest[i % len(digest)] + i) % len(FAKE_WORDS)] + " "
+            for i in range(self.tokens)
+        ]
+
+    def _text(self, messages: Any, response_format: dict) -> str:
+        text = "".join(self._answer(messages)).strip()
+        if response_format.get("type") == "json_object":
+            return json.dumps({"answer": text})
+        return text
+
+    def _chunks(self, model: str, messages: Any, response_format: dict) -> List[ChatCompletionChunk]:
+        if response_format.get("type") == "json_object":
+            tokens = [self._text(messages, response_format)]
+        else:
+            tokens = self._answer(messages)
+        deltas = [({"role": "assistant", "content": ""}, None)]
+        deltas += [({"content": token}, None) for token in tokens]
+        deltas += [({}, "stop")]
+        return [
+            ChatCompletionChunk.model_validate({
+                "id": "fake",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+            for delta, finish_reason in deltas
+        ]
+
+    def _completion(self, model: str, messages: Any, response_format: dict) -> ChatCompletion:
+        return ChatCompletion.model_validate({
+            "id": "fake",
+            "object": "chat.completion",
+            "created": 0,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self._text(messages, response_format)},
+                "finish_reason": "stop",
+            }],
+        })
+
+    @property
+    def _duration(self) -> float:
+        return self.first_token_latency + self.tokens / self.tokens_per_second
+
+    def chat_completion(self, model, messages, temperature, stream, response_format, timeout):
+        self._maybe_fail()
+        if stream:
+            return FakeStream(self._chunks(model, messages, response_format),
+                              self.first_token_latency, 1 / self.tokens_per_second)
+        time.sleep(self._duration)
+        return self._completion(model, messages, response_format)
+
+    async def achat_completion(self, model, messages, temperature, stream, response_format, timeout):
+        self._maybe_fail()
+        if stream:
+            return AsyncFakeStream(self._chunks(model, messages, response_format),
+                                   self.first_token_latency, 1 / self.tokens_per_second)
+        await asyncio.sleep(self._duration)
+        return self._completion(model, messages, response_format)
+
+    def generate_image(self, model, prompt, quality, n, timeout):
+        self._maybe_fail()
+        time.sleep(self.first_token_latency)
+        return [Image(url=self.image_url) for _ in range(n)]
+
+
+@lru_cache(maxsize=1)
+def get_provider() -> BaseProvider:
+    config = settings.LLM_PROVIDER
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
@@ -0,0 +1,342 @@
+"""
+Circuit breakers and hedged requests for LLM calls, configured per call site.
+
+Every call site (`"chat"`, `"title"`, ...) has a settings entry in `settings.LLM_CALL_SITES`,
+falling back to `"default"`:
+    - `BREAKER`: a circuit breaker that opens when the error rate or a latency percentile of
+      the recent calls is too high. An open circuit fails fast with `CircuitOpen`, which the
+      generation APIs turn into the usual "high demand" fake stream. Set to None to disable.
+    - `HEDGE_AFTER`/`FALLBACK_MODEL`: when the first token (or the response of a non-streamed
+      call) takes longer than `HEDGE_AFTER` seconds, or the first request fails, a second
+      request is sent to `FALLBACK_MODEL`. The first one to answer wins, the other is closed.
+      Each request is admitted on its own by the `admit` of the caller (see `main.limiter`), a
+      hedged call takes two slots while both requests run.
+
+Latency is measured until the first content token for streams, so `call` functions passed to
+`call_with_resilience` prefetch it (see `PrefetchedStream`). It also drives the adaptive load
+shedding limit (`TARGET_LATENCY`, see `main.shedding`).
+"""
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import AbstractContextManager, nullcontext
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from custom.custom_exceptions import DeadlineExceeded
+from main import metrics
+from main.shedding import shedder
+from main.transport import wait_readable
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def get_call_site_config(call_site: str) -> dict:
+    sites = settings.LLM_CALL_SITES
+    return {**sites["default"], **sites.get(call_site, {})}
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, config: dict) -> None:
+        self.name = name
+        self.config = config
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._calls: Deque[Tuple[float, bool, float]] = deque()
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        """Raises `CircuitOpen` unless the call may go upstream. Half-open circuits let a single trial call through."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.config["OPEN_SECONDS"]:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+        metrics.circuit_rejections.inc(call_site=self.name)
+        raise CircuitOpen(f"Circuit of {self.name} is open.")
+
+    def record(self, ok: bool, latency: float = 0.0) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                else:
+                    self._open(now)
+                return
+            self._calls.append((now, ok, latency))
+            while self._calls and now - self._calls[0][0] > self.config["WINDOW_SECONDS"]:
+                self._calls.popleft()
+            if self.state == self.CLOSED and self._should_open():
+                self._open(now)
+
+    def _should_open(self) -> bool:
+        if len(self._calls) < self.config["MIN_CALLS"]:
+            return False
+        errors = sum(1 for _, ok, _ in self._calls if not ok)
+        if errors / len(self._calls) >= self.config["ERROR_RATE"]:
+            return True
+        latencies = sorted(latency for _, ok, latency in self._calls if ok)
+        if not latencies:
+            return False
+        index = min(len(latencies) - 1, int(len(latencies) * self.config["LATENCY_PERCENTILE"] / 100))
+        return latencies[index] >= self.config["LATENCY_THRESHOLD"]
+
+    def _open(self, now: float) -> None:
+        logging.warning("Circuit breaker %s: opened.", self.name)
+        self.state = self.OPEN
+        self.opened_at = now
+        self._calls.clear()
+        metrics.circuit_opened.inc(call_site=self.name)
+
+
+_breakers: Dict[str, Optional[CircuitBreaker]] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(call_site: str) -> Optional[CircuitBreaker]:
+    with _breakers_lock:
+        if call_site not in _breakers:
+            config = get_call_site_config(call_site)["BREAKER"]
+            _breakers[call_site] = CircuitBreaker(call_site, config) if config else None
+        return _breakers[call_site]
+
+
+def _is_content_chunk(chunk: Any) -> bool:
+    if not chunk.choices:
+        return False
+    answer = chunk.choices[0]
+    return bool(answer.delta.content) or bool(answer.finish_reason)
+
+
+class PrefetchedStream:
+    """A completion stream whose chunks up to the first token were already read."""
+
+    def __init__(self, stream: Any) -> None:
+        self.stream = stream
+        self.prefetched: List[Any] = []
+        for chunk in stream:
+            self.prefetched.append(chunk)
+            if _is_content_chunk(chunk):
+                break
+
+    def __iter__(self):
+        while self.prefetched:
+            yield self.prefetched.pop(0)
+        yield from self.stream
+
+    def wait(self, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for the next chunk, see `main.transport.wait_readable`."""
+        return bool(self.prefetched) or wait_readable(self.stream, timeout)
+
+    def close(self) -> None:
+        self.stream.close()
+
+
+class APrefetchedStream:
+    """Async counterpart of `PrefetchedStream`, created with `await APrefetchedStream.create(stream)`."""
+
+    def __init__(self, stream: Any) -> None:
+        self.stream = stream
+        self.prefetched: List[Any] = []
+
+    @classmethod
+    async def create(cls, stream: Any) -> "APrefetchedStream":
+        prefetched = cls(stream)
+        async for chunk in stream:
+            prefetched.prefetched.append(chunk)
+            if _is_content_chunk(chunk):
+                break
+        return prefetched
+
+    async def __aiter__(self):
+        for chunk in self.prefetched:
+            yield chunk
+        async for chunk in self.stream:
+            yield chunk
+
+    async def close(self) -> None:
+        await self.stream.close()
+
+
+def _discard(result: Any) -> None:
+    if hasattr(result, "close"):
+        try:
+            result.close()
+        except Exception as e:
+            logging.exception(e)
+
+
+async def _adiscard(result: Any) -> None:
+    if hasattr(result, "close"):
+        try:
+            await result.close()
+        except Exception as e:
+            logging.exception(e)
+
+
+def _models(config: dict, model: Optional[str]) -> Tuple[str, Optional[str]]:
+    primary = model or settings.GPT_MODEL_ENGINE
+    fallback = config["FALLBACK_MODEL"] if config["HEDGE_AFTER"] is not None else None
+    return primary, fallback if fallback != primary else None
+
+
+def _record(breaker: Optional[CircuitBreaker], config: dict, ok: bool, latency: float) -> None:
+    """Records the outcome of a call to the primary model."""
+    if breaker:
+        breaker.record(ok, latency)
+    shedder.observe(ok, latency, config["TARGET_LATENCY"])
+
+
+def _start_thread(func: Callable, *args) -> None:
+    """Runs `func` in a new thread with a copy of the current context (e.g. `track_call`)."""
+    threading.Thread(target=contextvars.copy_context().run, args=(func, *args), daemon=True).start()
+
+
+def call_with_resilience(call_site: str, call: Callable[[str], Any], model: Optional[str] = None,
+                         admit: Callable[[], AbstractContextManager] = nullcontext) -> Any:
+    """
+        Runs `call(model)` through the circuit breaker and hedging of `call_site`.
+        `call` must return once the first token (or the whole response) is there.
+        `model` is the primary model (`settings.GPT_MODEL_ENGINE` by default, see `main.routing`).
+        Every request runs in its own `admit()` block (e.g. `limiter.admit`), the hedge timer starts
+        once the first one is admitted and latency is measured without the wait for admission.
+    """
+    config = get_call_site_config(call_site)
+    breaker = get_breaker(call_site)
+    if breaker:
+        breaker.allow()
+    primary, fallback = _models(config, model)
+    results: "queue.Queue[Tuple[str, Any, Optional[Exception]]]" = queue.Queue()
+    admitted = threading.Event()
+    lock = threading.Lock()
+    winner: List[str] = []
+
+    def timed(model: str):
+        started = time.monotonic()
+        try:
+            result = call(model)
+        except Exception as e:
+            if model == primary and not isinstance(e, DeadlineExceeded):
+                _record(breaker, config, False, time.monotonic() - started)
+            raise
+        if model == primary:
+            _record(breaker, config, True, time.monotonic() - started)
+        return result
+
+    def attempt(model: str):
+        try:
+            with admit():
+                admitted.set()
+                result = timed(model)
+        except Exception as e:
+            admitted.set()
+            results.put((model, None, e))
+            return
+        with lock:
+            won = not winner
+            if won:
+                winner.append(model)
+        if won:
+            results.put((model, result, None))
+        else:
+            _discard(result)
+
+    if not fallback:
+        attempt(primary)
+        return _result(results.get())
+
+    _start_thread(attempt, primary)
+    admitted.wait()
+    try:
+        outcome = results.get(timeout=config["HEDGE_AFTER"])
+    except queue.Empty:
+        outcome = None
+    if outcome is not None and outcome[2] is None:
+        return outcome[1]
+    metrics.hedged_requests.inc(call_site=call_site)
+    _start_thread(attempt, fallback)
+    if outcome is None:
+        outcome = results.get()
+    if outcome[2] is not None:
+        # one of the requests failed, wait for the other one
+        outcome = results.get()
+    if outcome[2] is None and outcome[0] == fallback:
+        metrics.hedge_wins.inc(call_site=call_site)
+    return _result(outcome)
+
+
+def _result(outcome: Tuple[str, Any, Optional[Exception]]) -> Any:
+    _, result, error = outcome
+    if error is not None:
+        raise error
+    return result
+
+
+async def acall_with_resilience(call_site: str, call: Callable[[str], Awaitable[Any]],
+                                model: Optional[str] = None) -> Any:
+    """Async counterpart of `call_with_resilience`. The losing request is cancelled."""
+    config = get_call_site_config(call_site)
+    breaker = get_breaker(call_site)
+    if breaker:
+        breaker.allow()
+    primary, fallback = _models(config, model)
+
+    async def attempt(model: str):
+        started = time.monotonic()
+        try:
+            result = await call(model)
+        except (asyncio.CancelledError, DeadlineExceeded):
+            raise
+        except Exception:
+            if model == primary:
+                _record(breaker, config, False, time.monotonic() - started)
+            raise
+        if model == primary:
+            _record(breaker, config, True, time.monotonic() - started)
+        return result
+
+    if not fallback:
+        return await attempt(primary)
+
+    tasks = {asyncio.ensure_future(attempt(primary)): primary}
+    done, _ = await asyncio.wait(tasks, timeout=config["HEDGE_AFTER"])
+    if done and not next(iter(done)).exception():
+        return next(iter(done)).result()
+    metrics.hedged_requests.inc(call_site=call_site)
+    tasks[asyncio.ensure_future(attempt(fallback))] = fallback
+    pending = {task for task in tasks if not task.done()}
+    error: Optional[BaseException] = next(iter(done)).exception() if done else None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                for task in succeeded[1:]:
+                    await _adiscard(task.result())
+                if tasks[succeeded[0]] == fallback:
+                    metrics.hedge_wins.inc(call_site=call_site)
+                return succeeded[0].result()
+            error = next(iter(done)).exception()
+        assert error is not None
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
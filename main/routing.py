@@ -0,0 +1,93 @@
+"""
+Cost-aware model routing of LLM calls.
+
+Every call is sent to the model picked by `route()`:
+    - a text `Agent` with a `model` set always uses it for its chat turns;
+    - otherwise the first rule of `settings.LLM_ROUTES` matching the call site (e.g. `"title"`,
+      `"interview_evaluation"`, `"chat"`), the agent type and the prompt size wins;
+    - calls matching no rule, or a rule without a configured model, use `settings.GPT_MODEL_ENGINE`.
+
+The hedging fallback of the call site (see `main.resilience`) applies to the routed model as well.
+Routed calls are counted per model in `main.metrics`, with their latency (to the first token for
+streams) and estimated cost. Calls not sent to `GPT_MODEL_ENGINE` also count the cost they saved
+(its price minus the routed model's, from `LLM_MODEL_COSTS`) and the latency they saved (the mean
+latency of `GPT_MODEL_ENGINE` at the same call site minus their own).
+"""
+from typing import List, Optional
+
+from django.conf import settings
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+
+from main import metrics
+
+
+class Route:
+    """The model of a single call. Its latency and tokens are reported with `.record_latency`/`.record_tokens`."""
+
+    def __init__(self, call_site: str, model: str, prompt_tokens: int) -> None:
+        self.call_site = call_site
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+
+    @property
+    def is_default(self) -> bool:
+        return self.model == settings.GPT_MODEL_ENGINE
+
+    def record_latency(self, latency: float) -> None:
+        metrics.llm_latency_seconds.observe(latency, call_site=self.call_site, model=self.model)
+        if self.is_default:
+            return
+        default_latency = metrics.llm_latency_seconds.mean(
+            call_site=self.call_site, model=settings.GPT_MODEL_ENGINE)
+        if default_latency:
+            metrics.llm_latency_saved_seconds.inc(max(default_latency - latency, 0), call_site=self.call_site)
+
+    def record_completion(self, completion: ChatCompletion) -> None:
+        """Records the tokens of a non-streamed completion, counted from its content without `usage`."""
+        if completion.usage:
+            self.record_tokens(completion.usage.completion_tokens)
+            return
+        from main.context_window import count_text_tokens  # pylint: disable=import-outside-toplevel
+        self.record_tokens(count_text_tokens(completion.choices[0].message.content or ""))
+
+    def record_tokens(self, completion_tokens: int) -> None:
+        cost = estimate_cost(self.model, self.prompt_tokens, completion_tokens)
+        metrics.llm_cost_usd.inc(cost, call_site=self.call_site, model=self.model)
+        if not self.is_default:
+            default_cost = estimate_cost(settings.GPT_MODEL_ENGINE, self.prompt_tokens, completion_tokens)
+            metrics.llm_cost_saved_usd.inc(max(default_cost - cost, 0), call_site=self.call_site)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """USD cost of a call from the `LLM_MODEL_COSTS` prices per 1M tokens, 0 for models without a price."""
+    input_price, output_price = settings.LLM_MODEL_COSTS.get(model, (0, 0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def _matches(rule: dict, call_site: str, agent_type: Optional[str], prompt_tokens: int) -> bool:
+    if not rule.get("MODEL"):
+        return False
+    if "CALL_SITES" in rule and call_site not in rule["CALL_SITES"]:
+        return False
+    if "AGENT_TYPES" in rule and agent_type not in rule["AGENT_TYPES"]:
+        return False
+    if "MAX_PROMPT_TOKENS" in rule and prompt_tokens > rule["MAX_PROMPT_TOKENS"]:
+        return False
+    return True
+
+
+def route(call_site: str, messages: List[ChatCompletionMessageParam], agent_type: Optional[str] = None,
+          model: Optional[str] = None) -> Route:
+    """
+        Picks the model of a call from `call_site` with `messages`.
+        `model` (e.g. `Agent.model`) overrides the rules, `agent_type` is matched against them.
+    """
+    # imported late, main.context_window creates completions itself
+    from main.context_window import count_tokens  # pylint: disable=import-outside-toplevel
+    prompt_tokens = sum(count_tokens(message.get("content")) for message in messages)
+    if not model:
+        rule = next((rule for rule in settings.LLM_ROUTES
+                     if _matches(rule, call_site, agent_type, prompt_tokens)), None)
+        model = rule["MODEL"] if rule else settings.GPT_MODEL_ENGINE
+    metrics.llm_calls.inc(call_site=call_site, model=model)
+    return Route(call_site, model, prompt_tokens)  # type: ignore
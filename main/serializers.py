@@ -47,7 +47,7 @@ class AgentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Agent
-        exclude = ['sys_template', 'user_template']
+        exclude = ['sys_template', 'user_template', 'template_version']
 
 
 class AgentTypeSerializer(serializers.Serializer):
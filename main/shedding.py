@@ -0,0 +1,80 @@
+"""
+Adaptive load shedding of new LLM work.
+
+The LLM calls of this process that are in flight or queued by `main.limiter` are capped at an
+adaptive limit (`settings.LOAD_SHEDDING`), adjusted AIMD-style from the observed latency:
+    - a call answering within the `TARGET_LATENCY` of its call site raises the limit by
+      `INCREASE / limit`, i.e. by about `INCREASE` per round of `limit` calls;
+    - a slower or failed call multiplies it by `BACKOFF`, at most once per `COOLDOWN` seconds,
+      so a single slow burst is counted once.
+Call sites without `TARGET_LATENCY` only count when they fail.
+
+Over the limit new streams get the usual "high demand" message right away and other requests
+(images, evaluations) are answered with 503 and `Retry-After`, instead of holding a worker until
+the provider times out. Calls that are already running are not affected.
+"""
+import threading
+import time
+from typing import Iterator, Optional
+
+from django.conf import settings
+
+from custom.custom_exceptions import ServiceUnavailable
+from main import metrics
+from main.limiter import limiter
+from main.sse import STOP_FRAME, format_frame
+
+OVERLOADED = "Currently, the AI service is experiencing high demand, please try a few minutes later."
+
+
+class AdaptiveLimit:
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.limit = float(config["INITIAL_LIMIT"])
+        self._decreased = 0.0
+        self._lock = threading.Lock()
+        metrics.llm_concurrency_limit.set(self.limit)
+
+    def observe(self, ok: bool, latency: float, target: Optional[float]) -> None:
+        """Adjusts the limit after a call that took `latency` seconds (to the first token for streams)."""
+        if ok and target is None:
+            return
+        with self._lock:
+            if ok and latency <= target:  # type: ignore
+                self.limit = min(self.config["MAX_LIMIT"], self.limit + self.config["INCREASE"] / self.limit)
+            else:
+                now = time.monotonic()
+                if now - self._decreased < self.config["COOLDOWN"]:
+                    return
+                self._decreased = now
+                self.limit = max(self.config["MIN_LIMIT"], self.limit * self.config["BACKOFF"])
+            limit = self.limit
+        metrics.llm_concurrency_limit.set(limit)
+
+
+shedder = AdaptiveLimit(settings.LOAD_SHEDDING)
+
+
+def is_overloaded(view: str) -> bool:
+    """True if new LLM work requested by `view` should be shed."""
+    if limiter.load() < int(shedder.limit):
+        return False
+    metrics.shed_requests.inc(view=view)
+    return True
+
+
+def check_capacity(view: str) -> None:
+    """Raises `ServiceUnavailable` (503 with `Retry-After`) if new LLM work should be shed."""
+    if is_overloaded(view):
+        raise ServiceUnavailable(wait=settings.LOAD_SHEDDING["RETRY_AFTER"])
+
+
+def overloaded_stream() -> Iterator[bytes]:
+    """Stream sent instead of a shed generation."""
+    yield format_frame(OVERLOADED)
+    yield STOP_FRAME
+
+
+async def aoverloaded_stream():
+    for frame in overloaded_stream():
+        yield frame
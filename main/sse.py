@@ -0,0 +1,175 @@
+"""Helpers for formatting chat completion streams as server-sent events."""
+import asyncio
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+
+from main.transport import wait_readable
+
+STOP_FRAME = ('data: Stop\0\n\n').encode()
+# SSE comment, ignored by clients. Keeps idle connections open and reveals disconnected ones.
+HEARTBEAT_FRAME = b': ping\n\n'
+
+
+def format_frame(text: str, event_id: Optional[int] = None) -> bytes:
+    """
+        Formats a piece of completion text as a single SSE data frame.
+
+        `event_id` is the length of the answer content sent up to and including this frame,
+        so a client reconnecting with `Last-Event-ID` can be resumed from that offset.
+    """
+    text = text.replace("\n", "<br/>")
+    if event_id is None:
+        return (f'data: {text}\n\n').encode()
+    return (f'id: {event_id}\ndata: {text}\n\n').encode()
+
+
+def parse_frame_id(frame: bytes) -> Optional[int]:
+    """Returns the id of a frame built by `format_frame`, if it has one."""
+    if not frame.startswith(b"id: "):
+        return None
+    return int(frame[4:frame.index(b"\n")])
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    """Parses the `Last-Event-ID` header. Returns None if it is missing or not ours."""
+    try:
+        return max(int(value), 0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def format_retry(seconds: float) -> bytes:
+    """Sets how long the client waits before it reconnects (with `Last-Event-ID`) once the response ends."""
+    return f'retry: {int(seconds * 1000)}\n\n'.encode()
+
+
+def format_event(event: str, data: str) -> bytes:
+    """Formats a named SSE event. Clients that only listen to `message` events ignore it."""
+    data = data.replace("\n", " ")
+    return (f'event: {event}\ndata: {data}\n\n').encode()
+
+
+class SSECoalescer:
+    """
+        Accumulates completion tokens and emits them as fewer, larger SSE frames.
+
+        The first token is always flushed right away, so time-to-first-token is unchanged.
+        After that a frame is emitted once `max_bytes` of UTF-8 text are pending or `max_delay`
+        seconds have passed since the last flush, also without a new token: the stream waits for
+        the next token at most `.timeout()` seconds and then sends `.flush_due()` (see `with_ticks`).
+        With both limits set to 0 every token is sent in its own frame.
+        The full content is kept in a list and joined once in `.content`.
+    """
+
+    def __init__(self, max_delay: Optional[float] = None, max_bytes: Optional[int] = None) -> None:
+        self.max_delay = settings.SSE_COALESCE_MS / 1000 if max_delay is None else max_delay
+        self.max_bytes = settings.SSE_COALESCE_BYTES if max_bytes is None else max_bytes
+        self._parts: List[str] = []
+        self._size = 0
+        self._pending: List[str] = []
+        self._pending_size = 0
+        self._last_flush: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_delay > 0 or self.max_bytes > 0
+
+    @property
+    def content(self) -> str:
+        return "".join(self._parts)
+
+    def push(self, text: str) -> Optional[bytes]:
+        """Adds a token and returns a frame if it's time to flush."""
+        if not self.enabled:
+            self._parts.append(text)
+            self._size += len(text)
+            return format_frame(text, self._size)
+        if not text:
+            return None
+        self._parts.append(text)
+        self._size += len(text)
+        self._pending.append(text)
+        self._pending_size += len(text.encode())
+        if (
+            self._last_flush is None
+            or (self.max_bytes and self._pending_size >= self.max_bytes)
+            or (self.max_delay and time.monotonic() - self._last_flush >= self.max_delay)
+        ):
+            return self.flush()
+        return None
+
+    def timeout(self) -> Optional[float]:
+        """Seconds until the pending text is due, None if there is none (or no time limit)."""
+        if not self._pending or not self.max_delay or self._last_flush is None:
+            return None
+        return max(self._last_flush + self.max_delay - time.monotonic(), 0)
+
+    def flush_due(self) -> Optional[bytes]:
+        """Returns a frame with the pending text if `max_delay` has passed since the last flush."""
+        if self.timeout() == 0:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[bytes]:
+        """Returns a frame with all pending text, if any."""
+        if not self._pending:
+            return None
+        frame = format_frame("".join(self._pending), self._size)
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+        return frame
+
+
+# Yielded by `with_ticks`/`awith_ticks` when the timeout passed without an item
+TICK = object()
+_END = object()
+
+
+def with_ticks(stream: Iterable, timeout: Callable[[], Optional[float]]) -> Iterator[Any]:
+    """
+        Yields the chunks of `stream`, and `TICK` whenever `timeout()` seconds (None: no limit) pass without
+        the next one arriving (see `main.transport.wait_readable`). The stream is read in the calling thread.
+        The caller acts on `TICK` (e.g. `SSECoalescer.flush_due`), so that `timeout()` moves on.
+    """
+    iterator = iter(stream)
+    while True:
+        wait = timeout()
+        if wait is not None and not wait_readable(stream, wait):
+            yield TICK
+            continue
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+async def awith_ticks(iterable: AsyncIterable, timeout: Callable[[], Optional[float]]) -> AsyncIterator[Any]:
+    """Async counterpart of `with_ticks`, the next chunk is awaited in a task that outlives the timeouts."""
+    iterator = iterable.__aiter__()
+    next_item: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({next_item}, timeout=timeout())
+            if not done:
+                yield TICK
+                continue
+            try:
+                item = next_item.result()
+            except StopAsyncIteration:
+                return
+            next_item = None
+            yield item
+    finally:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
+            # the iterable can only be closed once the cancelled read is done
+            try:
+                await next_item
+            except (asyncio.CancelledError, Exception):
+                pass
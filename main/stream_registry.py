@@ -0,0 +1,349 @@
+"""
+Registry of running answer generations.
+
+A generation is produced independently of the HTTP response that started it: frames are
+buffered in a `Generation`, and responses are only subscribers. A client that reconnects
+with `Last-Event-ID` attaches to the same generation and gets the frames it missed instead
+of starting a new completion. Duplicate requests (retries) attach to the running generation
+as well, so only one completion per key is in flight (single-flight).
+
+Under WSGI the stream is read by the request threads of its subscribers, one at a time, so a
+generation takes no thread of its own. Under ASGI the producer is a task on the event loop.
+Finished generations are kept for `STREAM_RESUME_TTL` seconds for late reconnects.
+Idle subscribers get heartbeat comments, so disconnected clients are noticed. A generation
+without subscribers for `STREAM_DISCONNECT_GRACE` seconds is closed, which closes the
+upstream completion as well.
+
+The frames are kept in the process that runs the generation. Running generations are also
+claimed in the `STREAM_REGISTRY_CACHE` cache (see `Claim`), which makes single-flight hold across
+processes: a reconnect or a duplicate request served by another process does not start a new
+generation, it follows the persisted answer (see `BaseGenerationAPI.replay_stream`) and is told
+whether the rest is still being generated. With the default local-memory cache the claims, and
+so the deduplication, only cover a single process.
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from main.sse import HEARTBEAT_FRAME, STOP_FRAME, parse_frame_id
+
+
+class Claim:
+    """
+        Marks a generation as running in the `STREAM_REGISTRY_CACHE` cache, which is shared by the workers.
+        The mark expires `STREAM_RESUME_STALE` seconds after the last `.refresh`, e.g. when its process died.
+    """
+
+    def __init__(self, key: Any) -> None:
+        self.cache_key = claim_key(key)
+        self._refreshed = time.monotonic()
+
+    @staticmethod
+    def _cache():
+        return caches[settings.STREAM_REGISTRY_CACHE]
+
+    def acquire(self) -> bool:
+        """Marks the generation as running, returns False if it already was."""
+        self._refreshed = time.monotonic()
+        return self._cache().add(self.cache_key, True, settings.STREAM_RESUME_STALE)
+
+    def refresh(self) -> None:
+        """Extends the mark, at most once per `STREAM_CHECKPOINT_INTERVAL`."""
+        if time.monotonic() - self._refreshed < settings.STREAM_CHECKPOINT_INTERVAL:
+            return
+        self._refreshed = time.monotonic()
+        self._cache().touch(self.cache_key, settings.STREAM_RESUME_STALE)
+
+    def release(self) -> None:
+        self._cache().delete(self.cache_key)
+
+
+def claim_key(key: Any) -> str:
+    return "generation:" + ":".join(map(str, key if isinstance(key, tuple) else (key,)))
+
+
+class Generation:
+    """Buffered frames of one answer generation."""
+
+    def __init__(self, key: Any, stream=None, claim: Optional[Claim] = None) -> None:
+        self.key = key
+        self.frames: List[Tuple[Optional[int], bytes]] = []
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self._stream = stream
+        self._claim = claim
+        self._started = False
+        # a sync stream is being read by a subscriber (or closed)
+        self._producing = False
+        # the event loop only keeps a weak reference to tasks
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self._subscribers = 0
+        self._idle_since: Optional[float] = None
+
+    @property
+    def is_async(self) -> bool:
+        return hasattr(self._stream, '__aiter__')
+
+    def publish(self, frame: bytes) -> None:
+        with self._condition:
+            self.frames.append((parse_frame_id(frame), frame))
+            self._notify()
+        if self._claim:
+            self._claim.refresh()
+
+    def attach(self, stream) -> None:
+        """Sets the stream of a generation created without one. Waiting subscribers start it."""
+        with self._condition:
+            self._stream = stream
+            self._notify()
+
+    def fail(self) -> None:
+        """Ends a generation whose stream could not be created."""
+        self.publish(STOP_FRAME)
+        self.finish()
+
+    def finish(self) -> None:
+        with self._condition:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify()
+        if self._claim:
+            self._claim.release()
+
+    def _notify(self) -> None:
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    @property
+    def abandoned(self) -> bool:
+        """True once all subscribers are gone for `STREAM_DISCONNECT_GRACE` seconds."""
+        with self._lock:
+            return self._abandoned()
+
+    def _abandoned(self) -> bool:
+        return (
+            self._subscribers == 0 and self._idle_since is not None
+            and time.monotonic() - self._idle_since >= settings.STREAM_DISCONNECT_GRACE
+        )
+
+    def _subscribe(self) -> None:
+        with self._lock:
+            self._subscribers += 1
+            self._idle_since = None
+
+    def _unsubscribe(self) -> None:
+        with self._lock:
+            self._subscribers -= 1
+            if self._subscribers:
+                return
+            self._idle_since = time.monotonic()
+            waiting = self._started and not self.done and not self.is_async
+        if waiting:
+            # nobody reads a sync stream without subscribers, it is closed unless one comes back in time
+            timer = threading.Timer(settings.STREAM_DISCONNECT_GRACE, self._close_abandoned)
+            timer.daemon = True
+            timer.start()
+
+    def _start(self) -> None:
+        """Starts the producer task of an async stream. Sync streams are read by their subscribers."""
+        with self._lock:
+            if self._started or self._stream is None or not self.is_async:
+                return
+            self._started = True
+        self._task = asyncio.get_running_loop().create_task(self._aproduce())
+
+    def _cancel(self) -> None:
+        logging.info("Generation %s: all clients disconnected, closing the stream.", self.key)
+        self.publish(STOP_FRAME)
+
+    def _produce(self) -> bool:
+        """
+            Reads the next frame of a sync stream in the calling thread and publishes it.
+            Returns False if there is nothing to read, or another subscriber is reading it.
+        """
+        with self._lock:
+            if self._producing or self._stream is None or self.done:
+                return False
+            self._producing = True
+            self._started = True
+        try:
+            self.publish(next(self._stream))
+        except StopIteration:
+            self.finish()
+        except Exception as e:
+            logging.exception(e)
+            self.publish(STOP_FRAME)
+            self.finish()
+        finally:
+            with self._condition:
+                self._producing = False
+                self._notify()
+        return True
+
+    def _close_abandoned(self) -> None:
+        """Closes a sync stream whose subscribers did not come back within `STREAM_DISCONNECT_GRACE`."""
+        with self._lock:
+            if self._producing or self.done or not self._abandoned():
+                return
+            self._producing = True
+        try:
+            self._stream.close()
+            self._cancel()
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self.finish()
+            connections.close_all()
+
+    async def _aproduce(self) -> None:
+        try:
+            async for frame in self._stream:
+                self.publish(frame)
+                if self.abandoned:
+                    await self._stream.aclose()
+                    self._cancel()
+                    break
+        except Exception as e:
+            logging.exception(e)
+            self.publish(STOP_FRAME)
+        finally:
+            self.finish()
+
+    def _position(self, last_event_id: Optional[int]) -> int:
+        """Index of the first frame the client has not seen yet."""
+        if last_event_id is None:
+            return 0
+        position = 0
+        for i, (event_id, _) in enumerate(self.frames):
+            if event_id is not None:
+                if event_id > last_event_id:
+                    break
+                position = i + 1
+        return position
+
+    def _read(self, position: int, last_event_id: Optional[int]) -> Tuple[List[bytes], int, bool]:
+        """Returns the unseen frames, the new position and whether the generation is done."""
+        with self._lock:
+            if last_event_id is not None:
+                # the client may be ahead of the frames produced so far
+                position = max(position, self._position(last_event_id))
+            frames = [frame for _, frame in self.frames[position:]]
+            return frames, position + len(frames), self.done
+
+    def subscribe(self, last_event_id: Optional[int] = None) -> Iterator[bytes]:
+        """
+            Yields all frames after `last_event_id` and then the new ones as they are produced.
+            A sync stream is read here, unless another subscriber is reading it already.
+            Sends a heartbeat after `SSE_HEARTBEAT_INTERVAL` seconds without frames.
+        """
+        self._subscribe()
+        try:
+            position = 0
+            while True:
+                self._start()
+                frames, position, done = self._read(position, last_event_id)
+                if frames:
+                    last_event_id = None
+                    yield from frames
+                    continue
+                if done:
+                    return
+                if self._produce():
+                    continue
+                with self._condition:
+                    idle = (
+                        position >= len(self.frames) and not self.done
+                        and not self._condition.wait(timeout=settings.SSE_HEARTBEAT_INTERVAL)
+                    )
+                if idle:
+                    yield HEARTBEAT_FRAME
+        finally:
+            self._unsubscribe()
+
+    async def asubscribe(self, last_event_id: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Async counterpart of `.subscribe`."""
+        self._subscribe()
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._lock:
+            self._async_waiters.append(waiter)
+        position = 0
+        try:
+            while True:
+                self._start()
+                event.clear()
+                frames, position, done = self._read(position, last_event_id)
+                if frames:
+                    last_event_id = None
+                    for frame in frames:
+                        yield frame
+                elif done:
+                    return
+                else:
+                    try:
+                        await asyncio.wait_for(event.wait(), settings.SSE_HEARTBEAT_INTERVAL)
+                    except asyncio.TimeoutError:
+                        yield HEARTBEAT_FRAME
+        finally:
+            with self._lock:
+                self._async_waiters.remove(waiter)
+            self._unsubscribe()
+
+
+class GenerationRegistry:
+    """Generations of this process by key. Their keys are claimed in the shared cache while they run (see `Claim`)."""
+
+    def __init__(self) -> None:
+        self._generations: Dict[Any, Generation] = {}
+        self._lock = threading.Lock()
+
+    def _cleanup(self) -> None:
+        now = time.monotonic()
+        for key, generation in list(self._generations.items()):
+            if generation.done and now - generation.finished_at > settings.STREAM_RESUME_TTL:  # type: ignore
+                del self._generations[key]
+
+    def get(self, key: Any) -> Optional[Generation]:
+        with self._lock:
+            self._cleanup()
+            return self._generations.get(key)
+
+    def running(self, key: Any) -> bool:
+        """True if the generation of `key` is running, in this process or another one."""
+        generation = self.get(key)
+        if generation is not None:
+            return not generation.done
+        return bool(caches[settings.STREAM_REGISTRY_CACHE].get(claim_key(key)))
+
+    def get_or_create(self, key: Any, resume: bool = False) -> Tuple[Optional[Generation], bool]:
+        """
+            Returns the running generation for `key`, or a finished one if the client resumes it.
+            Otherwise registers a new generation without a stream and returns it with `True`:
+            the caller must `.attach` its stream (or call `.fail`). It is produced once the first
+            client subscribes. Returns None if the generation is running in another process: its
+            frames are not here, the caller follows the persisted answer instead.
+        """
+        with self._lock:
+            self._cleanup()
+            generation = self._generations.get(key)
+            if generation is not None and (resume or not generation.done):
+                return generation, False
+            claim = Claim(key)
+            if not claim.acquire():
+                return None, False
+            generation = Generation(key, claim=claim)
+            self._generations[key] = generation
+            return generation, True
+
+
+generations = GenerationRegistry()
@@ -1,3 +1,810 @@
-from django.test import TestCase
+import asyncio
+import socket
+import threading
+import time
+from datetime import timedelta
+from itertools import islice
+from types import SimpleNamespace
 
-# Create your tests here.
+import httpx
+from django.conf import settings
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from httpcore._backends.sync import SyncStream
+from rest_framework.views import exception_handler
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from main import batch, deadline, metrics
+from main.api import StreamAgentAPI
+from custom.custom_exceptions import DeadlineExceeded, ServiceUnavailable, TooManyRequests
+from main.base_api import BaseGenerationAPI
+from main.completion_cache import CompletionCache, LocMemCacheBackend
+from main.limiter import Limiter, aqueued_stream, limiter
+from main.models import Agent, AgentTypes, BatchJob, BatchJobKinds, BatchJobStatuses
+from main.providers import FakeProvider, FakeProviderError, OpenAIProvider, get_provider
+from main.resilience import CircuitBreaker, CircuitOpen, call_with_resilience
+from main.routing import route
+from main.context_window import count_tokens
+from main.shedding import AdaptiveLimit, check_capacity, shedder
+from main.sse import STOP_FRAME, format_frame, format_retry
+from main.stream_registry import Generation, GenerationRegistry
+from main.transport import get_timeout, wait_readable
+from chat.models import (
+    Chat,
+    Message,
+    MessageObjectStatuses,
+    MessageObjectTypes,
+)
+
+
+class StreamAgentAPIContextTestCase(TestCase):
+    """Building the chat context must not issue queries per history message."""
+
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            type=AgentTypes.TEXT,
+            sys_template="You are a helpful assistant.",
+            user_template="{main_field} (quote: {quote}, email: {email})",
+        )
+        self.chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+
+    def create_history(self, turns: int):
+        for i in range(turns):
+            user_message = self.chat.messages.create(agent=self.agent, parameters={})
+            user_message.objs.create(content_type=MessageObjectTypes.TEXT, content=f"question {i}")
+            user_message.objs.create(content_type=MessageObjectTypes.QUOTE, content=f"quote {i}")
+            answer = self.chat.messages.create(agent=self.agent, is_answer=True)
+            answer.objs.create(content_type=MessageObjectTypes.TEXT, content=f"answer {i}")
+        last_message = self.chat.messages.create(agent=self.agent, parameters={})
+        last_message.objs.create(content_type=MessageObjectTypes.TEXT, content="last question")
+        return last_message
+
+    def build_context(self, last_message: Message, num_queries: int = 3):
+        ai_message = self.chat.messages.create(is_answer=True, agent=self.agent)
+        task_messages = Message.objects.filter(chat=self.chat, agent__type=self.agent.type)
+        api = StreamAgentAPI(ai_message)
+        api.init_messages()
+        with self.assertNumQueries(num_queries):
+            api.pre_generate(task_messages=task_messages, last_msg_id=last_message.pk)
+        ai_message.delete()
+        return api.messages
+
+    def test_constant_query_count(self):
+        for turns in (1, 5, 25):
+            with self.subTest(turns=turns):
+                Message.objects.all().delete()
+                last_message = self.create_history(turns)
+                # messages, objects and the bulk update of the rendered content
+                messages = self.build_context(last_message)
+                self.assertEqual(len(messages), 2 + 2 * turns)
+                # messages and the objects of the last message only
+                self.assertEqual(self.build_context(last_message, 2), messages)
+
+    def test_template_change_invalidates_rendered_content(self):
+        last_message = self.create_history(1)
+        self.build_context(last_message)
+        self.agent.user_template = "{main_field}!"
+        self.agent.template_version += 1
+        self.agent.save()
+        messages = self.build_context(last_message)
+        self.assertEqual(messages[1]["content"], "question 0!")
+        self.assertEqual(messages[2]["content"], "answer 0")
+
+    def test_context_content(self):
+        last_message = self.create_history(1)
+        messages = self.build_context(last_message)
+        self.assertEqual(
+            [message["role"] for message in messages],
+            ["system", "user", "assistant", "user"]
+        )
+        self.assertEqual(messages[1]["content"], "question 0 (quote: quote 0, email: user@example.com)")
+        self.assertEqual(messages[2]["content"], "answer 0")
+        self.assertEqual(messages[3]["content"][-1]["text"],
+                         "last question (quote: Not defined., email: user@example.com)")
+
+    def test_unavailable_stream_counted(self):
+        ai_message = self.chat.messages.create(is_answer=True, agent=self.agent)
+        api = StreamAgentAPI(ai_message)
+        labels = {"reason": "unavailable", **api.metric_labels}
+        before = metrics.streams_ended.value(**labels)
+        with self.assertLogs(level="ERROR"):
+            # the context can't be built
+            frames = list(api.get_text_stream(task_messages=None, last_msg_id=None))
+        self.assertEqual(frames, list(api.fake_stream(api.HIGH_DEMAND)))
+        self.assertEqual(metrics.streams_ended.value(**labels), before + 1)
+
+    @override_settings(CONTEXT_TOKEN_BUDGET=60, CONTEXT_SUMMARY_TARGET=0.5)
+    def test_over_budget_summarized_later(self):
+        last_message = self.create_history(5)
+        ai_message = self.chat.messages.create(is_answer=True, agent=self.agent)
+        api = StreamAgentAPI(ai_message)
+        api.init_messages()
+        # no summary call before the answer: only the queries of an in-budget history
+        with self.assertNumQueries(3):
+            api.pre_generate(task_messages=Message.objects.filter(chat=self.chat), last_msg_id=last_message.pk)
+        self.assertLess(len(api.messages), 2 + 2 * 5)
+        self.assertEqual(len(api.messages) - 1 + len(api._context.dropped), 1 + 2 * 5)
+
+
+class FrameStream:
+    """A sync answer stream of `words`, counting how often it was started and whether it was closed early."""
+
+    def __init__(self, *words: str, delay: float = 0) -> None:
+        self.words = words
+        self.delay = delay
+        self.started = 0
+        self.closed = False
+
+    def __call__(self):
+        self.started += 1
+        content = ""
+        try:
+            for word in self.words:
+                time.sleep(self.delay)
+                content += word
+                yield format_frame(word, len(content))
+            yield STOP_FRAME
+        except GeneratorExit:
+            self.closed = True
+            raise
+
+
+def wait_until(condition, timeout: float = 2) -> bool:
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class GenerationResumeTestCase(SimpleTestCase):
+    """A reconnecting client continues the same generation from its `Last-Event-ID`."""
+
+    def test_resume_from_offset(self):
+        stream = FrameStream("a", "bb", "ccc")
+        generation = Generation("resume")
+        generation.attach(stream())
+        subscriber = generation.subscribe()
+        self.assertEqual(list(islice(subscriber, 1)), [format_frame("a", 1)])
+        subscriber.close()
+        # the reconnect reads on where the first subscriber stopped, the frames it got are skipped
+        self.assertEqual(
+            list(generation.subscribe(last_event_id=1)),
+            [format_frame("bb", 3), format_frame("ccc", 6), STOP_FRAME]
+        )
+        self.assertEqual(list(generation.subscribe(last_event_id=3)), [format_frame("ccc", 6), STOP_FRAME])
+        self.assertEqual(stream.started, 1)
+        self.assertFalse(stream.closed)
+
+    @override_settings(STREAM_DISCONNECT_GRACE=0.05)
+    def test_abandoned_generation_closed(self):
+        stream = FrameStream("a", "bb", "ccc")
+        generation = Generation("abandoned")
+        generation.attach(stream())
+        subscriber = generation.subscribe()
+        next(subscriber)
+        subscriber.close()
+        self.assertTrue(wait_until(lambda: generation.done))
+        self.assertTrue(stream.closed)
+        self.assertEqual(generation.frames[-1][1], STOP_FRAME)
+
+    @override_settings(STREAM_DISCONNECT_GRACE=0.2)
+    def test_reconnect_within_grace(self):
+        stream = FrameStream("a", "bb")
+        generation = Generation("grace")
+        generation.attach(stream())
+        subscriber = generation.subscribe()
+        next(subscriber)
+        subscriber.close()
+        self.assertEqual(list(generation.subscribe(last_event_id=1)), [format_frame("bb", 3), STOP_FRAME])
+        time.sleep(0.3)
+        self.assertFalse(stream.closed)
+
+    def test_running_in_another_process(self):
+        key = ("test", "running")
+        generation, created = GenerationRegistry().get_or_create(key)
+        self.assertTrue(created)
+        # another worker sharing the cache
+        other = GenerationRegistry()
+        self.assertIsNone(other.get(key))
+        self.assertTrue(other.running(key))
+        generation.fail()
+        self.assertFalse(other.running(key))
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    """Identical requests share one generation, in this process and across processes sharing the cache."""
+
+    def request(self, registry: GenerationRegistry, key, stream: FrameStream, results: list, barrier):
+        barrier.wait()
+        generation, created = registry.get_or_create(key)
+        if created:
+            generation.attach(stream())
+        results.append(list(generation.subscribe()))
+
+    def test_concurrent_requests_share_upstream(self):
+        registry = GenerationRegistry()
+        stream = FrameStream("a", "bb", "ccc", delay=0.05)
+        results: list = []
+        barrier = threading.Barrier(2)
+        threads = [
+            threading.Thread(target=self.request, args=(registry, ("test", "concurrent"), stream, results, barrier))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(stream.started, 1)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][-1], STOP_FRAME)
+
+    def test_second_subscriber_attaches(self):
+        registry = GenerationRegistry()
+        stream = FrameStream("a", "bb")
+        generation, created = registry.get_or_create(("test", "attach"))
+        generation.attach(stream())
+        first = generation.subscribe()
+        self.assertEqual(next(first), format_frame("a", 1))
+        duplicate, created = registry.get_or_create(("test", "attach"))
+        self.assertIs(duplicate, generation)
+        self.assertFalse(created)
+        # the duplicate gets the frames sent so far and then the same new ones
+        self.assertEqual(list(duplicate.subscribe()), [format_frame("a", 1), format_frame("bb", 3), STOP_FRAME])
+        self.assertEqual(list(first), [format_frame("bb", 3), STOP_FRAME])
+        self.assertEqual(stream.started, 1)
+
+    def test_running_in_another_process(self):
+        key = ("test", "elsewhere")
+        generation, _ = GenerationRegistry().get_or_create(key)
+        generation.attach(FrameStream("a")())
+        self.assertEqual(GenerationRegistry().get_or_create(key), (None, False))
+        list(generation.subscribe())
+        generation, created = GenerationRegistry().get_or_create(key)
+        self.assertTrue(created)
+        generation.fail()
+
+    def test_failing_generation(self):
+        def failing():
+            yield format_frame("a", 1)
+            raise RuntimeError("upstream error")
+
+        registry = GenerationRegistry()
+        key = ("test", "failing")
+        generation, _ = registry.get_or_create(key)
+        generation.attach(failing())
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(list(generation.subscribe()), [format_frame("a", 1), STOP_FRAME])
+        self.assertEqual(list(registry.get_or_create(key, resume=True)[0].subscribe(last_event_id=0)),
+                         [format_frame("a", 1), STOP_FRAME])
+        # the generation is over, a new request starts a new one
+        self.assertFalse(registry.running(key))
+        generation, created = registry.get_or_create(key)
+        self.assertTrue(created)
+        generation.fail()
+
+
+class ReplayStreamTestCase(TestCase):
+    """A reconnect served by another process resumes from the persisted answer."""
+
+    def setUp(self):
+        agent = Agent.objects.create(type=AgentTypes.TEXT)
+        chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+        self.ai_message = chat.messages.create(agent=agent, is_answer=True)
+        self.obj = self.ai_message.objs.create(
+            content_type=MessageObjectTypes.TEXT, content="Hello world", status=MessageObjectStatuses.AWAITING)
+
+    def test_replay_running(self):
+        frames = list(StreamAgentAPI(self.ai_message).replay_stream(6, running=True))
+        self.assertEqual(frames, [format_frame("world", 11), format_retry(2)])
+
+    def test_replay_finished(self):
+        self.obj.status = MessageObjectStatuses.INITIAL
+        self.obj.save()
+        frames = list(StreamAgentAPI(self.ai_message).replay_stream(6, running=True))
+        self.assertEqual(frames, [format_frame("world", 11), STOP_FRAME])
+
+    def test_replay_not_running(self):
+        # the process generating it is gone, the persisted part is all there is
+        frames = list(StreamAgentAPI(self.ai_message).replay_stream(6))
+        self.assertEqual(frames, [format_frame("world", 11), STOP_FRAME])
+
+
+def make_chunk(content=None, finish_reason=None) -> ChatCompletionChunk:
+    delta = {"content": content} if content is not None else {}
+    return ChatCompletionChunk.model_validate({
+        "id": "test", "object": "chat.completion.chunk", "created": 0, "model": "test",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    })
+
+
+class ScheduledStream:
+    """Completion chunks arriving `at` seconds after the stream was created."""
+
+    def __init__(self, *chunks) -> None:
+        self.started = time.monotonic()
+        self.chunks = list(chunks)
+
+    def __iter__(self):
+        while self.chunks:
+            at, chunk = self.chunks.pop(0)
+            time.sleep(max(self.started + at - time.monotonic(), 0))
+            yield chunk
+
+    def wait(self, timeout: float) -> bool:
+        delay = self.started + self.chunks[0][0] - time.monotonic() if self.chunks else 0
+        time.sleep(max(min(delay, timeout), 0))
+        return delay <= timeout
+
+
+class GenerationAPI(BaseGenerationAPI):
+    def get_system_prompt(self, *args, **kwargs):
+        return ""
+
+    def get_user_prompt(self, *args, **kwargs):
+        return ""
+
+
+@override_settings(SSE_COALESCE_MS=30, SSE_COALESCE_BYTES=1024)
+class CoalescedFlushTestCase(SimpleTestCase):
+    """Coalesced text is sent once `SSE_COALESCE_MS` passed, also when no new token arrives."""
+
+    def test_pending_text_flushed_without_new_tokens(self):
+        stream = ScheduledStream(
+            (0, make_chunk("a")), (0.01, make_chunk("b")), (0.5, make_chunk("c")), (0.5, make_chunk(finish_reason="stop")))
+        sent = [(frame, time.monotonic() - stream.started) for frame in GenerationAPI()._text_stream(stream)]
+        self.assertEqual([frame for frame, _ in sent],
+                         [format_frame("a", 1), format_frame("b", 2), format_frame("c", 3), STOP_FRAME])
+        # "b" is sent when its window ends, not with "c"
+        self.assertLess(sent[1][1], 0.2)
+
+    def test_wait_readable_socket(self):
+        reader, writer = socket.socketpair()
+        try:
+            response = httpx.Response(200, extensions={"network_stream": SyncStream(reader)})
+            stream = SimpleNamespace(response=response)
+            self.assertFalse(wait_readable(stream, 0.01))
+            writer.send(b"data: token\n\n")
+            self.assertTrue(wait_readable(stream, 0.01))
+        finally:
+            reader.close()
+            writer.close()
+
+
+LIMITS = {
+    "GLOBAL_RATE": 1000,
+    "GLOBAL_BURST": 1000,
+    "GLOBAL_MAX_IN_FLIGHT": 2,
+    "USER_RATE": 1000,
+    "USER_BURST": 1000,
+    "USER_MAX_IN_FLIGHT": 1,
+    "QUEUE_SIZE": 3,
+    "USER_QUEUE_SIZE": 2,
+    "QUEUE_TIMEOUT": 15,
+}
+
+
+class LimiterTestCase(SimpleTestCase):
+    """Calls over the global or per-user limits wait in a fair queue, a full queue answers 429."""
+
+    def test_user_cap(self):
+        limits = Limiter(LIMITS)
+        first = limits.enqueue("a")
+        second = limits.enqueue("a")
+        other = limits.enqueue("b")
+        self.assertTrue(first.admitted)
+        # the user is at its cap, another user is still admitted
+        self.assertFalse(second.admitted)
+        self.assertTrue(other.admitted)
+        first.release()
+        self.assertTrue(second.admitted)
+
+    def test_queue_position(self):
+        limits = Limiter({**LIMITS, "GLOBAL_MAX_IN_FLIGHT": 1})
+        running = limits.enqueue("a")
+        a = limits.enqueue("a")
+        b = limits.enqueue("b")
+        c = limits.enqueue("c")
+        self.assertEqual(running.position, 0)
+        # users with fewer calls in flight go first
+        self.assertEqual([b.position, c.position, a.position], [1, 2, 3])
+        # once its call is done, "a" has no more calls in flight than the others and was queued first
+        running.release()
+        self.assertTrue(a.admitted)
+        self.assertEqual([b.position, c.position], [1, 2])
+        b.release()
+        self.assertEqual(c.position, 1)
+
+    def test_queue_full(self):
+        limits = Limiter({**LIMITS, "GLOBAL_MAX_IN_FLIGHT": 0})
+        limits.enqueue("a")
+        limits.enqueue("a")
+        with self.assertRaises(TooManyRequests):
+            limits.enqueue("a")
+        limits.enqueue("b")
+        with self.assertRaises(TooManyRequests):
+            limits.enqueue("c")
+        self.assertEqual(limits.load(), 3)
+
+    def test_rate(self):
+        limits = Limiter({**LIMITS, "USER_RATE": 0.001, "USER_BURST": 1})
+        limits.check_rate("a")
+        with self.assertRaises(TooManyRequests):
+            limits.check_rate("a")
+        limits.check_rate("b")
+
+    def test_async_stream_closed_before_release(self):
+        ticket = limiter.enqueue("async-close")
+        events = []
+
+        async def answer():
+            try:
+                yield b"frame"
+                yield b"frame"
+            finally:
+                events.append(("closed", ticket.released))
+
+        async def consume():
+            stream = aqueued_stream(ticket, answer)
+            await stream.__anext__()
+            await stream.aclose()
+
+        asyncio.run(consume())
+        self.assertEqual(events, [("closed", False)])
+        self.assertTrue(ticket.released)
+
+
+class DeadlineTestCase(SimpleTestCase):
+    def test_timeout(self):
+        self.assertEqual(deadline.timeout(10), 10)
+        with deadline.deadline_scope(1):
+            self.assertLessEqual(deadline.timeout(10), 1)
+            self.assertEqual(deadline.timeout(0.5), 0.5)
+            with deadline.deadline_scope(60):
+                # an inner scope can't extend the deadline
+                self.assertLessEqual(deadline.timeout(10), 1)
+        with deadline.deadline_scope(0):
+            with self.assertRaises(DeadlineExceeded):
+                deadline.timeout(10)
+
+    @override_settings(GPT_API_KEY="test")
+    def test_client_timeout_not_capped(self):
+        # the provider is cached, so its clients are shared by requests with later deadlines
+        with deadline.deadline_scope(1):
+            provider = OpenAIProvider()
+            self.assertLessEqual(get_timeout().read, 1)
+        config = settings.OPENAI_HTTP
+        self.assertEqual(provider.client.timeout.read, config["READ_TIMEOUT"])
+        self.assertEqual(provider.async_client.timeout.connect, config["CONNECT_TIMEOUT"])
+        self.assertEqual(provider.client._client.timeout.read, config["READ_TIMEOUT"])
+
+    @override_settings(REQUEST_DEADLINE=120, CLOUD_TASK_DEADLINE=1800)
+    def test_middleware(self):
+        middleware = deadline.deadline_middleware(lambda request: deadline.remaining())
+        factory = RequestFactory()
+        task = {"HTTP_X_CLOUDTASKS_TASKNAME": "task"}
+        self.assertGreater(middleware(factory.post("/cloud_tasks/generate-image/", **task)), 120)
+        self.assertLessEqual(middleware(factory.post("/cloud_tasks/generate-image/")), 120)
+        # the header is only trusted on the Cloud Tasks handlers
+        self.assertLessEqual(middleware(factory.post("/chat/", **task)), 120)
+        self.assertIsNone(deadline.remaining())
+
+
+BREAKER = {
+    "WINDOW_SECONDS": 60,
+    "MIN_CALLS": 2,
+    "ERROR_RATE": 0.5,
+    "LATENCY_PERCENTILE": 95,
+    "LATENCY_THRESHOLD": 10,
+    "OPEN_SECONDS": 0.05,
+}
+HEDGED_CALL_SITES = {
+    "default": {"BREAKER": None, "HEDGE_AFTER": 0.1, "FALLBACK_MODEL": "fallback", "TARGET_LATENCY": None},
+}
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    def test_open_half_open_closed(self):
+        breaker = CircuitBreaker("test", BREAKER)
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        time.sleep(BREAKER["OPEN_SECONDS"])
+        # a single trial call goes through
+        breaker.allow()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+        breaker.record(True)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.allow()
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker("test", BREAKER)
+        breaker.record(False)
+        breaker.record(False)
+        time.sleep(BREAKER["OPEN_SECONDS"])
+        breaker.allow()
+        breaker.record(False)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+
+    def test_slow_calls_open(self):
+        breaker = CircuitBreaker("test", BREAKER)
+        breaker.record(True, 1)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(True, 20)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+
+@override_settings(LLM_CALL_SITES=HEDGED_CALL_SITES)
+class HedgingTestCase(SimpleTestCase):
+    def call(self, delays):
+        """Answers with the model after its delay, and records the calls in flight of `self.limits` meanwhile."""
+        def call(model):
+            self.in_flight.append(self.limits.load())
+            time.sleep(delays[model])
+            return model
+        return call
+
+    def setUp(self):
+        self.limits = Limiter({**LIMITS, "USER_MAX_IN_FLIGHT": 2})
+        self.in_flight = []
+
+    def test_fast_primary_not_hedged(self):
+        hedged = metrics.hedged_requests.value(call_site="fast")
+        model = call_with_resilience("fast", self.call({"primary": 0}), "primary")
+        self.assertEqual(model, "primary")
+        self.assertEqual(metrics.hedged_requests.value(call_site="fast"), hedged)
+
+    def test_slow_primary_hedged(self):
+        wins = metrics.hedge_wins.value(call_site="slow")
+        model = call_with_resilience(
+            "slow", self.call({"primary": 0.5, "fallback": 0}), "primary", admit=lambda: self.limits.acquire("a"))
+        self.assertEqual(model, "fallback")
+        self.assertEqual(metrics.hedge_wins.value(call_site="slow"), wins + 1)
+        # each request held its own slot
+        self.assertEqual(self.in_flight, [1, 2])
+        self.assertTrue(wait_until(lambda: self.limits.load() == 0))
+
+    def test_failed_primary_hedged(self):
+        def call(model):
+            if model == "primary":
+                raise ValueError()
+            return model
+        self.assertEqual(call_with_resilience("failed", call, "primary"), "fallback")
+
+    def test_hedge_timer_starts_once_admitted(self):
+        self.limits = Limiter({**LIMITS, "GLOBAL_MAX_IN_FLIGHT": 1})
+        running = self.limits.enqueue("b")
+        threading.Timer(0.3, running.release).start()
+        model = call_with_resilience(
+            "queued", self.call({"primary": 0}), "primary", admit=lambda: self.limits.acquire("a"))
+        # waiting for a slot longer than HEDGE_AFTER does not send a second request
+        self.assertEqual(model, "primary")
+        self.assertEqual(self.in_flight, [1])
+
+
+class CompletionCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = CompletionCache(LocMemCacheBackend(), ttl=60)
+
+    def test_key_normalized(self):
+        key = self.cache.make_key("model", [{"role": "user", "content": "Hi"}], {"type": "text"})
+        self.assertEqual(key, self.cache.make_key("model", [{"content": "Hi", "role": "user"}], {"type": "text"}))
+        self.assertNotEqual(key, self.cache.make_key("other", [{"role": "user", "content": "Hi"}], {"type": "text"}))
+        self.assertNotEqual(key, self.cache.make_key("model", [{"role": "user", "content": "Hi"}], {"type": "json_object"}))
+
+    def test_hit(self):
+        completion = ChatCompletion(
+            id="1", object="chat.completion", created=0, model="model",
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hello"}}])
+        hits = metrics.completion_cache_lookups.value(result="hit")
+        self.cache.set("key", completion)
+        self.assertEqual(self.cache.get("key"), completion)
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 0})
+        self.assertEqual(metrics.completion_cache_lookups.value(result="hit"), hits + 1)
+
+    def test_invalid_entry_removed(self):
+        invalid = metrics.completion_cache_lookups.value(result="invalid")
+        self.cache.backend.set("key", '{"id": "1"}', 60)
+        with self.assertLogs(level="WARNING"):
+            self.assertIsNone(self.cache.get("key"))
+        self.assertIsNone(self.cache.backend.get("key"))
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 1})
+        self.assertEqual(metrics.completion_cache_lookups.value(result="invalid"), invalid + 1)
+
+
+SHEDDING = {
+    "INITIAL_LIMIT": 10,
+    "MIN_LIMIT": 4,
+    "MAX_LIMIT": 12,
+    "INCREASE": 1,
+    "BACKOFF": 0.5,
+    "COOLDOWN": 60,
+    "RETRY_AFTER": 7,
+}
+
+
+class AdaptiveLimitTestCase(SimpleTestCase):
+    def test_additive_increase(self):
+        shedding = AdaptiveLimit(SHEDDING)
+        shedding.observe(True, 0.5, 1)
+        self.assertAlmostEqual(shedding.limit, 10.1)
+        # about INCREASE per round of `limit` calls, up to MAX_LIMIT
+        for _ in range(10):
+            shedding.observe(True, 0.5, 1)
+        self.assertAlmostEqual(shedding.limit, 11, delta=0.1)
+        for _ in range(100):
+            shedding.observe(True, 0.5, 1)
+        self.assertEqual(shedding.limit, 12)
+
+    def test_multiplicative_decrease(self):
+        shedding = AdaptiveLimit(SHEDDING)
+        # a slow call counts like a failed one
+        shedding.observe(True, 2, 1)
+        self.assertEqual(shedding.limit, 5)
+        # once per cooldown
+        shedding.observe(False, 0, 1)
+        self.assertEqual(shedding.limit, 5)
+        shedding._decreased -= SHEDDING["COOLDOWN"]
+        shedding.observe(False, 0, 1)
+        self.assertEqual(shedding.limit, SHEDDING["MIN_LIMIT"])
+
+    def test_without_target(self):
+        shedding = AdaptiveLimit(SHEDDING)
+        shedding.observe(True, 100, None)
+        self.assertEqual(shedding.limit, 10)
+        shedding.observe(False, 0, None)
+        self.assertEqual(shedding.limit, 5)
+
+    @override_settings(LOAD_SHEDDING=SHEDDING)
+    def test_retry_after(self):
+        limit = shedder.limit
+        self.addCleanup(setattr, shedder, "limit", limit)
+        shedder.limit = float(limiter.load() + 1)
+        check_capacity("test")
+        shedder.limit = float(limiter.load())
+        with self.assertRaises(ServiceUnavailable) as raised:
+            check_capacity("test")
+        response = exception_handler(raised.exception, {})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "7")
+
+
+class BatchProvider(FakeProvider):
+    """Fake provider recording the transaction and the job statuses its batches are submitted in."""
+
+    def __init__(self, **options) -> None:
+        super().__init__(**options)
+        self.submits = []
+        self.fail = False
+
+    def submit_batch(self, requests):
+        requests = list(requests)
+        statuses = BatchJob.objects.filter(pk__in=[request["custom_id"] for request in requests]).values_list(
+            'status', flat=True)
+        self.submits.append((connection.in_atomic_block, set(statuses)))
+        if self.fail:
+            raise FakeProviderError("Injected error.")
+        return super().submit_batch(requests)
+
+
+@override_settings(LLM_PROVIDER={
+    "BACKEND": "main.tests.BatchProvider",
+    "OPTIONS": {"first_token_latency": 0, "tokens": 2, "tokens_per_second": 1000},
+})
+class BatchJobTestCase(TransactionTestCase):
+    def setUp(self):
+        get_provider.cache_clear()
+        self.addCleanup(get_provider.cache_clear)
+        self.provider = get_provider()
+        self.chats = [Chat.objects.create(user_id="1", user_email="user@example.com", title="Untitled")
+                      for _ in range(2)]
+        batch.enqueue([
+            batch.make_job(BatchJobKinds.CHAT_TITLE, chat.pk, [{"role": "user", "content": f"chat {chat.pk}"}], "title")
+            for chat in self.chats
+        ])
+
+    def statuses(self):
+        return list(BatchJob.objects.order_by('pk').values_list('status', flat=True))
+
+    def test_submit_outside_transaction(self):
+        self.assertEqual(batch.submit_pending(), 2)
+        # claimed before, but not locked while uploading
+        self.assertEqual(self.provider.submits, [(False, {BatchJobStatuses.SUBMITTING})])
+        self.assertEqual(self.statuses(), [BatchJobStatuses.SUBMITTED] * 2)
+        self.assertEqual(len(set(BatchJob.objects.values_list('batch_id', flat=True))), 1)
+        self.assertEqual(batch.submit_pending(), 0)
+
+    def test_failed_submit_stays_pending(self):
+        self.provider.fail = True
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(batch.submit_pending(), 0)
+        self.assertEqual(self.statuses(), [BatchJobStatuses.PENDING] * 2)
+        self.assertFalse(BatchJob.objects.filter(date_submitted__isnull=False).exists())
+
+    def test_stale_claim_submitted_again(self):
+        first, second = BatchJob.objects.order_by('pk')
+        BatchJob.objects.filter(pk=first.pk).update(
+            status=BatchJobStatuses.SUBMITTING,
+            date_submitted=timezone.now() - timedelta(seconds=settings.BATCH_JOBS["SUBMIT_TIMEOUT"] + 1))
+        BatchJob.objects.filter(pk=second.pk).update(status=BatchJobStatuses.SUBMITTING, date_submitted=timezone.now())
+        self.assertEqual(batch.submit_pending(), 1)
+        self.assertEqual(self.statuses(), [BatchJobStatuses.SUBMITTED, BatchJobStatuses.SUBMITTING])
+
+    def test_collect_writes_titles(self):
+        batch.submit_pending()
+        Chat.objects.filter(pk=self.chats[1].pk).update(title="Renamed")
+        self.assertEqual(batch.collect_submitted(), (2, 0))
+        self.assertEqual(self.statuses(), [BatchJobStatuses.COMPLETED] * 2)
+        job = BatchJob.objects.get(target_id=str(self.chats[0].pk))
+        self.assertTrue(job.result)
+        self.assertEqual(Chat.objects.get(pk=self.chats[0].pk).title, job.result)
+        # only "Untitled" chats get a title
+        self.assertEqual(Chat.objects.get(pk=self.chats[1].pk).title, "Renamed")
+        self.assertEqual(self.provider._batches, {})
+        self.assertEqual(batch.collect_submitted(), (0, 0))
+
+    def test_collect_failed(self):
+        self.provider.error_rate = 1
+        batch.submit_pending()
+        self.assertEqual(batch.collect_submitted(), (0, 2))
+        self.assertEqual(self.statuses(), [BatchJobStatuses.FAILED] * 2)
+        self.assertEqual(set(BatchJob.objects.values_list('error', flat=True)), {"Injected error."})
+        self.assertEqual(set(Chat.objects.values_list('title', flat=True)), {"Untitled"})
+
+
+class RoutingTestCase(TestCase):
+    """Agents with a model use it, other calls the first matching rule of LLM_ROUTES, or GPT_MODEL_ENGINE."""
+
+    def setUp(self):
+        self.short = [{"role": "user", "content": "Hi"}]
+        self.long = [{"role": "user", "content": "Hi " * 200}]
+        routes = [
+            {"CALL_SITES": ["title"], "MODEL": "small"},
+            {"CALL_SITES": ["summary"]},
+            {"CALL_SITES": ["chat"], "AGENT_TYPES": [AgentTypes.TEXT],
+             "MAX_PROMPT_TOKENS": count_tokens(self.short[0]["content"]), "MODEL": "small"},
+        ]
+        settings_override = self.settings(GPT_MODEL_ENGINE="default", LLM_ROUTES=routes)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_rules(self):
+        self.assertEqual(route("title", self.long).model, "small")
+        # a rule without a model is skipped
+        self.assertEqual(route("summary", self.short).model, "default")
+        self.assertEqual(route("chat", self.short, agent_type=AgentTypes.TEXT).model, "small")
+        # over MAX_PROMPT_TOKENS
+        self.assertEqual(route("chat", self.long, agent_type=AgentTypes.TEXT).model, "default")
+        self.assertEqual(route("chat", self.short, agent_type=AgentTypes.IMAGE).model, "default")
+        self.assertEqual(route("interview", self.short).model, "default")
+
+    def test_prompt_tokens(self):
+        self.assertEqual(route("chat", self.long).prompt_tokens, count_tokens(self.long[0]["content"]))
+
+    def test_agent_model(self):
+        calls = metrics.llm_calls.value(call_site="chat", model="agent-model")
+        chat = Chat.objects.create(user_id="1", user_email="user@example.com")
+
+        def get_api(model):
+            agent = Agent.objects.create(type=AgentTypes.TEXT, model=model)
+            return StreamAgentAPI(chat.messages.create(is_answer=True, agent=agent))
+
+        api = get_api("agent-model")
+        # whatever the prompt size
+        for messages in (self.short, self.long):
+            api._messages = messages
+            self.assertEqual(api.get_route().model, "agent-model")
+        self.assertEqual(metrics.llm_calls.value(call_site="chat", model="agent-model"), calls + 2)
+        api = get_api("")
+        api._messages = self.short
+        self.assertEqual(api.get_route().model, "small")
+        api._messages = self.long
+        self.assertEqual(api.get_route().model, "default")
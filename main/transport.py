@@ -0,0 +1,137 @@
+"""
+Pooled and instrumented HTTP transport of the OpenAI clients.
+
+Pool limits, keep-alive, HTTP/2 and timeouts come from `settings.OPENAI_HTTP`. Every request
+is traced through the httpcore `trace` extension, which records:
+    - pool wait: from handing the request to the pool until it starts connecting or sending;
+    - connect: TCP connect and TLS handshake, only for requests that open a new connection;
+    - time to first byte: from sending the request headers until the response headers arrive.
+Measurements are labeled with the call set by `track_call`. The clients are shared by all
+requests, so their default timeouts are the static ones; calls pass `get_timeout()`, which is
+capped by the deadline of the request (see `main.deadline`). `wait_readable` waits for the next chunk of a
+streamed response without reading it, e.g. to send coalesced tokens meanwhile.
+"""
+import selectors
+import ssl
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+
+import httpx
+from django.conf import settings
+
+from main import deadline, metrics
+
+_call: ContextVar[str] = ContextVar("upstream_call", default="other")
+
+
+@contextmanager
+def track_call(name: str):
+    """Labels the upstream requests made inside the block with `name`."""
+    token = _call.set(name)
+    try:
+        yield
+    finally:
+        _call.reset(token)
+
+
+class RequestTrace:
+    """Collects the timings of a single request from httpcore trace events."""
+
+    def __init__(self) -> None:
+        self.call = _call.get()
+        self.started = time.monotonic()
+        self.picked: Optional[float] = None
+        self.connect_started: Optional[float] = None
+        self.headers_sent: Optional[float] = None
+
+    def trace(self, name: str, info: dict) -> None:
+        now = time.monotonic()
+        if self.picked is None:
+            self.picked = now
+            metrics.upstream_pool_wait_seconds.observe(now - self.started, call=self.call)
+        if name.endswith("connect_tcp.started"):
+            self.connect_started = now
+        elif name.endswith("send_request_headers.started"):
+            self.headers_sent = now
+            if self.connect_started is not None:
+                metrics.upstream_connect_seconds.observe(now - self.connect_started, call=self.call)
+        elif name.endswith("receive_response_headers.complete") and self.headers_sent is not None:
+            metrics.upstream_ttfb_seconds.observe(now - self.headers_sent, call=self.call)
+
+    async def atrace(self, name: str, info: dict) -> None:
+        self.trace(name, info)
+
+
+class InstrumentedTransport(httpx.HTTPTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = RequestTrace().trace
+        return super().handle_request(request)
+
+
+class AsyncInstrumentedTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = RequestTrace().atrace
+        return await super().handle_async_request(request)
+
+
+def get_client_timeout() -> httpx.Timeout:
+    """Default timeouts of the clients, not capped by any deadline since the clients outlive the request that built them."""
+    config = settings.OPENAI_HTTP
+    return httpx.Timeout(config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"], pool=config["POOL_TIMEOUT"])
+
+
+def get_timeout(stream: bool = False) -> httpx.Timeout:
+    """
+        Timeouts of a single call. Non-streamed calls only get the response once the whole answer is
+        generated, so their read timeout is long. Streamed calls get `STREAM_READ_TIMEOUT` between chunks.
+        Raises `DeadlineExceeded` if the deadline of the request passed.
+    """
+    config = settings.OPENAI_HTTP
+    return httpx.Timeout(
+        deadline.timeout(config["STREAM_READ_TIMEOUT"] if stream else config["READ_TIMEOUT"]),
+        connect=deadline.timeout(config["CONNECT_TIMEOUT"]),
+        pool=deadline.timeout(config["POOL_TIMEOUT"]),
+    )
+
+
+def _get_limits() -> httpx.Limits:
+    config = settings.OPENAI_HTTP
+    return httpx.Limits(
+        max_connections=config["MAX_CONNECTIONS"],
+        max_keepalive_connections=config["MAX_KEEPALIVE_CONNECTIONS"],
+        keepalive_expiry=config["KEEPALIVE_EXPIRY"],
+    )
+
+
+def build_http_client() -> httpx.Client:
+    transport = InstrumentedTransport(limits=_get_limits(), http2=settings.OPENAI_HTTP["HTTP2"])
+    return httpx.Client(transport=transport, timeout=get_client_timeout(), follow_redirects=True)
+
+
+def build_async_http_client() -> httpx.AsyncClient:
+    transport = AsyncInstrumentedTransport(limits=_get_limits(), http2=settings.OPENAI_HTTP["HTTP2"])
+    return httpx.AsyncClient(transport=transport, timeout=get_client_timeout(), follow_redirects=True)
+
+
+def wait_readable(stream: Any, timeout: float) -> bool:
+    """
+        Waits up to `timeout` seconds for data of a streamed response without reading it, returns False if none arrived.
+
+        Streams with a `.wait(timeout)` method (e.g. `main.resilience.PrefetchedStream`) answer themselves,
+        SDK streams are watched on the socket of their connection. Data the SDK has already read from the socket
+        is not seen, such a stream only looks idle until its next read. Streams without a socket are always readable.
+    """
+    if hasattr(stream, "wait"):
+        return stream.wait(timeout)
+    response = getattr(stream, "response", None)
+    network_stream = response.extensions.get("network_stream") if isinstance(response, httpx.Response) else None
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is None:
+        return True
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        return True
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        return bool(selector.select(timeout))
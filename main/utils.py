@@ -1,4 +1,5 @@
-import httpx
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
 from requests.exceptions import (
     HTTPError,
@@ -6,38 +7,132 @@ from requests.exceptions import (
     Timeout,
     RequestException,
 )
-from typing import List, Literal
+from typing import List, Literal, Optional
 from django.conf import settings
-from openai import OpenAI
+from django.db import connections
 from openai.types.chat import ChatCompletionMessageParam
 from rest_framework.exceptions import APIException
+from main import deadline
+from main.completion_cache import get_completion_cache
+from main.limiter import current_stream_ticket, current_user, limiter, stream_scope
+from main.providers import get_provider
+from main.resilience import APrefetchedStream, PrefetchedStream, acall_with_resilience, call_with_resilience
+from main.routing import Route, route
+from main.transport import get_timeout, track_call
 
-client = OpenAI(api_key=settings.GPT_API_KEY,
-                timeout=httpx.Timeout(timeout=600.0, connect=10.0))
+background_executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix="ai-background")
 
 
-def generate_chat_completion(messages: List[ChatCompletionMessageParam], temperature=0, stream=False, reply_json=False):
-    return client.chat.completions.create(
-        model=settings.GPT_MODEL_ENGINE,
-        messages=messages,
-        temperature=temperature,
-        stream=stream,
-        response_format={"type": "json_object" if reply_json else "text"}
-    )
+def run_in_background(func, *args, **kwargs) -> Future:
+    """
+        Runs `func` in the shared thread pool. Database connections opened by `func` are closed afterwards.
+        LLM calls of `func` run under the ticket of the current stream (see `main.limiter.stream_scope`).
+    """
+    ticket = current_stream_ticket()
+
+    def wrapper():
+        try:
+            with stream_scope(ticket):
+                return func(*args, **kwargs)
+        finally:
+            connections.close_all()
+    return background_executor.submit(wrapper)
+
+
+def generate_chat_completion(messages: List[ChatCompletionMessageParam], temperature=0, stream=False, reply_json=False,
+                             cache=False, call_site="default", route_to: Optional[Route] = None):
+    """
+        Creates a chat completion with the configured provider (see `main.providers`) and the model
+        routed for `call_site` (see `main.routing`), or the one of `route_to`.
+
+        With `cache=True`, deterministic calls (`temperature=0`, not streamed) are served from
+        the completion cache (see `main.completion_cache`) when the same request was made before.
+        Non-streamed calls are admitted by `main.limiter` (streams are admitted by the views), each
+        hedged request on its own; the auxiliary calls of a stream run under its slot (see
+        `main.limiter.stream_scope`).
+        The circuit breaker and hedging of `call_site` apply (see `main.resilience`); streams are
+        returned once their first token arrived.
+        Upstream timeouts are capped by the deadline of the request (see `main.deadline`).
+        The tokens of streams are left to the caller to report with `Route.record_tokens`.
+    """
+    deadline.check()
+    route_to = route_to or route(call_site, messages)
+    response_format = {"type": "json_object" if reply_json else "text"}
+    cache_key = None
+    if cache and not stream and temperature == 0:
+        completion_cache = get_completion_cache()
+        cache_key = completion_cache.make_key(route_to.model, messages, response_format)
+        if completion := completion_cache.get(cache_key):
+            return completion
+
+    def create(model: str):
+        completion = get_provider().chat_completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=stream,
+            response_format=response_format,
+            timeout=get_timeout(stream)
+        )
+        return PrefetchedStream(completion) if stream else completion
+
+    if stream:
+        with track_call("generate_chat_completion"):
+            started = time.monotonic()
+            completion = call_with_resilience(call_site, create, route_to.model)
+        route_to.record_latency(time.monotonic() - started)
+        return completion
+    user = current_user()
+    with track_call("generate_chat_completion"):
+        started = time.monotonic()
+        completion = call_with_resilience(call_site, create, route_to.model, admit=lambda: limiter.admit(user))
+    route_to.record_latency(time.monotonic() - started)
+    route_to.record_completion(completion)
+    if cache_key:
+        get_completion_cache().set(cache_key, completion)
+    return completion
+
+
+async def agenerate_chat_completion(messages: List[ChatCompletionMessageParam], temperature=0, stream=False, reply_json=False,
+                                    call_site="default", route_to: Optional[Route] = None):
+    """Async variant of `generate_chat_completion` for the ASGI streaming path."""
+    route_to = route_to or route(call_site, messages)
+
+    async def create(model: str):
+        completion = await get_provider().achat_completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=stream,
+            response_format={"type": "json_object" if reply_json else "text"},
+            timeout=get_timeout(stream)
+        )
+        return await APrefetchedStream.create(completion) if stream else completion
+
+    started = time.monotonic()
+    with track_call("agenerate_chat_completion"):
+        completion = await acall_with_resilience(call_site, create, route_to.model)
+    route_to.record_latency(time.monotonic() - started)
+    if not stream:
+        route_to.record_completion(completion)
+    return completion
 
 
 def generate_image(prompt: str, n: int, quality: Literal['standard', 'hd']):
     # try:
-    response = client.images.generate(
-        model=settings.DALLE_MODEL_ENGINE,
-        prompt=prompt,
-        quality=quality,
-        n=n
-    )
+    with limiter.acquire(current_user()), track_call("generate_image"):
+        # images have no fallback model, only the circuit breaker of the "image" call site applies
+        images = call_with_resilience("image", lambda model: get_provider().generate_image(
+            model=settings.DALLE_MODEL_ENGINE,
+            prompt=prompt,
+            quality=quality,
+            n=n,
+            timeout=get_timeout()
+        ))
     # except openai.InvalidRequestError as exc:
     #     logging.error("OpenAI raised InvalidRequestError! Exception = %s", str(exc))
     #     raise BadRequest('Prompt is not acceptable.') from exc
-    return response.data  # type: ignore
+    return images
 
 
 def check_user_video_credits(jwt_token):
@@ -51,7 +146,7 @@ def check_user_video_credits(jwt_token):
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        response = requests.get(url, headers=headers, timeout=deadline.timeout(settings.REQUESTS_TIMEOUT))
         response.raise_for_status()
 
     except HTTPError as err:
@@ -88,7 +183,8 @@ def decrement_user_video_credits(video_credit, jwt_token):
     }
 
     try:
-        response = requests.patch(url, json=data, headers=headers)
+        response = requests.patch(url, json=data, headers=headers,
+                                  timeout=deadline.timeout(settings.REQUESTS_TIMEOUT))
         response.raise_for_status()
 
     except HTTPError as err:
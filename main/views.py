@@ -1,4 +1,6 @@
+import hmac
 import logging
+from functools import partial
 from tempfile import TemporaryFile
 from typing import Any
 
@@ -6,7 +8,7 @@ import requests
 from requests.exceptions import RequestException
 from django.conf import settings
 from django.core.files import File
-from django.http import StreamingHttpResponse
+from django.http import Http404, HttpResponse
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from drf_spectacular.utils import extend_schema
@@ -16,8 +18,13 @@ from rest_framework.permissions import AllowAny
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
+from main import deadline, metrics
 from main.api import StreamAgentAPI
+from main.limiter import aqueued_stream, limiter, queued_stream
 from main.models import Agent, AgentTypes
+from main.shedding import aoverloaded_stream, check_capacity, is_overloaded, overloaded_stream
+from main.sse import format_retry, parse_last_event_id
+from main.stream_registry import generations
 from main.serializers import (
     AgentSerializer,
     AgentTypeSerializer,
@@ -26,9 +33,10 @@ from main.serializers import (
     SynclabWebhookSerializer,
     VideoRequestSerializer,
 )
-from custom.custom_exceptions import BadRequest
+from custom.custom_exceptions import BadRequest, TooManyRequests
 from custom.custom_permissions import HasUnexpiredSubscription
 from custom.custom_renderers import ServerSentEventRenderer
+from custom.custom_responses import is_asgi_request, sse_response
 from custom.custom_shortcuts import get_object_or_raise
 from chat.models import (
     MessageObject,
@@ -41,6 +49,7 @@ from chat.serializers import MessageCreateSerializer
 from .utils import (
     check_user_video_credits,
     decrement_user_video_credits,
+    run_in_background,
 )
 from .google_tasks import (
     create_update_user_onboarding_task,
@@ -87,7 +96,14 @@ class AiViewSet(viewsets.GenericViewSet):
     def stream(self, request: Request, pk=None):
         """
             Returns a Streaming HTTP Response rendered as Server-sent Event with text tokens.
-            The view uses StreamAgentAPI to generate title (for the jlab.ProjectTask) and text response.
+            The view uses StreamAgentAPI to generate text response. For untitled chats the title is
+            generated concurrently and sent as a separate `title` event.
+            Frames carry ids, a client reconnecting with `Last-Event-ID` gets the rest of the same answer.
+            Concurrent requests for the same message and agent share a single generation, a request served by
+            another worker than the generation follows its persisted answer (see `main.stream_registry`).
+            Over the user's or global LLM limits the request waits in a queue and gets `queued` events
+            with its position, or 429 if the queue is full. When the provider is slow, new generations
+            over the adaptive limit (see `main.shedding`) get the "high demand" message right away.
         """
         # TODO (DEV-111): refactor to not use agent ID in request
         chat = self.get_object()
@@ -99,24 +115,64 @@ class AiViewSet(viewsets.GenericViewSet):
             BadRequest("Invalid agent ID."),
             pk=data['agent_id']
         )
+        last_event_id = parse_last_event_id(request.headers.get("Last-Event-ID"))
+        key = ("chat", chat.pk, data['message_id'], agent.pk)
+        if last_event_id is not None and generations.get(key) is None:
+            # The generation is not running in this process: resume from the persisted answer
+            if response := self.replay_stream(request, chat, agent, data['message_id'], key, last_event_id):
+                return response
+        # Retries of a request that is still in flight attach to its generation
+        generation, created = generations.get_or_create(key, resume=last_event_id is not None)
+        if generation is None:
+            # It is in flight in another process: follow its answer, or reconnect once it is started
+            return (self.replay_stream(request, chat, agent, data['message_id'], key, last_event_id or 0)
+                    or sse_response([format_retry(settings.STREAM_CHECKPOINT_INTERVAL)]))
+        if created and is_overloaded(f"{self.basename}-{self.action}"):
+            generation.attach(aoverloaded_stream() if is_asgi_request(request) else overloaded_stream())
+        elif created:
+            try:
+                ticket = limiter.enqueue(str(request.user.id))
+            except TooManyRequests:
+                generation.fail()
+                raise
+            start = partial(self.start_stream, request, chat, agent, data['message_id'])
+            if is_asgi_request(request):
+                generation.attach(aqueued_stream(ticket, start))
+            else:
+                generation.attach(queued_stream(ticket, start))
+        if is_asgi_request(request):
+            return sse_response(generation.asubscribe(last_event_id))
+        return sse_response(generation.subscribe(last_event_id))
+
+    def replay_stream(self, request: Request, chat: Chat, agent: Agent, message_id: Any, key: Any, last_event_id: int):
+        """Resumes the persisted answer to `message_id` after `last_event_id`, returns None if there is none."""
+        ai_message = chat.messages.filter(is_answer=True, agent=agent, pk__gt=message_id).order_by('pk').first()
+        if not ai_message:
+            return None
+        api = StreamAgentAPI(ai_message)
+        running = generations.running(key)
+        if is_asgi_request(request):
+            return sse_response(api.areplay_stream(last_event_id, running))
+        return sse_response(api.replay_stream(last_event_id, running))
+
+    def start_stream(self, request: Request, chat: Chat, agent: Agent, message_id: Any):
+        """Creates the answer message and returns its text stream."""
         messages = Message.objects.filter(
-            chat=chat, agent__type=agent.type).prefetch_related('objs', 'agent')
+            chat=chat, agent__type=agent.type).select_related('agent')
         ai_message = chat.messages.create(is_answer=True, agent=agent)
-        
+        Chat.message_added(chat.pk)
+
         create_update_user_onboarding_task({
             "first_text": True
         }, str(request.auth))
         api = StreamAgentAPI(ai_message)
+        api.view = f"{self.basename}-{self.action}"
         if chat.title == "Untitled":
-            chat.title = api.get_title(data['message_id'])
-            chat.save()
-        stream = api.get_text_stream(messages, data['message_id'])
-        response = StreamingHttpResponse(
-            stream, content_type="text/event-stream")
-        response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
-        # Ensure clients don't cache the data
-        response['Cache-Control'] = 'no-cache'
-        return response
+            # The title is generated alongside the answer and sent as a separate `title` event
+            api.add_side_event("title", run_in_background(api.generate_title, message_id))
+        if is_asgi_request(request):
+            return api.aget_text_stream(messages, message_id)
+        return api.get_text_stream(messages, message_id)
 
     @extend_schema(responses={201: MessageCreateSerializer})
     @action(['post'], True)
@@ -159,6 +215,7 @@ class AiViewSet(viewsets.GenericViewSet):
             id=data['message_id']
         )
         ai_message = chat.messages.create(is_answer=True, agent=agent)
+        Chat.message_added(chat.pk)
         ai_msg_obj = ai_message.objs.create(
             content_type=MessageObjectTypes.VIDEO)
         if data['onboarding']:
@@ -180,6 +237,8 @@ class AiViewSet(viewsets.GenericViewSet):
             The view uses `generate_image_task` to asyncronously generate an image based on
             the provided TaskMessage's text content and the provided Agent's image prompt template.
         """
+        check_capacity(f"{self.basename}-{self.action}")
+        limiter.check_rate(str(request.user.id))
         chat = self.get_object()
         ser = self.get_serializer(data=request.data)
         ser.is_valid(raise_exception=True)
@@ -195,6 +254,7 @@ class AiViewSet(viewsets.GenericViewSet):
         if agent.type != AgentTypes.IMAGE:
             raise BadRequest("Invalid agent type.")
         ai_message = chat.messages.create(is_answer=True, agent=agent)
+        Chat.message_added(chat.pk)
         ai_msg_obj = ai_message.objs.create(
             content_type=MessageObjectTypes.IMAGE)
         if data['onboarding']:
@@ -226,7 +286,7 @@ class AiViewSet(viewsets.GenericViewSet):
             return Response()
         ai_msg_obj = MessageObject.objects.get(video_id=video_id)
         response = requests.get(
-            data['result']['videoUrl'], stream=True, timeout=settings.REQUESTS_TIMEOUT)
+            data['result']['videoUrl'], stream=True, timeout=deadline.timeout(settings.REQUESTS_TIMEOUT))
         filename = f"stage_video_{ai_msg_obj.pk}.mp4" if settings.DEBUG else f"video_{ai_msg_obj.pk}.mp4"
         tmp_file = TemporaryFile("w+b")
         for chunk in response.iter_content(1024):
@@ -259,3 +319,18 @@ class AgentViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
             By default, assumes AgentType of TEXT.
         """
         return super().list(request, *args, **kwargs)
+
+
+def metrics_view(request):
+    """
+        Metrics of this worker process in the Prometheus text format (see `main.metrics`).
+        A plain Django view, so it is protected with the `METRICS_TOKEN` bearer token instead of DRF permissions.
+    """
+    if not settings.METRICS_TOKEN:
+        raise Http404()
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+        response = HttpResponse("Unauthorized", status=401, content_type="text/plain")
+        response["WWW-Authenticate"] = 'Bearer realm="metrics"'
+        return response
+    return HttpResponse(metrics.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")